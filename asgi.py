@@ -0,0 +1,156 @@
+"""ASGI entry point.
+
+    uvicorn asgi:application --workers 4
+
+The catalog reads (GET /products, /products/search and /products/<id>)
+are served natively on the event loop with an async SQLAlchemy engine
+(asyncpg on PostgreSQL, aiosqlite on SQLite), so a slow query holds a
+coroutine instead of a thread. Every other route still runs the Flask
+view, through asgiref's WSGI adapter and its thread pool, and so do
+filtered or paged product listings, which the catalog index answers.
+
+Needs the optional packages asgiref, uvicorn and asyncpg or aiosqlite.
+"""
+import json
+import re
+from urllib.parse import parse_qs
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import with_polymorphic
+from main import app, BROWSE_PARAMETERS
+from product import Product
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite'
+}
+
+
+def async_database_url(url):
+    """Map a sync database URL to its async driver. Returns (url, connect_args)"""
+    url = make_url(url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f"No async driver for {url.get_backend_name()}")
+    connect_args = {}
+    if 'sslmode' in url.query:
+        # asyncpg takes the libpq sslmode as its ssl argument
+        connect_args['ssl'] = url.query['sslmode']
+        url = url.difference_update_query(['sslmode'])
+    return url.set(drivername=driver), connect_args
+
+
+def product_payload(product):
+    return {
+        'id': product.id,
+        'name': product.name,
+        'description': product.description,
+        'price': product.price,
+        'type': product.type,
+        'details': product.get_details()
+    }
+
+
+class AsyncApp:
+    """ASGI app serving the catalog reads itself and delegating the rest to Flask"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app) if WsgiToAsgi is not None else None
+        self.engine = None
+        self.routes = [
+            (re.compile(r'^/products$'), self.get_products),
+            (re.compile(r'^/products/search$'), self.search_products),
+            (re.compile(r'^/products/(?P<product_id>\d+)$'), self.get_product)
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            for pattern, handler in self.routes:
+                match = pattern.match(scope['path'])
+                if match:
+                    query = parse_qs(scope['query_string'].decode())
+                    if handler == self.get_products and any(name in query for name in BROWSE_PARAMETERS):
+                        break
+                    body, status, headers = await self.call_handler(handler, query, **match.groupdict())
+                    return await self.respond(send, body, status, headers)
+        if self.wsgi is None:
+            raise RuntimeError("asgiref is required to serve the Flask routes over ASGI")
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.engine is not None:
+                    await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def start(self):
+        if self.engine is None:
+            url, connect_args = async_database_url(self.flask_app.config['SQLALCHEMY_DATABASE_URI'])
+            self.engine = create_async_engine(url, connect_args=connect_args)
+
+    async def call_handler(self, handler, query, **kwargs):
+        self.start()
+        try:
+            async with AsyncSession(self.engine) as session:
+                return await handler(session, query, **kwargs)
+        except Exception as e:
+            return {'error': str(e)}, 500, {}
+
+    async def respond(self, send, body, status, headers):
+        payload = json.dumps(body).encode()
+        headers = dict(headers, **{'content-type': 'application/json', 'content-length': str(len(payload))})
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.encode(), value.encode()) for name, value in headers.items()]
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+
+    async def load_products(self, session, *criteria):
+        # Load the subclass columns up front; lazy loads cannot run on the event loop
+        products = with_polymorphic(Product, '*')
+        result = await session.execute(select(products).where(*criteria).order_by(products.id))
+        return result.scalars().all()
+
+    async def get_products(self, session, query):
+        products = await self.load_products(session)
+        return {'products': [product_payload(product) for product in products]}, 200, {}
+
+    async def search_products(self, session, query):
+        term = query.get('q', [''])[0]
+        if not term:
+            return {'error': 'Please provide a search term'}, 400, {}
+        products = await self.load_products(session, Product.name.ilike(f'%{term}%'))
+        if not products:
+            return {'message': 'No products found', 'products': []}, 200, {}
+        results = []
+        for product in products:
+            payload = product_payload(product)
+            del payload['id']
+            results.append(payload)
+        return {'message': f'Found {len(products)} products', 'products': results}, 200, {}
+
+    async def get_product(self, session, query, product_id):
+        products = await self.load_products(session, Product.id == int(product_id))
+        if not products:
+            return {'error': 'Product not found'}, 404, {}
+        product = products[0]
+        return product_payload(product), 200, {'etag': f'"{product.version_id}"'}
+
+
+application = AsyncApp(app)
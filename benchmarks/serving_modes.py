@@ -0,0 +1,113 @@
+"""Compare the sync WSGI server with the ASGI entry point under many waiting clients.
+
+    python benchmarks/serving_modes.py --mode wsgi --clients 200
+    python benchmarks/serving_modes.py --mode asgi --clients 200
+
+Starts the server against the configured database, then opens ``--clients``
+keep-alive connections that each request GET /products in a loop, pausing
+``--think`` seconds between requests like a browser would. Reports
+throughput and latency percentiles. The ASGI mode needs uvicorn.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'wsgi': lambda port: [sys.executable, '-m', 'flask', 'run', '--with-threads', '--port', str(port)],
+    'asgi': lambda port: [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(port), '--log-level', 'warning']
+}
+
+
+async def wait_for_server(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+async def fetch(reader, writer, path):
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode().partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def client(port, path, deadline, think, latencies, errors):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                status = await fetch(reader, writer, path)
+            except (OSError, asyncio.IncompleteReadError, IndexError, ValueError):
+                errors.append(1)
+                writer.close()
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                continue
+            if status == 200:
+                latencies.append(time.monotonic() - started)
+            else:
+                errors.append(status)
+            await asyncio.sleep(think)
+    finally:
+        writer.close()
+
+
+async def run(port, clients, duration, think, path):
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[client(port, path, deadline, think, latencies, errors) for _ in range(clients)])
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=sorted(SERVERS), default='wsgi')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--think', type=float, default=0.5, help='Seconds each client idles between requests')
+    parser.add_argument('--path', default='/products')
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    env = dict(os.environ, FLASK_APP='main')
+    server = subprocess.Popen(SERVERS[args.mode](args.port), cwd=ROOT, env=env)
+    try:
+        asyncio.run(wait_for_server(args.port))
+        latencies, errors = asyncio.run(run(args.port, args.clients, args.duration, args.think, args.path))
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    print(f"{args.mode}: {args.clients} clients, {args.duration:.0f}s")
+    print(f"  requests: {len(latencies)} ok, {len(errors)} failed, {len(latencies) / args.duration:.1f} req/s")
+    print(f"  latency:  p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,31 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import create_engine, text
+from sqlalchemy import orm
 from dotenv import load_dotenv
+from utils.replicas import RoutingSession, send_stickiness
 import os
 
 # Load environment variables
 load_dotenv()
 
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose session can read from the replicas in SQLALCHEMY_REPLICA_URIS"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def init_app(self, app):
+        super().init_app(app)
+
+        @app.before_request
+        def reset_session_routing():
+            self.session().reset_routing()
+
+        app.after_request(send_stickiness)
+
+
 # Initialize SQLAlchemy instance
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 def init_db(app):
     # Get Supabase credentials from environment variables
@@ -23,21 +41,62 @@ def init_db(app):
     # Configure Flask app
     app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    # Comma separated read replica URLs, e.g. the standby servers of DB_HOST
+    replica_urls = os.getenv('DB_REPLICA_URLS')
+    app.config['SQLALCHEMY_REPLICA_URIS'] = [url.strip() for url in replica_urls.split(',')] if replica_urls else []
+    app.config['REPLICA_POLICY'] = os.getenv('DB_REPLICA_POLICY', 'round_robin')
+    # Catalog snapshot shared by the workers on a node, e.g. /dev/shm/catalog.snapshot
+    app.config['CATALOG_SNAPSHOT_PATH'] = os.getenv('CATALOG_SNAPSHOT_PATH')
+    # Seconds between change log polls, and between full rebuilds, of the snapshot
+    app.config['CATALOG_REFRESH_INTERVAL'] = float(os.getenv('CATALOG_REFRESH_INTERVAL', 1))
+    app.config['CATALOG_REBUILD_INTERVAL'] = float(os.getenv('CATALOG_REBUILD_INTERVAL', 3600))
+    # Changed products the snapshot's delta holds before it is merged into the snapshot
+    app.config['CATALOG_DELTA_LIMIT'] = int(os.getenv('CATALOG_DELTA_LIMIT', 1000))
+    # Where the outbox dispatcher delivers events, e.g. file:logs/events.ndjson,http://localhost:9000/events
+    app.config['OUTBOX_SINKS'] = os.getenv('OUTBOX_SINKS', 'file:logs/events.ndjson')
+    # Where export jobs write their files
+    app.config['EXPORT_DIRECTORY'] = os.getenv('EXPORT_DIRECTORY', 'exports')
+    # 'write_behind' keeps browsing carts in a key-value store, e.g. CART_KV_URL=redis://localhost:6379/0
+    app.config['CART_BACKEND'] = os.getenv('CART_BACKEND', 'database')
+    app.config['CART_KV_URL'] = os.getenv('CART_KV_URL')
+    app.config['CART_FLUSH_INTERVAL'] = float(os.getenv('CART_FLUSH_INTERVAL', 5))
+    # Seconds to cache GET /cart summaries in each worker. Off by default: the
+    # cache is per process, so a cart changed through another worker can be
+    # served stale for up to this long. Only enable with a single worker.
+    app.config['CART_SUMMARY_CACHE_TTL'] = float(os.getenv('CART_SUMMARY_CACHE_TTL', 0))
     
     # Initialize the app with SQLAlchemy
     db.init_app(app)
     
-    # Create all tables within app context
+
+
+def verify_schema(app):
+    """Connect and check the schema revision; DDL runs through 'flask db-upgrade'"""
     with app.app_context():
         try:
-            # Enable PostgreSQL extensions if needed
-            db.session.execute(text('CREATE EXTENSION IF NOT EXISTS "uuid-ossp";'))
-            db.session.commit()
-            
-            # Create tables
-            db.create_all()
-            print("Successfully connected to Supabase!")
+            from migrations import verify
+            revision = verify(db.engine)
+            print(f"Successfully connected to Supabase! Schema revision {revision}")
         except Exception as e:
             print(f"Database connection error: {e}")
 
 
+def ensure_indexes():
+    """Create any index declared on the models that the database is missing.
+
+    ``create_all`` skips tables that already exist, so indexes added to
+    existing tables have to be created here. On PostgreSQL the indexes are
+    built CONCURRENTLY. Must run inside an app context. Returns the names of
+    the indexes created.
+    """
+    from migrations import Operations
+    op = Operations(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        if not op.has_table(table.name):
+            continue
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if op.create_index(index):
+                created.append(index.name)
+    return created
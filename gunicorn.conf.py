@@ -0,0 +1,75 @@
+import multiprocessing
+import os
+import signal
+
+wsgi_app = 'wsgi:application'
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+timeout = 60
+keepalive = 5
+
+# Import the app once in the master; workers fork with the code already loaded
+preload_app = True
+# Seconds a worker gets to finish in-flight requests after SIGTERM
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', 30))
+
+
+def on_starting(server):
+    from wsgi import application
+    from db import db, verify_schema
+    from product.snapshot import get_catalog
+
+    verify_schema(application)
+    # Build the node's catalog snapshot once, before any worker needs it
+    with application.app_context():
+        catalog = get_catalog()
+        if catalog is not None:
+            catalog.rebuild()
+    # Close the master's connections so no socket is shared with the workers
+    with application.app_context():
+        db.engine.dispose()
+
+
+def post_fork(server, worker):
+    from wsgi import application
+    from db import db
+    from utils.lifecycle import warm_up
+    from utils.replicas import reset_replicas
+    from product.snapshot import start_catalog_refresher
+
+    # Start from empty pools, then connect and fill caches before taking traffic
+    with application.app_context():
+        db.engine.dispose()
+    reset_replicas(application)
+    warm_up(application)
+    # One worker per node keeps the catalog snapshot current, the others stand by
+    start_catalog_refresher(application)
+
+
+def post_worker_init(worker):
+    from wsgi import application
+
+    lifecycle = application.extensions['lifecycle']
+    handle_exit = worker.handle_exit
+
+    def drain_on_exit(signum, frame):
+        # Fail the readiness probe while gunicorn finishes the in-flight requests
+        lifecycle.start_draining()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, drain_on_exit)
+
+
+def worker_exit(server, worker):
+    from wsgi import application
+    from db import db
+
+    application.extensions['lifecycle'].drain(timeout=graceful_timeout)
+    with application.app_context():
+        # Write out carts the worker still holds in memory
+        store = application.extensions.get('cart_store')
+        if store is not None:
+            store.flush(limit=None)
+        db.engine.dispose()
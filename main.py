@@ -1,18 +1,31 @@
-from flask import Flask, request, jsonify, session
-from db import db, init_db
+from utils.startup import startup
+from flask import Flask, Blueprint, Response, request, jsonify, session, g, current_app, stream_with_context, send_file
+from db import db, init_db, verify_schema, ensure_indexes
 from user import User, UserFactory
 from product import Product, ProductFactory
-from orders import Order, OrderFactory, Purchase, Return, Exchange
-from orders.cart import Cart
+from orders import Order, OrderFactory, OrderHeader, Purchase, Return, Exchange
+from orders.order_header import LINE_WINDOW
+from orders.cart import Cart, cart_summary_cache
+from orders.cart_store import get_cart_store, reset_cart_store
+from orders.pending import pending_counter, get_pending_queue, queue_entry, QUEUE_TYPES
+from orders.export import EXPORTS, EXPORT_FORMATS, export_orders, copy_csv
 from functools import wraps
+import click
 import jwt
 from werkzeug.security import check_password_hash
 from datetime import datetime, timedelta
-from product.physical import PhysicalProduct
-from product.digital import DigitalProduct
+from product.inventory import InventoryMovement, adjust_stock, set_stock, open_ledger, rebuild_stock
+from product.snapshot import get_catalog, CatalogRefresher
+from product.catalog_index import catalog_index, TYPE_CODES, SORTS
+from product.changes import get_changes, compact_changes
 from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, with_polymorphic
+from sqlalchemy.orm.exc import StaleDataError
 import uuid
 import os
+import json
+import time
 from dotenv import load_dotenv
 from utils.logger import (
     log_user_operation,
@@ -20,16 +33,17 @@ from utils.logger import (
     log_cart_operation,
     log_order_operation
 )
+from utils.idempotency import idempotent
+from utils.retry import retry_on_stale
+from utils.lifecycle import Lifecycle
+from utils.jobs import Job, JobRunner, job_handler, job_types, enqueue
+from utils.outbox import publish, Dispatcher, sinks_from_config, outbox_stats, prune_outbox
 
 # Load environment variables
 load_dotenv()
 
-app = Flask(__name__)
-# Get secret key from environment variable
-app.config['SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
-
-# Initialize database
-init_db(app)
+# Routes and CLI commands are registered on the app by create_app
+api = Blueprint('api', __name__, cli_group=None)
 
 def token_required(f):
     @wraps(f)
@@ -40,7 +54,7 @@ def token_required(f):
 
         try:
             token = token.split(' ')[1]
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
             current_user = User.query.get(data['user_id'])
             if not current_user:
                 return jsonify({'error': 'User not found'}), 404
@@ -48,6 +62,7 @@ def token_required(f):
             print(f"Token validation error: {str(e)}")  # Debug print
             return jsonify({'error': 'Token is invalid'}), 401
 
+        g.current_user = current_user
         return f(current_user, *args, **kwargs)
     return decorated
 
@@ -60,19 +75,21 @@ def admin_required(f):
 
         try:
             token = token.split(' ')[1]
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
             current_user = User.query.get(data['user_id'])
             if current_user.type != 'administrator':
                 return jsonify({'error': 'Admin privileges required'}), 403
         except:
             return jsonify({'error': 'Token is invalid'}), 401
 
+        g.current_user = current_user
         return f(current_user, *args, **kwargs)
     return decorated
 
 
 #Create users
-@app.route('/users', methods=['POST'])
+@api.route('/users', methods=['POST'])
+@idempotent()
 @log_user_operation('create_user')
 def create_users():
     """
@@ -82,6 +99,7 @@ def create_users():
     URL: http://localhost:5000/users
     Headers: 
         Content-Type: application/json
+        Idempotency-Key: string   # Optional - retries with the same key replay the first response
 
     Request Body:
     {
@@ -105,41 +123,7 @@ def create_users():
         if not isinstance(data, list):
             data = [data]
 
-        created_users = []
-        errors = []
-
-        for user_data in data:
-            try:
-                existing_user = User.query.filter_by(
-                    username=user_data['username']
-                ).first() or User.query.filter_by(
-                    email=user_data['email']
-                ).first()
-
-                if existing_user:
-                    errors.append(f"User with username {user_data['username']} or email {user_data['email']} already exists")
-                    continue
-
-                new_user = UserFactory.create_user(
-                    user_type=user_data.get('user_type', 'customer'),
-                    username=user_data['username'],
-                    email=user_data['email'],
-                    password=user_data['password']
-                )
-                
-                db.session.add(new_user)
-                db.session.flush() 
-                
-                created_users.append({
-                    'id': new_user.id,
-                    'username': new_user.username,
-                    'email': new_user.email,
-                    'type': new_user.type
-                })
-
-            except Exception as e:
-                errors.append(f"Error creating user {user_data.get('username')}: {str(e)}")
-        
+        created_users, errors = create_users_from(data)
         if created_users:
             db.session.commit()
         
@@ -156,8 +140,53 @@ def create_users():
         db.session.rollback()
         return jsonify({'error': str(e)}), 400
 
+def create_users_from(data, progress=None):
+    """Add users from a list of request dicts to the session, without committing.
+
+    Returns the created users as dicts and the list of per-user errors.
+    """
+    created_users = []
+    errors = []
+
+    for number, user_data in enumerate(data, start=1):
+        try:
+            existing_user = User.query.filter_by(
+                username=user_data['username']
+            ).first() or User.query.filter_by(
+                email=user_data['email']
+            ).first()
+
+            if existing_user:
+                errors.append(f"User with username {user_data['username']} or email {user_data['email']} already exists")
+                continue
+
+            new_user = UserFactory.create_user(
+                user_type=user_data.get('user_type', 'customer'),
+                username=user_data['username'],
+                email=user_data['email'],
+                password=user_data['password']
+            )
+            
+            db.session.add(new_user)
+            db.session.flush() 
+            
+            created_users.append({
+                'id': new_user.id,
+                'username': new_user.username,
+                'email': new_user.email,
+                'type': new_user.type
+            })
+
+        except Exception as e:
+            errors.append(f"Error creating user {user_data.get('username')}: {str(e)}")
+        finally:
+            if progress and number % 100 == 0:
+                progress(number / len(data), f"Processed {number} of {len(data)} users")
+
+    return created_users, errors
+
 # LOGIN - Authenticate user and get JWT token
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
 @log_user_operation('user_login')
 def login():
     try:
@@ -190,7 +219,7 @@ def login():
         token = jwt.encode({
             'user_id': user.id,
             'exp': datetime.utcnow() + timedelta(days=1)
-        }, app.config['SECRET_KEY'])
+        }, current_app.config['SECRET_KEY'])
 
         # Convert bytes to string if needed
         if isinstance(token, bytes):
@@ -206,7 +235,7 @@ def login():
         return jsonify({'error': str(e)}), 500
 
 # Get all users
-@app.route('/users', methods=['GET'])
+@api.route('/users', methods=['GET'])
 @admin_required
 def get_all_users(current_user):
     """
@@ -243,7 +272,7 @@ def get_all_users(current_user):
     })
 
 #  Get user by ID
-@app.route('/users/<int:user_id>', methods=['GET'])
+@api.route('/users/<int:user_id>', methods=['GET'])
 @admin_required
 def get_user(user_id):
     """
@@ -284,7 +313,7 @@ def get_user(user_id):
     })
 
 #Update user
-@app.route('/users/<int:user_id>', methods=['PUT'])
+@api.route('/users/<int:user_id>', methods=['PUT'])
 @token_required
 def update_user(current_user, user_id):
     """
@@ -360,7 +389,7 @@ def update_user(current_user, user_id):
         return jsonify({'error': str(e)}), 400
 
 #Delete user
-@app.route('/users/<int:user_id>', methods=['DELETE'])
+@api.route('/users/<int:user_id>', methods=['DELETE'])
 @admin_required
 def delete_user(user_id):
     """
@@ -394,8 +423,9 @@ def delete_user(user_id):
         return jsonify({'error': str(e)}), 400
 
 #Create products
-@app.route('/products', methods=['POST'])
+@api.route('/products', methods=['POST'])
 @admin_required
+@idempotent()
 @log_product_operation('create_product')
 def create_product(current_user):
     """
@@ -406,6 +436,7 @@ def create_product(current_user):
     Headers:
         Authorization: Bearer <token>
         Content-Type: application/json
+        Idempotency-Key: string   # Optional - retries with the same key replay the first response
 
     Request Body:
 
@@ -414,6 +445,7 @@ def create_product(current_user):
         "description": string,    # Product description (optional)
         "price": float,          # Product price
         "product_type": string,  # Either "physical" or "digital"
+        "sku": string,           # External SKU, unique (optional)
         
         # For physical products:
         "weight": float,         # Product weight (optional)
@@ -443,50 +475,9 @@ def create_product(current_user):
     data = request.get_json()
     if isinstance(data, dict):
         data = [data]
-    
-    created_products = []
-    errors = []
 
     try:
-        for product_data in data:
-            try:
-                
-                base_attrs = {
-                    'name': product_data['name'],
-                    'description': product_data.get('description', ''),
-                    'price': product_data['price']
-                }
-                if product_data['product_type'] == 'physical':
-                    base_attrs.update({
-                        'weight': product_data.get('weight'),
-                        'stock': product_data.get('stock', 0)
-                    })
-                elif product_data['product_type'] == 'digital':
-                    base_attrs.update({
-                        'file_size': product_data.get('file_size'),
-                        'download_link': product_data.get('download_link')
-                    })
-                new_product = ProductFactory.create_product(
-                    product_type=product_data['product_type'],
-                    **base_attrs
-                )
-                
-                db.session.add(new_product)
-                db.session.flush() 
-                
-                product_dict = {
-                    'id': new_product.id,
-                    'name': new_product.name,
-                    'description': new_product.description,
-                    'price': new_product.price,
-                    'type': new_product.type,
-                    'details': new_product.get_details()
-                }
-                created_products.append(product_dict)
-                
-            except Exception as e:
-                errors.append(f"Error creating product {product_data.get('name')}: {str(e)}")
-        
+        created_products, errors = create_products_from(data, current_user.id)
         if created_products:
             db.session.commit()
             response_data = created_products[0] if len(created_products) == 1 else created_products
@@ -498,8 +489,63 @@ def create_product(current_user):
         db.session.rollback()
         return jsonify({'error': str(e)}), 400
 
+def create_products_from(data, user_id, progress=None):
+    """Add products from a list of request dicts to the session, without committing.
+
+    Returns the created products as dicts and the list of per-product errors.
+    """
+    created_products = []
+    errors = []
+
+    for number, product_data in enumerate(data, start=1):
+        try:
+            
+            base_attrs = {
+                'name': product_data['name'],
+                'description': product_data.get('description', ''),
+                'price': product_data['price'],
+                'sku': product_data.get('sku')
+            }
+            if product_data['product_type'] == 'physical':
+                base_attrs.update({
+                    'weight': product_data.get('weight'),
+                    'stock': 0
+                })
+            elif product_data['product_type'] == 'digital':
+                base_attrs.update({
+                    'file_size': product_data.get('file_size'),
+                    'download_link': product_data.get('download_link')
+                })
+            new_product = ProductFactory.create_product(
+                product_type=product_data['product_type'],
+                **base_attrs
+            )
+            
+            # Initial stock goes through the inventory ledger
+            set_stock(new_product, product_data.get('stock', 0), user_id=user_id)
+
+            db.session.add(new_product)
+            db.session.flush() 
+            
+            product_dict = {
+                'id': new_product.id,
+                'name': new_product.name,
+                'description': new_product.description,
+                'price': new_product.price,
+                'type': new_product.type,
+                'details': new_product.get_details()
+            }
+            created_products.append(product_dict)
+            
+        except Exception as e:
+            errors.append(f"Error creating product {product_data.get('name')}: {str(e)}")
+        if progress and number % 100 == 0:
+            progress(number / len(data), f"Processed {number} of {len(data)} products")
+
+    return created_products, errors
+
 # search product by name
-@app.route('/products/search', methods=['GET'])
+@api.route('/products/search', methods=['GET'])
 def search_products():
     """
     Search for products by name.
@@ -554,7 +600,7 @@ def search_products():
         return jsonify({'error': str(e)}), 500
  
 #Get all products
-@app.route('/products', methods=['GET'])
+@api.route('/products', methods=['GET'])
 def get_products():
     """
     Get list of all products.
@@ -564,6 +610,15 @@ def get_products():
     Headers: 
         Content-Type: application/json
 
+    Query Parameters (any of them switches to a filtered, paginated listing):
+        min_price: float  # Optional
+        max_price: float  # Optional
+        type: string      # Optional - "physical" or "digital"
+        in_stock: bool    # Optional - "true" to hide physical products without stock
+        sort: string      # Optional - "price" or "-price", default by id
+        page: int         # Optional - default 1
+        per_page: int     # Optional - default 20, max 100
+
     Returns:
     200: {
         "products": [
@@ -575,10 +630,25 @@ def get_products():
                 "type": string,
                 "details": object
             }
-        ]
+        ],
+        "total": int,        # Filtered listing only
+        "page": int,         # Filtered listing only
+        "per_page": int      # Filtered listing only
     }
+    400: {"error": "Invalid product type"}
+    400: {"error": "Invalid sort"}
     """
     try:
+        if any(name in request.args for name in BROWSE_PARAMETERS):
+            return browse_products()
+
+        # Served straight from the node's catalog snapshot when there is one
+        catalog = get_catalog()
+        snapshot = catalog.current() if catalog else None
+        if snapshot is not None:
+            body = b'{"products":[' + snapshot.listing() + b']}\n'
+            return Response(body, mimetype='application/json'), 200
+
         products = Product.query.all()
         return jsonify({
             'products': [{
@@ -593,8 +663,122 @@ def get_products():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
+BROWSE_PARAMETERS = ('min_price', 'max_price', 'type', 'in_stock', 'sort', 'page', 'per_page')
+
+def load_product_documents(product_ids):
+    """{id: product dict} for the given ids that exist, in one query"""
+    if not product_ids:
+        return {}
+    products = with_polymorphic(Product, '*')
+    return {
+        product.id: {
+            'id': product.id,
+            'name': product.name,
+            'description': product.description,
+            'price': product.price,
+            'type': product.type,
+            'details': product.get_details()
+        } for product in db.session.query(products).filter(products.id.in_(product_ids))
+    }
+
+def browse_products():
+    """Filtered, sorted page of GET /products, answered from the in-memory catalog index"""
+    product_type = request.args.get('type')
+    if product_type is not None and product_type not in TYPE_CODES:
+        return jsonify({'error': 'Invalid product type'}), 400
+    sort = request.args.get('sort')
+    if sort is not None and sort not in SORTS:
+        return jsonify({'error': 'Invalid sort'}), 400
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+
+    product_ids, total = catalog_index.query(
+        min_price=request.args.get('min_price', type=float),
+        max_price=request.args.get('max_price', type=float),
+        product_type=product_type,
+        in_stock=request.args.get('in_stock', '').lower() in ('1', 'true', 'yes'),
+        sort=sort,
+        page=page,
+        per_page=per_page
+    )
+
+    # Load only the page, from the catalog snapshot when there is one
+    catalog = get_catalog()
+    snapshot = catalog.current() if catalog else None
+    documents = {}
+    if snapshot is not None:
+        for product_id in product_ids:
+            cached = snapshot.get(product_id)
+            if cached is not None:
+                documents[product_id] = json.loads(bytes(cached[0]))
+    missing = [product_id for product_id in product_ids if product_id not in documents]
+    documents.update(load_product_documents(missing))
+
+    return jsonify({
+        'products': [documents[product_id] for product_id in product_ids if product_id in documents],
+        'total': total,
+        'page': page,
+        'per_page': per_page
+    }), 200
+
+#Catalog change feed
+@api.route('/products/changes', methods=['GET'])
+def get_product_changes():
+    """
+    Get catalog changes after a sequence number, for incremental sync.
+
+    Start from since=0 (the whole catalog) and then pass the returned
+    next_since each time. Entries a later entry supersedes are compacted
+    away over time, so a product may appear once with its latest state.
+
+    Method: GET
+    URL: http://localhost:5000/products/changes?since=<seq>
+
+    Query Parameters:
+        since: int        # Optional - default 0, last seq already applied
+        limit: int        # Optional - default 100, max 1000
+
+    Returns:
+    200: {
+        "changes": [
+            {
+                "seq": int,
+                "product_id": int,
+                "operation": string,    # insert, update, stock or delete
+                "created_at": string,
+                "product": object       # Current product, null if deleted since
+            }
+        ],
+        "next_since": int,
+        "has_more": bool
+    }
+    """
+    try:
+        since = max(request.args.get('since', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+
+        changes, has_more = get_changes(since, limit)
+        # Read from the database, not the snapshot, so the product is at least as new as the entry
+        documents = load_product_documents(
+            sorted({change.product_id for change in changes if change.operation != 'delete'})
+        )
+
+        entries = []
+        for change in changes:
+            entry = change.to_dict()
+            entry['product'] = documents.get(change.product_id) if change.operation != 'delete' else None
+            entries.append(entry)
+
+        return jsonify({
+            'changes': entries,
+            'next_since': changes[-1].seq if changes else since,
+            'has_more': has_more
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 #Get product by ID
-@app.route('/products/<int:product_id>', methods=['GET'])
+@api.route('/products/<int:product_id>', methods=['GET'])
 def get_product(product_id):
     """
     Get product by ID.
@@ -615,21 +799,33 @@ def get_product(product_id):
     }
     """
     try:
+        catalog = get_catalog()
+        snapshot = catalog.current() if catalog else None
+        cached = snapshot.get(product_id) if snapshot is not None else None
+        if cached is not None:
+            body, version_id = cached
+            response = Response(b''.join((body, b'\n')), mimetype='application/json')
+            response.set_etag(str(version_id))
+            return response, 200
+
         product = Product.query.get_or_404(product_id)
-        return jsonify({
+        response = jsonify({
             'id': product.id,
             'name': product.name,
             'description': product.description,
             'price': product.price,
             'type': product.type,
             'details': product.get_details()
-        }), 200
+        })
+        response.set_etag(str(product.version_id))
+        return response, 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 #Update product
-@app.route('/products/<int:product_id>', methods=['PUT'])
+@api.route('/products/<int:product_id>', methods=['PUT'])
 @admin_required
+@retry_on_stale()
 def update_product(current_user, product_id):
     """
     Update an existing product. Admin only.
@@ -639,6 +835,7 @@ def update_product(current_user, product_id):
     Headers: 
         Content-Type: application/json
         Authorization: Bearer <token>
+        If-Match: string          # Optional - ETag from GET /products/<product_id>
 
     Request Body:
     {
@@ -667,12 +864,21 @@ def update_product(current_user, product_id):
             "details": object
         }
     }
+
+    Errors:
+    404: {"error": "Product not found"}
+    409: {"error": "Concurrent update conflict, please retry"}
+    412: {"error": "Product has been modified, reload and retry"}
     """
     try:
         product = Product.query.get(product_id)
         if not product:
             return jsonify({'error': 'Product not found'}), 404
 
+        # Only apply the update if the client saw the current version
+        if request.if_match and not request.if_match.contains(str(product.version_id)):
+            return jsonify({'error': 'Product has been modified, reload and retry'}), 412
+
         data = request.get_json()
 
         if 'name' in data:
@@ -687,7 +893,7 @@ def update_product(current_user, product_id):
             if 'weight' in data:
                 product.weight = data['weight']
             if 'stock' in data:
-                product.stock = data['stock']
+                set_stock(product, data['stock'], user_id=current_user.id)
         elif product.type == 'digital':
             if 'file_size' in data:
                 product.file_size = data['file_size']
@@ -696,7 +902,7 @@ def update_product(current_user, product_id):
                 
         db.session.commit()
         
-        return jsonify({
+        response = jsonify({
             'message': 'Product updated successfully',
             'product': {
                 'id': product.id,
@@ -706,13 +912,18 @@ def update_product(current_user, product_id):
                 'type': product.type,
                 'details': product.get_details()
             }
-        }), 200
+        })
+        response.set_etag(str(product.version_id))
+        return response, 200
+    except StaleDataError:
+        db.session.rollback()
+        raise
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 #Delete product (admin only)
-@app.route('/products/<int:product_id>', methods=['DELETE'])
+@api.route('/products/<int:product_id>', methods=['DELETE'])
 @admin_required
 def delete_product(current_user, product_id):
     """
@@ -748,9 +959,60 @@ def delete_product(current_user, product_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+#Get inventory movements for a product (admin only)
+@api.route('/products/<int:product_id>/movements', methods=['GET'])
+@admin_required
+def get_product_movements(current_user, product_id):
+    """
+    Get the inventory ledger for a product, newest first. Admin only.
+
+    Method: GET
+    URL: http://localhost:5000/products/<product_id>/movements
+    Headers:
+        Authorization: Bearer <token>
+
+    Query Parameters:
+        limit: int      # Optional - default 100, max 1000
+
+    Returns:
+    200: {
+        "product_id": int,
+        "stock": int,
+        "movements": [
+            {
+                "id": int,
+                "product_id": int,
+                "quantity": int,        # Signed stock change
+                "reason": string,       # checkout, return, exchange or adjust
+                "reference_id": int,    # Purchase/return/exchange ID
+                "user_id": int,
+                "created_at": string
+            }
+        ]
+    }
+    """
+    try:
+        product = Product.query.get(product_id)
+        if not product:
+            return jsonify({'error': 'Product not found'}), 404
+
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+        movements = InventoryMovement.query.filter_by(
+            product_id=product_id
+        ).order_by(InventoryMovement.id.desc()).limit(limit).all()
+
+        return jsonify({
+            'product_id': product_id,
+            'stock': getattr(product, 'stock', None),
+            'movements': [movement.to_dict() for movement in movements]
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 #Create return order
-@app.route('/orders/return', methods=['POST'])
+@api.route('/orders/return', methods=['POST'])
 @token_required
+@idempotent()
 @log_order_operation('create_return')
 def create_return(current_user):
     """
@@ -761,6 +1023,7 @@ def create_return(current_user):
     Headers:
         Content-Type: application/json
         Authorization: Bearer <token>
+        Idempotency-Key: string   # Optional - retries with the same key replay the first response
 
     Request Body:
     {
@@ -792,6 +1055,7 @@ def create_return(current_user):
     401: {"error": "Invalid or missing token"}
     403: {"error": "Unauthorized to return this purchase"}
     404: {"error": "Purchase not found"}
+    409: {"error": "A return request is already pending for this purchase"}
     500: {"error": "Internal server error message"}
     """
     data = request.get_json()
@@ -814,6 +1078,16 @@ def create_return(current_user):
         if purchase.status != 'completed':
             return jsonify({'error': 'Only completed purchases can be returned'}), 400
 
+        existing_return = Return.query.filter_by(
+            original_purchase_id=purchase.id,
+            active_request=True
+        ).first()
+        if existing_return:
+            return jsonify({
+                'error': 'A return request is already pending for this purchase',
+                'return_id': existing_return.id
+            }), 409
+
     
         if float(data.get('refund_amount')) > purchase.total_price:
             return jsonify({
@@ -828,7 +1102,7 @@ def create_return(current_user):
             refund_amount=data.get('refund_amount'),
             customer_email=current_user.email,
             customer_name=current_user.username,
-            purchase_date=purchase.date,
+            purchase_date=purchase.created_at,
             original_purchase_id=purchase.id
         )
         
@@ -837,6 +1111,7 @@ def create_return(current_user):
         
         db.session.add(return_order)
         db.session.commit()
+        pending_counter.increment('return')
 
         return jsonify({
             'message': 'Return request created successfully, waiting for admin approval',
@@ -847,18 +1122,23 @@ def create_return(current_user):
                 'product_id': purchase.product_id,
                 'reason': data.get('reason'),
                 'refund_amount': data.get('refund_amount'),
-                'purchase_date': purchase.date.strftime('%Y-%m-%d %H:%M:%S')
+                'purchase_date': purchase.created_at.strftime('%Y-%m-%d %H:%M:%S')
             }
         }), 201
 
+    except IntegrityError:
+        # Lost the race against a concurrent request for the same purchase
+        db.session.rollback()
+        return jsonify({'error': 'A return request is already pending for this purchase'}), 409
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
     
 
 #Create exchange order
-@app.route('/orders/exchange', methods=['POST'])
+@api.route('/orders/exchange', methods=['POST'])
 @token_required
+@idempotent()
 @log_order_operation('create_exchange')
 def create_exchange(current_user):
     """
@@ -869,6 +1149,7 @@ def create_exchange(current_user):
     Headers:
         Content-Type: application/json
         Authorization: Bearer <token>
+        Idempotency-Key: string   # Optional - retries with the same key replay the first response
 
     Request Body:
     {
@@ -876,6 +1157,9 @@ def create_exchange(current_user):
         "new_product_id": int,
         "reason": string
     }
+
+    Errors:
+    409: {"error": "An exchange request is already pending for this purchase"}
     """
     data = request.get_json()
     
@@ -901,6 +1185,16 @@ def create_exchange(current_user):
         if purchase.status != 'completed':
             return jsonify({'error': 'Only completed purchases can be exchanged'}), 400
 
+        existing_exchange = Exchange.query.filter_by(
+            original_purchase_id=purchase.id,
+            active_request=True
+        ).first()
+        if existing_exchange:
+            return jsonify({
+                'error': 'An exchange request is already pending for this purchase',
+                'exchange_id': existing_exchange.id
+            }), 409
+
       
         new_product = Product.query.get(data.get('new_product_id'))
         if not new_product:
@@ -914,7 +1208,7 @@ def create_exchange(current_user):
             reason=data.get('reason'),
             customer_email=current_user.email,
             customer_name=current_user.username,
-            purchase_date=purchase.date,
+            purchase_date=purchase.created_at,
             original_purchase_id=purchase.id
         )
         
@@ -923,6 +1217,7 @@ def create_exchange(current_user):
         
         db.session.add(exchange_order)
         db.session.commit()
+        pending_counter.increment('exchange')
 
         return jsonify({
             'message': 'Exchange request created successfully, waiting for admin approval',
@@ -933,17 +1228,22 @@ def create_exchange(current_user):
                 'original_product_id': purchase.product_id,
                 'new_product_id': new_product.id,
                 'reason': data.get('reason'),
-                'purchase_date': purchase.date.strftime('%Y-%m-%d %H:%M:%S')
+                'purchase_date': purchase.created_at.strftime('%Y-%m-%d %H:%M:%S')
             }
         }), 201
 
+    except IntegrityError:
+        # Lost the race against a concurrent request for the same purchase
+        db.session.rollback()
+        return jsonify({'error': 'An exchange request is already pending for this purchase'}), 409
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 # Admin approval route for returns
-@app.route('/orders/return/<int:return_id>/approve', methods=['POST'])
+@api.route('/orders/return/<int:return_id>/approve', methods=['POST'])
 @admin_required
+@retry_on_stale()
 def approve_return(current_user, return_id):
     """
     Approve or reject a return request. Admin only.
@@ -999,16 +1299,23 @@ def approve_return(current_user, return_id):
             
             return_order.status = 'approved'
             return_order.admin_notes = admin_notes
+            return_order.active_request = None
             return_order.approved_by = current_user.id
             return_order.approved_at = datetime.utcnow()
 
-            
-            if hasattr(product, 'stock'):
-                product.stock += 1
-                db.session.add(product)
+            adjust_stock(product, 1, 'return', return_order, current_user.id)
 
             db.session.add(return_order)
+            publish('return.approved', {
+                'return_id': return_order.id,
+                'user_id': return_order.user_id,
+                'product_id': return_order.product_id,
+                'refund_amount': return_order.refund_amount,
+                'original_purchase_id': return_order.original_purchase_id,
+                'decided_by': current_user.id
+            })
             db.session.commit()
+            pending_counter.decrement('return')
 
             return jsonify({
                 'message': 'Return approved successfully',
@@ -1029,11 +1336,20 @@ def approve_return(current_user, return_id):
             # Reject return
             return_order.status = 'rejected'
             return_order.admin_notes = admin_notes
+            return_order.active_request = None
             return_order.rejected_by = current_user.id
             return_order.rejected_at = datetime.utcnow()
             
             db.session.add(return_order)
+            publish('return.rejected', {
+                'return_id': return_order.id,
+                'user_id': return_order.user_id,
+                'product_id': return_order.product_id,
+                'original_purchase_id': return_order.original_purchase_id,
+                'decided_by': current_user.id
+            })
             db.session.commit()
+            pending_counter.decrement('return')
 
             return jsonify({
                 'message': 'Return rejected',
@@ -1048,14 +1364,18 @@ def approve_return(current_user, return_id):
                 }
             }), 200
 
+    except StaleDataError:
+        db.session.rollback()
+        raise
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 
 # Admin approval route for exchanges
-@app.route('/orders/exchange/<int:exchange_id>/approve', methods=['POST'])
+@api.route('/orders/exchange/<int:exchange_id>/approve', methods=['POST'])
 @admin_required
+@retry_on_stale()
 def approve_exchange(current_user, exchange_id):
     """
     Approve or reject an exchange request. Admin only.
@@ -1111,20 +1431,24 @@ def approve_exchange(current_user, exchange_id):
            
             exchange.status = 'approved'
             exchange.admin_notes = admin_notes
+            exchange.active_request = None
             exchange.approved_by = current_user.id
             exchange.approved_at = datetime.utcnow()
 
-            
-            if hasattr(original_product, 'stock'):
-                original_product.stock += 1
-                db.session.add(original_product)
-            
-            if hasattr(new_product, 'stock'):
-                new_product.stock -= 1
-                db.session.add(new_product)
+            adjust_stock(original_product, 1, 'exchange', exchange, current_user.id)
+            adjust_stock(new_product, -1, 'exchange', exchange, current_user.id)
 
             db.session.add(exchange)
+            publish('exchange.approved', {
+                'exchange_id': exchange.id,
+                'user_id': exchange.user_id,
+                'product_id': exchange.product_id,
+                'new_product_id': exchange.new_product_id,
+                'original_purchase_id': exchange.original_purchase_id,
+                'decided_by': current_user.id
+            })
             db.session.commit()
+            pending_counter.decrement('exchange')
 
             return jsonify({
                 'message': 'Exchange approved successfully',
@@ -1144,11 +1468,21 @@ def approve_exchange(current_user, exchange_id):
           
             exchange.status = 'rejected'
             exchange.admin_notes = admin_notes
+            exchange.active_request = None
             exchange.rejected_by = current_user.id
             exchange.rejected_at = datetime.utcnow()
             
             db.session.add(exchange)
+            publish('exchange.rejected', {
+                'exchange_id': exchange.id,
+                'user_id': exchange.user_id,
+                'product_id': exchange.product_id,
+                'new_product_id': exchange.new_product_id,
+                'original_purchase_id': exchange.original_purchase_id,
+                'decided_by': current_user.id
+            })
             db.session.commit()
+            pending_counter.decrement('exchange')
 
             return jsonify({
                 'message': 'Exchange rejected',
@@ -1163,13 +1497,106 @@ def approve_exchange(current_user, exchange_id):
                 }
             }), 200
 
+    except StaleDataError:
+        db.session.rollback()
+        raise
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
-# Add to cart 
-@app.route('/cart/add', methods=['POST'])
+# Admin queue of returns/exchanges waiting for approval
+@api.route('/orders/pending', methods=['GET'])
+@admin_required
+def get_pending_orders(current_user):
+    """
+    List returns and exchanges waiting for approval, oldest first. Admin only.
+
+    Method: GET
+    URL: http://localhost:5000/orders/pending
+    Headers:
+        Authorization: Bearer <token>
+
+    Query Parameters:
+        type: string      # Optional - "return" or "exchange", default both
+        page: int         # Optional - default 1
+        per_page: int     # Optional - default 20, max 100
+
+    Returns:
+    200: {
+        "orders": [
+            {
+                "id": int,
+                "type": string,
+                "status": string,
+                "date": string,
+                "product_id": int,
+                "original_purchase_id": int,
+                "customer_name": string,
+                "customer_email": string,
+                "reason": string,
+                "refund_amount": float,    # Returns only
+                "new_product_id": int      # Exchanges only
+            }
+        ],
+        "page": int,
+        "per_page": int,
+        "total": int,
+        "counts": {"return": int, "exchange": int}
+    }
+
+    Errors:
+    400: {"error": "Invalid order type"}
+    """
+    try:
+        order_type = request.args.get('type')
+        if order_type and order_type not in QUEUE_TYPES:
+            return jsonify({'error': 'Invalid order type'}), 400
+
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+
+        orders = get_pending_queue(order_type, page, per_page)
+        counts = pending_counter.counts()
+
+        return jsonify({
+            'orders': [queue_entry(order) for order in orders],
+            'page': page,
+            'per_page': per_page,
+            'total': counts[order_type] if order_type else sum(counts.values()),
+            'counts': counts
+        }), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Pending approval counts for the dashboard badge
+@api.route('/orders/pending/counts', methods=['GET'])
+@admin_required
+def get_pending_counts(current_user):
+    """
+    Get the number of returns and exchanges waiting for approval. Admin only.
+
+    Method: GET
+    URL: http://localhost:5000/orders/pending/counts
+    Headers:
+        Authorization: Bearer <token>
+
+    Returns:
+    200: {
+        "counts": {"return": int, "exchange": int},
+        "total": int
+    }
+    """
+    try:
+        counts = pending_counter.counts()
+        return jsonify({'counts': counts, 'total': sum(counts.values())}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Add to cart
+@api.route('/cart/add', methods=['POST'])
 @token_required
+@idempotent()
 @log_cart_operation('add_to_cart')
 def add_to_cart(current_user):
     try:
@@ -1190,27 +1617,14 @@ def add_to_cart(current_user):
         if not product:
             return jsonify({'error': 'Product not found'}), 404
 
-        # Create cart item
-        cart_item = Cart(
-            user_id=current_user.id,
-            product_id=product_id,
-            quantity=quantity,
-            total_price=product.price * quantity,
-            status='in_cart'
-        )
-
-        # Check stock availability
-        stock_available, message = cart_item.check_stock(product)
-        if not stock_available:
+        # Merged into the user's line for this product, with stock checked for the total
+        cart_item, message = get_cart_store().add(current_user.id, product, quantity)
+        if cart_item is None:
             return jsonify({'error': message}), 400
 
-        # Save to database
-        db.session.add(cart_item)
-        db.session.commit()
-
         return jsonify({
             'message': 'Item added to cart successfully',
-            'cart_item': cart_item.to_dict()
+            'cart_item': cart_item
         }), 201
 
     except Exception as e:
@@ -1218,8 +1632,70 @@ def add_to_cart(current_user):
         print(f"Add to cart error: {str(e)}")  # Debug print
         return jsonify({'error': str(e)}), 500
 
+# Add, update or remove many cart lines at once
+@api.route('/cart/bulk', methods=['POST'])
+@token_required
+@idempotent()
+@log_cart_operation('bulk_update_cart')
+def bulk_update_cart(current_user):
+    """
+    Apply many cart changes in one request, e.g. to reorder a purchase or add a bundle.
+
+    Method: POST
+    URL: http://localhost:5000/cart/bulk
+    Headers:
+        Authorization: Bearer <token>
+        Content-Type: application/json
+        Idempotency-Key: string   # Optional - retries with the same key replay the first response
+
+    Request Body:
+    {
+        "items": [
+            {
+                "product_id": int,
+                "quantity": int,    # Amount to add, or the new quantity for "set"
+                "action": string    # Optional - "add" (default), "set" or "remove"
+            }
+        ]
+    }
+
+    Returns:
+    200: {
+        "message": string,
+        "results": [
+            {
+                "product_id": int,
+                "action": string,
+                "status": string,   # "ok" or "error"
+                "quantity": int,    # Resulting line quantity, if ok
+                "error": string     # Reason, if error
+            }
+        ]
+    }
+
+    Errors:
+    400: {"error": "Items list is required"}
+    400: {"message": string, "results": [...]}   # No line could be applied
+    """
+    try:
+        data = request.get_json()
+        items = data.get('items') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'Items list is required'}), 400
+
+        results, applied = get_cart_store().apply_bulk(current_user.id, items)
+
+        return jsonify({
+            'message': f'Applied {applied} of {len(items)} cart changes',
+            'results': results
+        }), 200 if applied else 400
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 # Get cart contents 
-@app.route('/cart', methods=['GET'])
+@api.route('/cart', methods=['GET'])
 @token_required
 def get_cart(current_user):
     """
@@ -1234,29 +1710,30 @@ def get_cart(current_user):
     200: {
         "items": [
             {
-                "id": int,          # Cart item ID
-                "product_id": int,  # Product ID
-                "quantity": int,    # Quantity
-                "price": float,     # Unit price
-                "total": float      # Total price for this item
+                "id": int,              # Cart item ID, null until a write-behind cart is flushed
+                "product_id": int,      # Product ID
+                "name": string,         # Product name
+                "type": string,         # "physical" or "digital"
+                "quantity": int,        # Quantity
+                "price": float,         # Current unit price
+                "total_price": float,   # Total price for this item at the current price
+                "stock": int,           # Available stock (physical products only)
+                "stock_status": string, # in_stock, insufficient_stock, out_of_stock or digital
+                "status": string,
+                "created_at": string
             }
         ],
         "total": float             # Total price for all items
     }
     """
     try:
-        cart_items = Cart.get_user_cart(current_user.id)
-        
-        return jsonify({
-            'items': [item.to_dict() for item in cart_items],
-            'total': sum(item.total_price for item in cart_items)
-        }), 200
+        return jsonify(get_cart_store().summary(current_user.id)), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # Clear cart 
-@app.route('/cart/clear', methods=['DELETE'])
+@api.route('/cart/clear', methods=['DELETE'])
 @token_required
 def clear_cart(current_user):
     """
@@ -1273,7 +1750,7 @@ def clear_cart(current_user):
     }
     """
     try:
-        success, message = Cart.clear_cart(current_user.id)
+        success, message = get_cart_store().clear(current_user.id)
         
         if not success:
             return jsonify({'error': message}), 400
@@ -1284,100 +1761,734 @@ def clear_cart(current_user):
         return jsonify({'error': str(e)}), 500
 
 #Complete purchase 
-@app.route('/cart/complete', methods=['POST'])
+@api.route('/cart/complete', methods=['POST'])
 @token_required
+@idempotent()
+@retry_on_stale()
 @log_cart_operation('complete_purchase')
 def complete_cart(current_user):
+    cart_store = get_cart_store()
+    taken = None
     try:
-        # Get all cart items for user
-        cart_items = Cart.query.filter_by(
-            user_id=current_user.id,
-            status='in_cart'
-        ).all()
+        # Get all cart items for user, writing a write-behind cart to cart_items first
+        cart_items, taken = cart_store.take(current_user.id)
 
         if not cart_items:
             return jsonify({'error': 'No items in cart'}), 400
 
-        # Create purchase orders
-        purchase_ids = []
-        for cart_item in cart_items:
-            # Create purchase order
-            purchase = Purchase(
-                user_id=current_user.id,
-                product_id=cart_item.product_id,
-                quantity=cart_item.quantity,
-                total_price=cart_item.total_price,
-                status='completed'
-            )
-            db.session.add(purchase)
-            purchase_ids.append(purchase.id)
-            
-            # Update product stock if physical
-            product = Product.query.get(cart_item.product_id)
-            if isinstance(product, PhysicalProduct):
-                product.stock -= cart_item.quantity
-            
-            # Delete cart item
-            db.session.delete(cart_item)
-
+        products = {product.id: product for product in Product.query.filter(
+            Product.id.in_({cart_item.product_id for cart_item in cart_items})
+        )}
+
+        # One order header per checkout, priced from the products just loaded;
+        # its purchase lines are inserted in one batch
+        order = OrderHeader.from_cart(current_user.id, cart_items, products)
+        db.session.add(order)
+
+        # Update product stock if physical
+        for cart_item, purchase in zip(cart_items, order.lines):
+            adjust_stock(products[cart_item.product_id], -cart_item.quantity, 'checkout', purchase, current_user.id)
+
+        # Delete the checked-out lines in one statement
+        Cart.query.filter(
+            Cart.id.in_([cart_item.id for cart_item in cart_items])
+        ).delete(synchronize_session=False)
+
+        db.session.flush()
+        order_id, purchase_ids = order.id, [purchase.id for purchase in order.lines]
+        publish('order.completed', {
+            'order_id': order_id,
+            'user_id': current_user.id,
+            'item_count': order.item_count,
+            'total_price': order.total_price,
+            'lines': [{
+                'purchase_id': purchase.id,
+                'product_id': purchase.product_id,
+                'quantity': purchase.quantity,
+                'total_price': purchase.total_price
+            } for purchase in order.lines]
+        })
         db.session.commit()
+        cart_summary_cache.invalidate(current_user.id)
 
         return jsonify({
             'message': 'Purchase completed successfully',
+            'order_id': order_id,
             'purchase_ids': purchase_ids
         }), 200
 
+    except StaleDataError:
+        db.session.rollback()
+        cart_store.put_back(current_user.id, taken)
+        raise
     except Exception as e:
         db.session.rollback()
+        cart_store.put_back(current_user.id, taken)
         print(f"Complete cart error: {str(e)}")  # Debug print
         return jsonify({'error': str(e)}), 500
 
-@app.route('/reset-db', methods=['POST'])
+@api.route('/reset-db', methods=['POST'])
 def reset_database():
     try:
-        with db.engine.connect() as connection:
-            # Drop child tables first
-            connection.execute(text("DROP TABLE IF EXISTS cart_items CASCADE;"))
-            connection.execute(text("DROP TABLE IF EXISTS returns CASCADE;"))
-            connection.execute(text("DROP TABLE IF EXISTS exchanges CASCADE;"))
-            connection.execute(text("DROP TABLE IF EXISTS purchases CASCADE;"))
-            connection.execute(text("DROP TABLE IF EXISTS orders CASCADE;"))
-            connection.execute(text("DROP TABLE IF EXISTS physical_products CASCADE;"))
-            connection.execute(text("DROP TABLE IF EXISTS digital_products CASCADE;"))
-            connection.execute(text("DROP TABLE IF EXISTS products CASCADE;"))
-            connection.execute(text("DROP TABLE IF EXISTS customers CASCADE;"))
-            connection.execute(text("DROP TABLE IF EXISTS administrators CASCADE;"))
-            connection.execute(text("DROP TABLE IF EXISTS users CASCADE;"))
-            connection.commit()
-
-        # Recreate all tables
-        db.create_all()
+        reset_tables()
         
         return jsonify({'message': 'Database reset successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
-@app.route('/orders', methods=['GET'])
+def reset_tables():
+    """Drop every table except the job queue and rebuild the schema"""
+    with db.engine.connect() as connection:
+        # Drop child tables first
+        connection.execute(text("DROP TABLE IF EXISTS schema_version CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS idempotency_keys CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS inventory_movements CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS product_changes CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS outbox_events CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS cart_items CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS returns CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS exchanges CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS purchases CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS order_headers CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS orders CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS physical_products CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS digital_products CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS products CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS customers CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS administrators CASCADE;"))
+        connection.execute(text("DROP TABLE IF EXISTS users CASCADE;"))
+        connection.commit()
+
+    # Rebuild the schema through the migrations so it is versioned
+    from migrations import upgrade
+    upgrade(db.engine)
+    pending_counter.reset()
+    cart_summary_cache.clear()
+    reset_cart_store()
+    catalog_index.reset()
+
+#Export orders
+@api.route('/orders/export', methods=['GET'])
+@admin_required
+def export_orders_route(current_user):
+    """
+    Stream purchases, returns or exchanges for finance. Admin only.
+
+    Rows are read in chunks from a server-side cursor and written out as they
+    arrive, ordered by id. To resume an interrupted download, repeat the
+    request with after_id set to the last id received.
+
+    Method: GET
+    URL: http://localhost:5000/orders/export?type=purchase&format=csv
+    Headers:
+        Authorization: Bearer <token>
+
+    Query Parameters:
+        type: string      # Required - "purchase", "return" or "exchange"
+        format: string    # Optional - "csv" (default), "ndjson" or "parquet"
+        since: string     # Optional - ISO date, inclusive
+        until: string     # Optional - ISO date, exclusive
+        after_id: int     # Optional - resume after this id
+
+    Returns:
+    200: the export file, streamed
+
+    Errors:
+    400: {"error": "Invalid export type"}
+    400: {"error": "Invalid export format"}
+    400: {"error": "Invalid date, use YYYY-MM-DD"}
+    """
+    order_type = request.args.get('type')
+    export_format = request.args.get('format', 'csv')
+    if order_type not in EXPORTS:
+        return jsonify({'error': 'Invalid export type'}), 400
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': 'Invalid export format'}), 400
+
+    try:
+        since = datetime.fromisoformat(request.args['since']) if request.args.get('since') else None
+        until = datetime.fromisoformat(request.args['until']) if request.args.get('until') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid date, use YYYY-MM-DD'}), 400
+
+    try:
+        pieces = export_orders(order_type, export_format, since, until, request.args.get('after_id', type=int))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    response = Response(stream_with_context(pieces), mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename={order_type}s.{export_format}'
+    return response
+
+@api.route('/orders', methods=['GET'])
 @token_required
 @log_order_operation('get_orders')
 def get_orders(current_user):
-    """Get orders for the current user or all orders for admin"""
+    """
+    Get the current user's orders, or all orders for admin, newest first.
+
+    Method: GET
+    URL: http://localhost:5000/orders
+    Headers:
+        Authorization: Bearer <token>
+
+    Query Parameters:
+        page: int         # Optional - default 1
+        per_page: int     # Optional - default 20, max 100
+        since: string     # Optional - ISO date, orders created on or after
+        until: string     # Optional - ISO date, orders created before
+
+    Returns:
+    200: {
+        "orders": [
+            {
+                "id": int,
+                "status": string,
+                "item_count": int,
+                "total_price": float,
+                "created_at": string,
+                "lines": [
+                    {
+                        "id": int,              # Purchase id, used for returns and exchanges
+                        "order_header_id": int,
+                        "product_id": int,
+                        "quantity": int,
+                        "total_price": float,
+                        "status": string,
+                        "created_at": string,
+                        "details": object
+                    }
+                ]
+            }
+        ],
+        "page": int,
+        "per_page": int
+    }
+    400: {"error": "Invalid date"}
+    """
     try:
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+        try:
+            since = datetime.fromisoformat(request.args['since']) if request.args.get('since') else None
+            until = datetime.fromisoformat(request.args['until']) if request.args.get('until') else None
+        except ValueError:
+            return jsonify({'error': 'Invalid date'}), 400
+
+        query = OrderHeader.query
         # Check if admin by checking the type attribute
-        if current_user.type == 'administrator':
-            # Admin can see all orders
-            purchases = Purchase.query.all()
-        else:
+        if current_user.type != 'administrator':
             # Customers can only see their own orders
-            purchases = Purchase.query.filter_by(user_id=current_user.id).all()
+            query = query.filter_by(user_id=current_user.id)
+
+        # Filtering on created_at lets partitioned tables skip the other months.
+        # Lines are never older than their order, so the same range applies to them.
+        lines = OrderHeader.lines
+        if since is not None:
+            query = query.filter(OrderHeader.created_at >= since)
+            lines = lines.and_(Purchase.created_at >= since)
+        if until is not None:
+            query = query.filter(OrderHeader.created_at < until)
+            lines = lines.and_(Purchase.created_at < until + LINE_WINDOW)
+
+        # One query for the page of headers and one for all of their lines
+        orders = query.options(selectinload(lines)).order_by(
+            OrderHeader.created_at.desc(), OrderHeader.id.desc()
+        ).limit(per_page).offset((page - 1) * per_page).all()
 
         return jsonify({
-            'orders': [purchase.to_dict() for purchase in purchases]
+            'orders': [order.to_dict() for order in orders],
+            'page': page,
+            'per_page': per_page
         }), 200
 
     except Exception as e:
         print(f"Get orders error: {str(e)}")  # Debug print
         return jsonify({'error': str(e)}), 500
     
+@api.cli.command('open-ledger')
+def open_ledger_command():
+    """Record opening stock balances for products without ledger entries."""
+    seeded = open_ledger()
+    print(f"Recorded opening balances for {seeded} products")
+
+@api.cli.command('rebuild-stock')
+@click.option('--dry-run', is_flag=True, help='Only report drifted products.')
+def rebuild_stock_command(dry_run):
+    """Replay the inventory ledger and repair drifted stock values."""
+    drifted = rebuild_stock(dry_run=dry_run)
+    for product_id, (stored, expected) in sorted(drifted.items()):
+        print(f"Product {product_id}: stock {stored} -> {expected}")
+    action = 'Found' if dry_run else 'Repaired'
+    print(f"{action} {len(drifted)} drifted products")
+
+@api.cli.command('compact-cart')
+def compact_cart_command():
+    """Merge duplicate in-cart lines and create the unique cart line index."""
+    removed = Cart.compact_lines()
+    print(f"Merged duplicate cart lines, removed {removed} rows")
+
+@api.cli.command('sweep-carts')
+@click.option('--days', default=30, show_default=True, help='Age after which in-cart lines count as abandoned.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows deleted per transaction.')
+def sweep_carts_command(days, batch_size):
+    """Purge completed and abandoned cart lines."""
+    reclaimed = Cart.sweep(abandoned_days=days, batch_size=batch_size)
+    print(
+        f"Reclaimed {sum(reclaimed.values())} cart rows "
+        f"({reclaimed['completed']} completed, {reclaimed['abandoned']} abandoned)"
+    )
+
+@api.cli.command('flush-carts')
+@click.option('--batch-size', default=100, show_default=True, help='Carts written per round.')
+def flush_carts_command(batch_size):
+    """Write changed write-behind carts to cart_items."""
+    store = get_cart_store()
+    flushed = total = store.flush(batch_size)
+    while flushed == batch_size:
+        flushed = store.flush(batch_size)
+        total += flushed
+    print(f"Flushed {total} carts")
+
+@api.cli.command('create-indexes')
+def create_indexes_command():
+    """Create indexes declared on the models that are missing from the database."""
+    created = ensure_indexes()
+    for name in created:
+        print(f"Created index {name}")
+    print(f"Created {len(created)} indexes")
+
+@api.cli.command('db-upgrade')
+@click.option('--target', type=int, default=None, help='Stop at this revision.')
+def db_upgrade_command(target):
+    """Apply pending schema migrations."""
+    from migrations import upgrade, current_revision
+    applied = upgrade(db.engine, target)
+    for revision in applied:
+        print(f"Applied migration {revision}")
+    print(f"Schema at revision {current_revision(db.engine)}")
+
+@api.cli.command('db-version')
+def db_version_command():
+    """Show the applied and latest schema revisions."""
+    from migrations import current_revision, latest_revision
+    print(f"Current revision: {current_revision(db.engine)}")
+    print(f"Latest revision: {latest_revision()}")
+
+@api.cli.command('export-orders')
+@click.option('--type', 'order_type', type=click.Choice(sorted(EXPORTS)), required=True)
+@click.option('--format', 'export_format', type=click.Choice(sorted(EXPORT_FORMATS)), default='csv')
+@click.option('--since', type=click.DateTime(), default=None, help='Inclusive start date.')
+@click.option('--until', type=click.DateTime(), default=None, help='Exclusive end date.')
+@click.option('--after-id', type=int, default=None, help='Resume after this id.')
+@click.option('--output', default='-', help='File to write, default stdout.')
+def export_orders_command(order_type, export_format, since, until, after_id, output):
+    """Export purchases, returns or exchanges as CSV, NDJSON or Parquet."""
+    with click.open_file(output, 'wb') as out:
+        # COPY TO is far faster than fetching rows when the database can do it
+        if export_format == 'csv' and db.engine.dialect.name == 'postgresql':
+            copy_csv(order_type, out, since, until, after_id)
+            return
+        for piece in export_orders(order_type, export_format, since, until, after_id):
+            out.write(piece.encode() if isinstance(piece, str) else piece)
+
+@api.cli.command('import-catalog')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'feed_format', type=click.Choice(['csv', 'ndjson']), default=None,
+              help='Feed format, default from the file extension.')
+@click.option('--batch-size', default=10000, help='Rows staged per COPY/INSERT batch.')
+def import_catalog_command(path, feed_format, batch_size):
+    """Load a product feed, creating or updating products by SKU."""
+    from product.catalog_import import read_feed, import_catalog
+    counts, errors = import_catalog(read_feed(path, feed_format), batch_size=batch_size)
+    for line, error in errors[:20]:
+        print(f"Line {line}: {error}")
+    print(f"Staged {counts['staged']} rows: {counts['inserted']} products created, "
+          f"{counts['updated']} updated, {counts['stock_movements']} stock changes, "
+          f"{len(errors)} rejected")
+
+@api.cli.command('partition-orders')
+@click.option('--months-ahead', default=3, show_default=True, help='Future months to create partitions for.')
+def partition_orders_command(months_ahead):
+    """Convert order headers and purchases to monthly partitioned tables (PostgreSQL)."""
+    from orders.partitions import PARTITIONED_TABLES, partition_table
+    if db.engine.dialect.name != 'postgresql':
+        print("Partitioning needs PostgreSQL")
+        return
+    for table in PARTITIONED_TABLES:
+        converted = partition_table(table, months_ahead)
+        print(f"{'Partitioned' if converted else 'Already partitioned'}: {table}")
+
+@api.cli.command('create-partitions')
+@click.option('--months-ahead', default=3, show_default=True, help='Future months to create partitions for.')
+def create_partitions_command(months_ahead):
+    """Create upcoming monthly partitions for order history."""
+    from orders.partitions import ensure_partitions
+    created = ensure_partitions(months_ahead)
+    for name in created:
+        print(f"Created partition {name}")
+    print(f"Created {len(created)} partitions")
+
+@api.cli.command('archive-orders')
+@click.option('--before', type=click.DateTime(['%Y-%m-%d']), required=True,
+              help='Archive months that end on or before this date.')
+@click.option('--mode', type=click.Choice(['schema', 'export']), default='schema', show_default=True,
+              help='Move partitions to the archive schema, or export them to gzipped CSV and drop them.')
+@click.option('--directory', default='archive', show_default=True, help='Where exported partitions are written.')
+def archive_orders_command(before, mode, directory):
+    """Detach and archive cold order history partitions."""
+    from orders.partitions import archive_partitions
+    archived = archive_partitions(before.date(), mode, directory)
+    for name in archived:
+        print(f"Archived {name}")
+    print(f"Archived {len(archived)} partitions")
+
+@api.cli.command('catalog-snapshot')
+def catalog_snapshot_command():
+    """Rebuild the catalog snapshot at CATALOG_SNAPSHOT_PATH from the database."""
+    catalog = get_catalog()
+    if catalog is None:
+        print("CATALOG_SNAPSHOT_PATH is not set")
+        return
+    snapshot = catalog.rebuild()
+    if snapshot is None:
+        print("Catalog snapshot build failed, see the product log")
+        return
+    print(f"Wrote snapshot {snapshot.generation} with {len(snapshot)} products to {catalog.path}")
+
+@api.cli.command('refresh-catalog')
+@click.option('--interval', default=1.0, show_default=True, help='Seconds between rounds.')
+def refresh_catalog_command(interval):
+    """Keep the node's catalog snapshot current, for servers without the gunicorn hooks."""
+    catalog = get_catalog()
+    if catalog is None:
+        print("CATALOG_SNAPSHOT_PATH is not set")
+        return
+    CatalogRefresher(
+        current_app._get_current_object(), catalog,
+        interval=interval,
+        rebuild_interval=current_app.config.get('CATALOG_REBUILD_INTERVAL', 3600)
+    ).run()
+
+@api.cli.command('compact-product-changes')
+@click.option('--keep-hours', default=24, show_default=True, help='Leave entries newer than this untouched.')
+def compact_product_changes_command(keep_hours):
+    """Drop product change log entries superseded by a later entry."""
+    removed = compact_changes(timedelta(hours=keep_hours))
+    print(f"Removed {removed} superseded product changes")
+
+@api.cli.command('dispatch-outbox')
+@click.option('--batch-size', default=100, show_default=True, help='Events claimed per batch.')
+@click.option('--interval', default=1.0, show_default=True, help='Seconds to wait when the outbox is empty.')
+@click.option('--once', is_flag=True, help='Deliver what is pending and exit.')
+def dispatch_outbox_command(batch_size, interval, once):
+    """Deliver outbox events to the sinks in OUTBOX_SINKS."""
+    dispatcher = Dispatcher(sinks_from_config(current_app.config['OUTBOX_SINKS']), batch_size=batch_size)
+    started = time.monotonic()
+    if once:
+        while dispatcher.dispatch_once():
+            pass
+    else:
+        try:
+            dispatcher.run(interval)
+        except KeyboardInterrupt:
+            pass
+    metrics = dispatcher.metrics
+    print(f"Delivered {metrics['delivered']} events in {metrics['batches']} batches "
+          f"({dispatcher.throughput():.0f}/s while busy, {time.monotonic() - started:.1f}s total), "
+          f"{metrics['retried']} to retry, {metrics['failed']} failed")
+
+@api.cli.command('prune-outbox')
+@click.option('--keep-days', default=7, show_default=True, help='Keep delivered events this long.')
+def prune_outbox_command(keep_days):
+    """Delete delivered outbox events."""
+    print(f"Deleted {prune_outbox(timedelta(days=keep_days))} delivered events")
+
+#Outbox metrics
+@api.route('/outbox/metrics', methods=['GET'])
+@admin_required
+def get_outbox_metrics(current_user):
+    """
+    Report the outbox backlog and delivery rate. Admin only.
+
+    Method: GET
+    URL: http://localhost:5000/outbox/metrics
+    Headers:
+        Authorization: Bearer <token>
+
+    Returns:
+    200: {
+        "pending": int,                 # Waiting for or in delivery
+        "failed": int,                  # Gave up after the retry limit
+        "delivered": int,
+        "lag_seconds": float,           # Age of the oldest undelivered event
+        "delivered_per_minute": int
+    }
+    """
+    try:
+        return jsonify(outbox_stats()), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+#Background jobs
+@job_handler('create_products')
+def create_products_job(params, progress):
+    created, errors = create_products_from(params['products'], params.get('user_id'), progress)
+    return {'created': [product['id'] for product in created], 'errors': errors}
+
+@job_handler('create_users')
+def create_users_job(params, progress):
+    created, errors = create_users_from(params['users'], progress)
+    return {'created': [user['id'] for user in created], 'errors': errors}
+
+def check_export_params(params):
+    """Validate export job params before they name a file. Returns (type, format)"""
+    order_type, export_format = params.get('type'), params.get('format', 'csv')
+    if order_type not in EXPORTS:
+        raise ValueError(f"Invalid export type: {order_type}")
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Invalid export format: {export_format}")
+    return order_type, export_format
+
+@job_handler('export_orders')
+def export_orders_job(params, progress):
+    order_type, export_format = check_export_params(params)
+    since = datetime.fromisoformat(params['since']) if params.get('since') else None
+    until = datetime.fromisoformat(params['until']) if params.get('until') else None
+    directory = current_app.config.get('EXPORT_DIRECTORY', 'exports')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.abspath(os.path.join(directory, f'{order_type}s-{uuid.uuid4().hex}.{export_format}'))
+    try:
+        with open(path, 'wb') as out:
+            if export_format == 'csv' and db.engine.dialect.name == 'postgresql':
+                copy_csv(order_type, out, since, until)
+            else:
+                for piece in export_orders(order_type, export_format, since, until):
+                    out.write(piece.encode() if isinstance(piece, str) else piece)
+    except Exception:
+        # Leave no partial file behind
+        os.remove(path)
+        raise
+    return {'file': path, 'bytes': os.path.getsize(path), 'mimetype': EXPORT_FORMATS[export_format]}
+
+@job_handler('import_catalog')
+def import_catalog_job(params, progress):
+    from product.catalog_import import read_feed, import_catalog
+    counts, errors = import_catalog(read_feed(params['path'], params.get('format')), user_id=params.get('user_id'))
+    return {'counts': counts, 'errors': errors[:100]}
+
+@job_handler('create_partitions')
+def create_partitions_job(params, progress):
+    from orders.partitions import ensure_partitions
+    return {'created': ensure_partitions(params.get('months_ahead', 3))}
+
+@api.route('/jobs', methods=['POST'])
+@admin_required
+def create_job(current_user):
+    """
+    Queue a long-running admin operation. Admin only.
+
+    Poll GET /jobs/<job_id> for progress; a `flask run-jobs` process does the work.
+
+    Method: POST
+    URL: http://localhost:5000/jobs
+    Headers:
+        Authorization: Bearer <token>
+        Content-Type: application/json
+
+    Request Body:
+    {
+        "type": string,      # create_products, create_users, export_orders,
+                             # import_catalog or create_partitions
+        "params": object     # create_products: {"products": [...]} as for POST /products
+                             # create_users: {"users": [...]} as for POST /users
+                             # export_orders: {"type", "format", "since", "until"} as for GET /orders/export
+                             # import_catalog: {"path", "format"}
+                             # create_partitions: {"months_ahead"}
+    }
+
+    Returns:
+    202: {
+        "job_id": int,
+        "status": "queued",
+        "status_url": string
+    }
+    400: {"error": "Invalid job type: <type>"}
+    400: {"error": "Invalid export type: <type>"}
+    """
+    try:
+        data = request.get_json() or {}
+        params = dict(data.get('params') or {})
+        if data.get('type') in ('create_products', 'import_catalog'):
+            params['user_id'] = current_user.id
+        if data.get('type') == 'export_orders':
+            check_export_params(params)
+        job = enqueue(data.get('type'), params, created_by=current_user.id)
+        response = jsonify({'job_id': job.id, 'status': job.status, 'status_url': f'/jobs/{job.id}'})
+        response.headers['Location'] = f'/jobs/{job.id}'
+        return response, 202
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/jobs', methods=['GET'])
+@admin_required
+def get_jobs(current_user):
+    """
+    List recent jobs, newest first. Admin only.
+
+    Method: GET
+    URL: http://localhost:5000/jobs
+    Headers:
+        Authorization: Bearer <token>
+
+    Query Parameters:
+        status: string    # Optional - queued, running, succeeded or failed
+        page: int         # Optional - default 1
+        per_page: int     # Optional - default 20, max 100
+
+    Returns:
+    200: {
+        "jobs": [object],     # As returned by GET /jobs/<job_id>
+        "page": int,
+        "per_page": int
+    }
+    """
+    try:
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+        query = Job.query
+        if request.args.get('status'):
+            query = query.filter_by(status=request.args['status'])
+        jobs = query.order_by(Job.id.desc()).limit(per_page).offset((page - 1) * per_page).all()
+        return jsonify({'jobs': [job.to_dict() for job in jobs], 'page': page, 'per_page': per_page}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/jobs/<int:job_id>', methods=['GET'])
+@admin_required
+def get_job(current_user, job_id):
+    """
+    Get a job's status, progress and result. Admin only.
+
+    Method: GET
+    URL: http://localhost:5000/jobs/<job_id>
+    Headers:
+        Authorization: Bearer <token>
+
+    Returns:
+    200: {
+        "id": int,
+        "type": string,
+        "status": string,        # queued, running, succeeded or failed
+        "progress": float,       # 0 to 1
+        "message": string,
+        "result": object,        # Once succeeded
+        "error": string,         # Once failed
+        "created_at": string,
+        "started_at": string,
+        "finished_at": string
+    }
+    404: {"error": "Job not found"}
+    """
+    # Progress is written by the runner outside this session; always read it fresh
+    db.session.expire_all()
+    job = Job.query.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict()), 200
+
+@api.route('/jobs/<int:job_id>/download', methods=['GET'])
+@admin_required
+def download_job_result(current_user, job_id):
+    """
+    Download the file an export job produced. Admin only.
+
+    Method: GET
+    URL: http://localhost:5000/jobs/<job_id>/download
+    Headers:
+        Authorization: Bearer <token>
+
+    Returns:
+    200: the exported file
+    404: {"error": "Job has no file"}
+    """
+    job = Job.query.get(job_id)
+    result = job.to_dict()['result'] if job else None
+    if not result or not result.get('file') or not os.path.exists(result['file']):
+        return jsonify({'error': 'Job has no file'}), 404
+    return send_file(result['file'], mimetype=result.get('mimetype'), as_attachment=True,
+                     download_name=os.path.basename(result['file']))
+
+@api.cli.command('run-jobs')
+@click.option('--workers', default=4, show_default=True, help='Jobs run at the same time by this process.')
+def run_jobs_command(workers):
+    """Run queued background jobs until interrupted."""
+    print(f"Running jobs with {workers} workers")
+    JobRunner(current_app._get_current_object(), workers=workers).run()
+
+@api.cli.command('enqueue-job')
+@click.argument('job_type', type=click.Choice(job_types()))
+@click.option('--params', default='{}', help='Job parameters as JSON.')
+def enqueue_job_command(job_type, params):
+    """Queue a background job, e.g. create_partitions from cron."""
+    job = enqueue(job_type, json.loads(params))
+    print(f"Queued job {job.id}")
+
+#Readiness probe
+@api.route('/health/ready', methods=['GET'])
+def readiness():
+    """
+    Report whether this worker should receive traffic. Does not touch the database.
+
+    Method: GET
+    URL: http://localhost:5000/health/ready
+
+    Returns:
+    200: {"status": "ready"}
+    503: {"status": "draining"}    # Shutting down, finishing in-flight requests
+    """
+    if current_app.extensions['lifecycle'].ready:
+        return jsonify({'status': 'ready'}), 200
+    return jsonify({'status': 'draining'}), 503
+
+@api.cli.command('startup-report')
+@click.option('--limit', default=15, help='Number of imports to list.')
+@click.option('--first-party', is_flag=True, help="Only list this project's own modules.")
+def startup_report_command(limit, first_party):
+    """Show startup step timings and the slowest imports of a cold start."""
+    from utils.startup import import_times
+    print(startup.report())
+    print()
+    print(f"{'module':<45} {'self':>10} {'cumulative':>12}")
+    for module, self_us, cumulative_us in import_times('main', limit, first_party_only=first_party):
+        print(f"{module:<45} {self_us / 1000:8.1f}ms {cumulative_us / 1000:10.1f}ms")
+
+def create_app(config=None):
+    """Build the app. Does not connect to the database."""
+    app = Flask(__name__)
+    # Get secret key from environment variable
+    app.config['SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
+
+    # Initialize database
+    with startup.step('init_db'):
+        init_db(app)
+    if config:
+        app.config.update(config)
+
+    with startup.step('register routes'):
+        Lifecycle().init_app(app)
+        app.register_blueprint(api)
+
+    if os.getenv('STARTUP_TIMINGS'):
+        print(startup.report())
+    return app
+
+startup.mark('import main')
+app = create_app()
+
 if __name__ == '__main__':
+    verify_schema(app)
     app.run(debug=True)
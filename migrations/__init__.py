@@ -0,0 +1,186 @@
+"""Versioned schema migrations.
+
+Each module in ``migrations/versions`` is named ``NNNN_description.py`` and
+defines ``revision`` (int), ``description`` and ``upgrade(op)``. Scripts run
+in revision order outside of a wrapping transaction, so that PostgreSQL
+``CREATE INDEX CONCURRENTLY`` and batched backfills can commit as they go.
+Every step must therefore be safe to re-run (use the ``IF NOT EXISTS`` style
+helpers on ``Operations``); the applied revision is recorded only after the
+whole script succeeds.
+"""
+from datetime import datetime
+import importlib
+import pkgutil
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData, inspect, text
+from sqlalchemy.schema import CreateIndex
+from utils.logger import logger
+
+VERSION_TABLE = 'schema_version'
+
+_version_metadata = MetaData()
+schema_version = Table(
+    VERSION_TABLE, _version_metadata,
+    Column('revision', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow)
+)
+
+
+class SchemaVersionError(Exception):
+    pass
+
+
+class Operations:
+    """Lock-light DDL helpers handed to each migration's ``upgrade(op)``"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+
+    def execute(self, sql, params=None):
+        with self.engine.begin() as connection:
+            return connection.execute(text(sql), params or {})
+
+    def has_table(self, table):
+        return inspect(self.engine).has_table(table)
+
+    def has_column(self, table, column):
+        return column in {c['name'] for c in inspect(self.engine).get_columns(table)}
+
+    def has_index(self, table, name):
+        """True if ``table`` has an index or unique constraint called ``name``"""
+        inspector = inspect(self.engine)
+        names = {index['name'] for index in inspector.get_indexes(table)}
+        names.update(constraint['name'] for constraint in inspector.get_unique_constraints(table))
+        return name in names
+
+    def create_tables(self, metadata):
+        """Create tables from ``metadata`` that do not exist yet"""
+        metadata.create_all(self.engine, checkfirst=True)
+
+    def add_column(self, table, column, ddl):
+        """ADD COLUMN if missing. On PostgreSQL 11+ a constant DEFAULT is metadata-only"""
+        if not self.has_column(table, column):
+            self.execute(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}')
+
+    def create_index(self, index):
+        """Create a SQLAlchemy Index if missing, without blocking writes on PostgreSQL"""
+        if self.has_index(index.table.name, index.name):
+            return False
+        self._create_index(str(CreateIndex(index).compile(dialect=self.engine.dialect)))
+        logger.info(f"Created index {index.name}")
+        return True
+
+    def create_unique_index(self, name, table, columns):
+        """Create a unique index on ``columns`` if no index or constraint has that name"""
+        if self.has_index(table, name):
+            return False
+        self._create_index(f'CREATE UNIQUE INDEX {name} ON {table} ({", ".join(columns)})')
+        logger.info(f"Created index {name}")
+        return True
+
+    def _create_index(self, ddl):
+        if self.dialect == 'postgresql':
+            # CONCURRENTLY cannot run inside a transaction block
+            ddl = ddl.replace('INDEX', 'INDEX CONCURRENTLY IF NOT EXISTS', 1)
+            with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                connection.execute(text(ddl))
+        else:
+            self.execute(ddl.replace('INDEX', 'INDEX IF NOT EXISTS', 1))
+
+    def backfill(self, table, assignments, where, batch_size=5000, params=None):
+        """Run ``UPDATE table SET assignments WHERE where`` in batches of ``batch_size`` rows.
+
+        ``where`` must stop matching rows once they are updated, otherwise the
+        loop never ends. Each batch commits on its own so row locks are short.
+        Returns the number of rows updated.
+        """
+        total = 0
+        while True:
+            result = self.execute(
+                f'UPDATE {table} SET {assignments} WHERE id IN '
+                f'(SELECT id FROM {table} WHERE {where} LIMIT {int(batch_size)})',
+                params
+            )
+            if not result.rowcount:
+                return total
+            total += result.rowcount
+
+
+def model_metadata():
+    """Import every model module and return the metadata they register on"""
+    import user
+    import product
+    import product.inventory
+    import product.changes
+    import orders
+    import orders.cart
+    import utils.idempotency
+    import utils.outbox
+    import utils.jobs
+    from db import db
+    return db.metadata
+
+
+def load_migrations():
+    """Import every migration script, ordered by revision"""
+    from migrations import versions
+    modules = [
+        importlib.import_module(f'migrations.versions.{name}')
+        for _, name, _ in pkgutil.iter_modules(versions.__path__)
+    ]
+    modules.sort(key=lambda module: module.revision)
+    revisions = [module.revision for module in modules]
+    if len(set(revisions)) != len(revisions):
+        raise SchemaVersionError(f"Duplicate migration revisions: {revisions}")
+    return modules
+
+
+def latest_revision():
+    migrations = load_migrations()
+    return migrations[-1].revision if migrations else 0
+
+
+def current_revision(engine):
+    """Get the newest applied revision, 0 for an unversioned database"""
+    if not inspect(engine).has_table(VERSION_TABLE):
+        return 0
+    with engine.connect() as connection:
+        revision = connection.execute(
+            text(f'SELECT MAX(revision) FROM {VERSION_TABLE}')
+        ).scalar()
+    return revision or 0
+
+
+def upgrade(engine, target=None):
+    """Apply pending migrations up to ``target`` (default: latest). Returns applied revisions"""
+    _version_metadata.create_all(engine, checkfirst=True)
+    current = current_revision(engine)
+    op = Operations(engine)
+
+    applied = []
+    for migration in load_migrations():
+        if migration.revision <= current or (target is not None and migration.revision > target):
+            continue
+        logger.info(f"Applying migration {migration.revision}: {migration.description}")
+        migration.upgrade(op)
+        with engine.begin() as connection:
+            connection.execute(schema_version.insert().values(
+                revision=migration.revision,
+                description=migration.description,
+                applied_at=datetime.utcnow()
+            ))
+        applied.append(migration.revision)
+    return applied
+
+
+def verify(engine):
+    """Raise SchemaVersionError unless the database is at the latest revision. Issues no DDL"""
+    current = current_revision(engine)
+    latest = latest_revision()
+    if current != latest:
+        raise SchemaVersionError(
+            f"Database schema is at revision {current}, code expects {latest}. "
+            f"Run 'flask db-upgrade'."
+        )
+    return current
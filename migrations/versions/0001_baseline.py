@@ -0,0 +1,144 @@
+"""Create the tables the application had before versioned migrations.
+
+The definitions are frozen here as they stood at this revision; later
+columns and indexes are added by the scripts that introduced them. On a
+fresh database this builds that schema, on a database that predates
+migrations it only adds the tables that are missing (the idempotency keys
+and the inventory ledger) and the later scripts evolve the rest.
+"""
+from sqlalchemy import (
+    Table, Column, MetaData, ForeignKey, UniqueConstraint,
+    DateTime, Float, Integer, String, Text
+)
+
+revision = 1
+description = 'Baseline schema'
+
+metadata = MetaData()
+
+Table(
+    'users', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('username', String(80), unique=True, nullable=False),
+    Column('email', String(120), unique=True, nullable=False),
+    Column('password_hash', String(500), nullable=False),
+    Column('type', String(50))
+)
+Table(
+    'administrators', metadata,
+    Column('id', Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+)
+Table(
+    'customers', metadata,
+    Column('id', Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+)
+Table(
+    'products', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('description', String(500)),
+    Column('price', Float, nullable=False),
+    Column('type', String(50))
+)
+Table(
+    'physical_products', metadata,
+    Column('id', Integer, ForeignKey('products.id'), primary_key=True),
+    Column('weight', Float),
+    Column('stock', Integer)
+)
+Table(
+    'digital_products', metadata,
+    Column('id', Integer, ForeignKey('products.id'), primary_key=True),
+    Column('file_size', Float),
+    Column('download_link', String(500))
+)
+Table(
+    'cart_items', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('product_id', Integer, ForeignKey('products.id'), nullable=False),
+    Column('quantity', Integer, nullable=False),
+    Column('total_price', Float, nullable=False),
+    Column('status', String(20), nullable=False),
+    Column('created_at', DateTime)
+)
+Table(
+    'purchases', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('product_id', Integer, ForeignKey('products.id'), nullable=False),
+    Column('quantity', Integer, nullable=False),
+    Column('total_price', Float, nullable=False),
+    Column('status', String(20), nullable=False),
+    Column('created_at', DateTime)
+)
+Table(
+    'orders', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id')),
+    Column('product_id', Integer, ForeignKey('products.id'), nullable=False),
+    Column('date', DateTime, nullable=False),
+    Column('status', String(50)),
+    Column('type', String(50)),
+    Column('quantity', Integer),
+    Column('total_price', Float)
+)
+Table(
+    'returns', metadata,
+    Column('id', Integer, ForeignKey('orders.id'), primary_key=True),
+    Column('reason', String(500)),
+    Column('refund_amount', Float),
+    Column('customer_email', String(100), nullable=False),
+    Column('customer_name', String(100), nullable=False),
+    Column('purchase_date', DateTime, nullable=False),
+    Column('original_purchase_id', Integer, ForeignKey('purchases.id'), nullable=False),
+    Column('admin_notes', String(500)),
+    Column('approved_by', Integer, ForeignKey('users.id')),
+    Column('approved_at', DateTime),
+    Column('rejected_by', Integer, ForeignKey('users.id')),
+    Column('rejected_at', DateTime)
+)
+Table(
+    'exchanges', metadata,
+    Column('id', Integer, ForeignKey('orders.id'), primary_key=True),
+    Column('new_product_id', Integer, ForeignKey('products.id')),
+    Column('reason', String(500)),
+    Column('customer_email', String(100), nullable=False),
+    Column('customer_name', String(100), nullable=False),
+    Column('purchase_date', DateTime, nullable=False),
+    Column('original_purchase_id', Integer, ForeignKey('purchases.id'), nullable=False),
+    Column('admin_notes', String(500)),
+    Column('approved_by', Integer, ForeignKey('users.id')),
+    Column('approved_at', DateTime),
+    Column('rejected_by', Integer, ForeignKey('users.id')),
+    Column('rejected_at', DateTime)
+)
+Table(
+    'idempotency_keys', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('key', String(255), nullable=False),
+    Column('user_id', Integer),
+    Column('route', String(200), nullable=False),
+    Column('state', String(20), nullable=False),
+    Column('status_code', Integer),
+    Column('response_body', Text),
+    Column('created_at', DateTime),
+    Column('expires_at', DateTime, nullable=False),
+    UniqueConstraint('key', 'user_id', 'route', name='uq_idempotency_key_user_route')
+)
+Table(
+    'inventory_movements', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('product_id', Integer, ForeignKey('products.id', ondelete='CASCADE'), nullable=False),
+    Column('quantity', Integer, nullable=False),
+    Column('reason', String(20), nullable=False),
+    Column('reference_id', Integer),
+    Column('user_id', Integer),
+    Column('created_at', DateTime, nullable=False)
+)
+
+
+def upgrade(op):
+    if op.dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp"')
+    op.create_tables(metadata)
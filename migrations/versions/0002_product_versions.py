@@ -0,0 +1,9 @@
+"""Add products.version_id for optimistic concurrency control."""
+
+revision = 2
+description = 'Product row versions'
+
+
+def upgrade(op):
+    # A constant default makes this metadata-only on PostgreSQL 11+, no table rewrite
+    op.add_column('products', 'version_id', 'INTEGER NOT NULL DEFAULT 1')
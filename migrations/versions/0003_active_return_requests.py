@@ -0,0 +1,35 @@
+"""Allow at most one open return/exchange request per purchase.
+
+Adds the active_request flag, backfills it in batches from the pending
+status, closes duplicate open requests (keeping the oldest) and builds the
+unique index without blocking writes.
+"""
+revision = 3
+description = 'Unique active return/exchange requests'
+
+
+def upgrade(op):
+    for table in ('returns', 'exchanges'):
+        op.add_column(table, 'active_request', 'BOOLEAN')
+        op.backfill(
+            table,
+            'active_request = TRUE',
+            "active_request IS NULL AND id IN "
+            "(SELECT id FROM orders WHERE status = 'pending_approval')"
+        )
+
+        duplicates = (
+            f"SELECT newer.id FROM {table} newer JOIN {table} older "
+            f"ON older.original_purchase_id = newer.original_purchase_id "
+            f"AND older.active_request IS TRUE AND older.id < newer.id "
+            f"WHERE newer.active_request IS TRUE"
+        )
+        op.execute(f"UPDATE orders SET status = 'rejected' WHERE id IN ({duplicates})")
+        op.execute(
+            f"UPDATE {table} SET active_request = NULL, "
+            f"admin_notes = 'Closed as duplicate request' WHERE id IN ({duplicates})"
+        )
+
+        op.create_unique_index(
+            f'uq_{table}_active_purchase', table, ['original_purchase_id', 'active_request']
+        )
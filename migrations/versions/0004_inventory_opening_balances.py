@@ -0,0 +1,13 @@
+"""Seed the inventory ledger with each physical product's current stock."""
+
+revision = 4
+description = 'Inventory ledger opening balances'
+
+
+def upgrade(op):
+    op.execute(
+        "INSERT INTO inventory_movements (product_id, quantity, reason, created_at) "
+        "SELECT p.id, p.stock, 'adjust', CURRENT_TIMESTAMP FROM physical_products p "
+        "WHERE p.stock <> 0 AND NOT EXISTS "
+        "(SELECT 1 FROM inventory_movements m WHERE m.product_id = p.id)"
+    )
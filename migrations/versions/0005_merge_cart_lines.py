@@ -0,0 +1,46 @@
+"""Merge duplicate in-cart lines, then add the unique (user_id, product_id) index."""
+from sqlalchemy import Table, Column, MetaData, Index, Integer, String, text
+
+revision = 5
+description = 'Unique in-cart lines'
+
+IN_CART = text("status = 'in_cart'")
+
+metadata = MetaData()
+cart_items = Table(
+    'cart_items', metadata,
+    Column('user_id', Integer),
+    Column('product_id', Integer),
+    Column('status', String(20))
+)
+unique_in_cart = Index(
+    'uq_cart_items_user_product_in_cart', cart_items.c.user_id, cart_items.c.product_id,
+    unique=True,
+    postgresql_where=IN_CART,
+    sqlite_where=IN_CART
+)
+
+# Keep the oldest line per (user_id, product_id) with the summed quantity and price
+SAME_LINE = (
+    "FROM cart_items siblings WHERE siblings.user_id = cart_items.user_id "
+    "AND siblings.product_id = cart_items.product_id AND siblings.status = 'in_cart'"
+)
+MERGE = (
+    f"UPDATE cart_items SET "
+    f"quantity = (SELECT SUM(siblings.quantity) {SAME_LINE}), "
+    f"total_price = (SELECT SUM(siblings.total_price) {SAME_LINE}) "
+    f"WHERE status = 'in_cart' AND id IN ("
+    f"SELECT MIN(id) FROM cart_items WHERE status = 'in_cart' "
+    f"GROUP BY user_id, product_id HAVING COUNT(*) > 1)"
+)
+REMOVE = (
+    "DELETE FROM cart_items WHERE status = 'in_cart' AND id NOT IN ("
+    "SELECT MIN(id) FROM cart_items WHERE status = 'in_cart' GROUP BY user_id, product_id)"
+)
+
+
+def upgrade(op):
+    with op.engine.begin() as connection:
+        connection.execute(text(MERGE))
+        connection.execute(text(REMOVE))
+    op.create_index(unique_in_cart)
@@ -0,0 +1,40 @@
+"""Build the indexes for the hot query predicates, concurrently on PostgreSQL."""
+from sqlalchemy import Table, Column, MetaData, Index, DateTime, Integer, String
+
+revision = 6
+description = 'Indexes for hot query predicates'
+
+# Only the indexed columns; the tables themselves come from revision 1
+metadata = MetaData()
+cart_items = Table(
+    'cart_items', metadata,
+    Column('user_id', Integer), Column('status', String(20)), Column('created_at', DateTime)
+)
+inventory_movements = Table(
+    'inventory_movements', metadata,
+    Column('id', Integer), Column('product_id', Integer)
+)
+orders = Table(
+    'orders', metadata,
+    Column('type', String(50)), Column('status', String(50)), Column('date', DateTime)
+)
+products = Table('products', metadata, Column('type', String(50)))
+purchases = Table(
+    'purchases', metadata,
+    Column('user_id', Integer), Column('product_id', Integer), Column('created_at', DateTime)
+)
+
+INDEXES = (
+    Index('ix_cart_items_status_created_at', cart_items.c.status, cart_items.c.created_at),
+    Index('ix_cart_items_user_id_status', cart_items.c.user_id, cart_items.c.status),
+    Index('ix_inventory_movements_product_id', inventory_movements.c.product_id, inventory_movements.c.id),
+    Index('ix_orders_type_status_date', orders.c.type, orders.c.status, orders.c.date),
+    Index('ix_products_type', products.c.type),
+    Index('ix_purchases_product_id', purchases.c.product_id),
+    Index('ix_purchases_user_id_created_at', purchases.c.user_id, purchases.c.created_at),
+)
+
+
+def upgrade(op):
+    for index in INDEXES:
+        op.create_index(index)
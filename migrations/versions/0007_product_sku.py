@@ -0,0 +1,10 @@
+"""Add products.sku, the external key catalog imports match on."""
+
+revision = 7
+description = 'Product SKUs'
+
+
+def upgrade(op):
+    op.add_column('products', 'sku', 'VARCHAR(64)')
+    # NULLs do not collide, so products created without a SKU are unaffected
+    op.create_unique_index('uq_products_sku', 'products', ['sku'])
@@ -0,0 +1,108 @@
+"""Group purchases under order headers, one per checkout.
+
+Existing purchases are backfilled into headers: a user's purchases created
+within a second of each other came from the same checkout. The backfill
+walks the users in id order, ``BATCH_USERS`` at a time, and commits each
+batch, so memory and lock time stay bounded on a large purchases table and
+an interrupted run resumes where it stopped.
+"""
+from datetime import timedelta
+from sqlalchemy import (
+    Table, Column, MetaData, ForeignKey, Index, DateTime, Float, Integer, String, select, text
+)
+
+revision = 8
+description = 'Order headers'
+
+CHECKOUT_WINDOW = timedelta(seconds=1)
+BATCH_USERS = 500
+
+metadata = MetaData()
+# Referenced only; created by revision 1
+Table('users', metadata, Column('id', Integer, primary_key=True))
+order_headers = Table(
+    'order_headers', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('status', String(20), nullable=False),
+    Column('item_count', Integer, nullable=False),
+    Column('total_price', Float, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Index('ix_order_headers_user_id_created_at', 'user_id', 'created_at')
+)
+# The columns the backfill reads; the table comes from revision 1
+purchases = Table(
+    'purchases', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer),
+    Column('quantity', Integer),
+    Column('total_price', Float),
+    Column('created_at', DateTime),
+    Column('order_header_id', Integer),
+    Index('ix_purchases_order_header_id', 'order_header_id')
+)
+
+
+def _checkouts(rows):
+    """Split (id, user_id, quantity, total_price, created_at) rows into checkouts"""
+    group = []
+    for row in rows:
+        if group and (row.user_id != group[-1].user_id
+                      or row.created_at - group[-1].created_at > CHECKOUT_WINDOW):
+            yield group
+            group = []
+        group.append(row)
+    if group:
+        yield group
+
+
+def _backfill_batch(op, connection, after_user_id):
+    """Add headers for the next BATCH_USERS users' purchases. Returns the last user id, None when done"""
+    pending = (purchases.c.order_header_id.is_(None), purchases.c.created_at.isnot(None))
+    users = select(purchases.c.user_id).where(*pending).distinct()
+    if after_user_id is not None:
+        users = users.where(purchases.c.user_id > after_user_id)
+    user_ids = connection.execute(
+        users.order_by(purchases.c.user_id).limit(BATCH_USERS)
+    ).scalars().all()
+    if not user_ids:
+        return None
+
+    rows = connection.execute(
+        select(purchases.c.id, purchases.c.user_id, purchases.c.quantity,
+               purchases.c.total_price, purchases.c.created_at)
+        .where(*pending, purchases.c.user_id.between(user_ids[0], user_ids[-1]))
+        .order_by(purchases.c.user_id, purchases.c.created_at, purchases.c.id)
+    ).fetchall()
+    for group in _checkouts(rows):
+        header_id = connection.execute(text(
+            "INSERT INTO order_headers (user_id, status, item_count, total_price, created_at) "
+            "VALUES (:user_id, 'completed', :item_count, :total_price, :created_at)"
+            + (" RETURNING id" if op.dialect == 'postgresql' else "")
+        ), {
+            'user_id': group[0].user_id,
+            'item_count': sum(row.quantity for row in group),
+            'total_price': sum(row.total_price for row in group),
+            'created_at': group[0].created_at
+        })
+        header_id = header_id.scalar() if op.dialect == 'postgresql' else header_id.lastrowid
+        connection.execute(
+            text("UPDATE purchases SET order_header_id = :header_id WHERE id = :id"),
+            [{'header_id': header_id, 'id': row.id} for row in group]
+        )
+    return user_ids[-1]
+
+
+def upgrade(op):
+    op.create_tables(metadata)
+    op.add_column('purchases', 'order_header_id', 'INTEGER REFERENCES order_headers (id)')
+
+    last_user_id = None
+    while True:
+        with op.engine.begin() as connection:
+            last_user_id = _backfill_batch(op, connection, last_user_id)
+        if last_user_id is None:
+            break
+
+    for index in (*purchases.indexes, *order_headers.indexes):
+        op.create_index(index)
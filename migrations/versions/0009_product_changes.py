@@ -0,0 +1,29 @@
+"""Add the product change log behind GET /products/changes.
+
+Every existing product gets an insert entry, so a client syncing from
+seq 0 receives the whole catalog.
+"""
+from sqlalchemy import Table, Column, MetaData, Index, DateTime, Integer, String
+
+revision = 9
+description = 'Product change log'
+
+metadata = MetaData()
+Table(
+    'product_changes', metadata,
+    Column('seq', Integer, primary_key=True),
+    Column('product_id', Integer, nullable=False),
+    Column('operation', String(10), nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Index('ix_product_changes_product_id', 'product_id', 'seq')
+)
+
+
+def upgrade(op):
+    op.create_tables(metadata)
+    op.execute(
+        "INSERT INTO product_changes (product_id, operation, created_at) "
+        "SELECT id, 'insert', CURRENT_TIMESTAMP FROM products "
+        "WHERE NOT EXISTS (SELECT 1 FROM product_changes c WHERE c.product_id = products.id) "
+        "ORDER BY id"
+    )
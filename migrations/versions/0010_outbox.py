@@ -0,0 +1,24 @@
+"""Add the outbox for order and stock events."""
+from sqlalchemy import Table, Column, MetaData, Index, DateTime, Integer, String, Text
+
+revision = 10
+description = 'Event outbox'
+
+metadata = MetaData()
+Table(
+    'outbox_events', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('event_type', String(50), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('status', String(20), nullable=False),
+    Column('attempts', Integer, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Column('available_at', DateTime, nullable=False),
+    Column('delivered_at', DateTime),
+    Column('last_error', String(500)),
+    Index('ix_outbox_events_status_available_at', 'status', 'available_at', 'id')
+)
+
+
+def upgrade(op):
+    op.create_tables(metadata)
@@ -0,0 +1,29 @@
+"""Add the background job queue."""
+from sqlalchemy import Table, Column, MetaData, Index, DateTime, Float, Integer, String, Text
+
+revision = 11
+description = 'Job queue'
+
+metadata = MetaData()
+Table(
+    'jobs', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('job_type', String(50), nullable=False),
+    Column('params', Text, nullable=False),
+    Column('status', String(20), nullable=False),
+    Column('progress', Float, nullable=False),
+    Column('message', String(500)),
+    Column('result', Text),
+    Column('error', String(500)),
+    Column('created_by', Integer),
+    Column('worker', String(100)),
+    Column('created_at', DateTime, nullable=False),
+    Column('started_at', DateTime),
+    Column('finished_at', DateTime),
+    Column('heartbeat_at', DateTime),
+    Index('ix_jobs_status_id', 'status', 'id')
+)
+
+
+def upgrade(op):
+    op.create_tables(metadata)
@@ -2,6 +2,7 @@ from orders.order import Order
 from orders.purchase import Purchase
 from orders.return_order import Return
 from orders.exchange import Exchange
+from orders.order_header import OrderHeader
 from orders.factory import OrderFactory
 
-__all__ = ['Order', 'Purchase', 'Return', 'Exchange', 'OrderFactory'] 
\ No newline at end of file
+__all__ = ['Order', 'Purchase', 'Return', 'Exchange', 'OrderHeader', 'OrderFactory'] 
\ No newline at end of file
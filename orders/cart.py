@@ -1,11 +1,89 @@
 from orders.order import Order
-from orders.purchase import Purchase
+from orders.order_header import OrderHeader
 from db import db
-from datetime import datetime
+from datetime import datetime, timedelta
+from threading import Lock
+import time
+from flask import current_app
+from sqlalchemy import text
+from product.product import Product
 from product.physical import PhysicalProduct
 from product.digital import DigitalProduct
+from product.events import on_products_changed
 from utils.logger import logger, cart_logger
 
+
+class CartSummaryCache:
+    """Per-user cache of GET /cart summaries.
+
+    Entries are dropped when the user's cart changes and whenever any
+    product changes (prices and stock feed into every summary). The TTL
+    comes from CART_SUMMARY_CACHE_TTL and defaults to 0 (disabled), since
+    entries are per process and a write through another worker would not
+    drop them.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            return None
+
+    def set(self, user_id, summary, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + ttl, summary)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cart_summary_cache = CartSummaryCache()
+
+
+@on_products_changed
+def _invalidate_cart_summaries(product_ids):
+    cart_summary_cache.clear()
+
+
+# Predicate of the partial unique index; spelled as literal SQL so PostgreSQL
+# can match it when inferring the ON CONFLICT target
+IN_CART = text("status = 'in_cart'")
+
+
+def _is_int(value):
+    # bool is an int subclass, but true is not a quantity or an id
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def bulk_product_ids(items):
+    """The integer product ids named by bulk cart items"""
+    return {
+        item.get('product_id') for item in items
+        if isinstance(item, dict) and _is_int(item.get('product_id'))
+    }
+
+
+def _stock_status(product_type, stock, quantity):
+    if product_type != 'physical':
+        return 'digital'
+    if not stock:
+        return 'out_of_stock'
+    if stock < quantity:
+        return 'insufficient_stock'
+    return 'in_stock'
+
 class Cart(db.Model):
     __tablename__ = 'cart_items'
     
@@ -17,6 +95,20 @@ class Cart(db.Model):
     status = db.Column(db.String(20), nullable=False, default='in_cart')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # At most one active line per product; add-to-cart upserts against it
+    __table_args__ = (
+        db.Index(
+            'uq_cart_items_user_product_in_cart', 'user_id', 'product_id',
+            unique=True,
+            postgresql_where=IN_CART,
+            sqlite_where=IN_CART
+        ),
+        # Lets the sweeper find completed/abandoned lines without a full scan
+        db.Index('ix_cart_items_status_created_at', 'status', 'created_at'),
+        # Cart reads, checkout and clear: WHERE user_id = ? AND status = ?
+        db.Index('ix_cart_items_user_id_status', 'user_id', 'status'),
+    )
+
     # Relationships
     user = db.relationship('User', backref='cart_items')
     product = db.relationship('Product', backref='cart_items')
@@ -60,59 +152,314 @@ class Cart(db.Model):
         return cls.query.filter_by(user_id=user_id, status='in_cart').all()
 
     @classmethod
-    def add_to_cart(cls, product_id, quantity, user_id):
-        """Add item to cart"""
+    def get_summary(cls, user_id):
+        """Get the user's cart lines with current product info and the cart total.
+
+        Lines, product name/price/stock and the grand total come back from a
+        single query; line and cart totals use the current product price.
+        """
+        ttl = current_app.config.get('CART_SUMMARY_CACHE_TTL', 0)
+        summary = cart_summary_cache.get(user_id)
+        if summary is not None:
+            return summary
+
+        physical = PhysicalProduct.__table__
+        line_total = cls.quantity * Product.price
+        rows = db.session.query(
+            cls.id,
+            cls.product_id,
+            cls.quantity,
+            cls.status,
+            cls.created_at,
+            Product.name,
+            Product.price,
+            Product.type,
+            physical.c.stock,
+            line_total.label('line_total'),
+            db.func.sum(line_total).over().label('cart_total')
+        ).join(
+            Product, Product.id == cls.product_id
+        ).outerjoin(
+            physical, physical.c.id == cls.product_id
+        ).filter(
+            cls.user_id == user_id,
+            cls.status == 'in_cart'
+        ).order_by(cls.id).all()
+
+        summary = {
+            'items': [{
+                'id': row.id,
+                'product_id': row.product_id,
+                'name': row.name,
+                'type': row.type,
+                'quantity': row.quantity,
+                'price': row.price,
+                'total_price': row.line_total,
+                'stock': row.stock,
+                'stock_status': _stock_status(row.type, row.stock, row.quantity),
+                'status': row.status,
+                'created_at': row.created_at.isoformat() if row.created_at else None
+            } for row in rows],
+            'total': rows[0].cart_total if rows else 0
+        }
+        cart_summary_cache.set(user_id, summary, ttl)
+        return summary
+
+    @classmethod
+    def upsert_lines(cls, user_id, lines, replace=False):
+        """Merge (product, quantity) pairs into the user's in-cart lines.
+
+        Issues one INSERT ... ON CONFLICT against the partial unique index on
+        (user_id, product_id): new products get a line, existing lines have
+        the quantity added, or set when ``replace`` is true. Does not commit.
+        """
+        if not lines:
+            return
+        now = datetime.utcnow()
+        rows = [{
+            'user_id': user_id,
+            'product_id': product.id,
+            'quantity': quantity,
+            'total_price': product.price * quantity,
+            'status': 'in_cart',
+            'created_at': now
+        } for product, quantity in lines]
+
+        dialect = db.engine.dialect.name
+        if dialect not in ('postgresql', 'sqlite'):
+            for row in rows:
+                cls._merge_line(row, replace)
+            return
+
+        # Dialect modules are imported here so importing the app stays cheap
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(cls.__table__).values(rows)
+        if replace:
+            set_ = {
+                'quantity': stmt.excluded.quantity,
+                'total_price': stmt.excluded.total_price
+            }
+        else:
+            set_ = {
+                'quantity': cls.__table__.c.quantity + stmt.excluded.quantity,
+                'total_price': cls.__table__.c.total_price + stmt.excluded.total_price
+            }
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'product_id'],
+            index_where=IN_CART,
+            set_=set_
+        )
+        db.session.execute(stmt)
+
+    @classmethod
+    def _merge_line(cls, row, replace=False):
+        """Read-then-write merge for databases without ON CONFLICT"""
+        cart_item = cls.query.filter_by(
+            user_id=row['user_id'],
+            product_id=row['product_id'],
+            status='in_cart'
+        ).first()
+        if cart_item and replace:
+            cart_item.quantity = row['quantity']
+            cart_item.total_price = row['total_price']
+        elif cart_item:
+            cart_item.quantity += row['quantity']
+            cart_item.total_price += row['total_price']
+        else:
+            db.session.add(cls(**row))
+        db.session.flush()
+
+    @classmethod
+    def apply_bulk(cls, user_id, items):
+        """Add, set or remove many cart lines in one transaction.
+
+        ``items`` is a list of {"product_id", "quantity", "action"} where
+        action is "add" (default), "set" or "remove". All products and the
+        current lines are loaded with one IN query each, valid lines are
+        written with a single upsert plus a single DELETE, and everything is
+        committed once. Invalid lines are skipped and reported.
+
+        Returns (results, applied) where results holds one entry per item.
+        """
+        product_ids = bulk_product_ids(items)
+        products = {
+            product.id: product
+            for product in db.session.query(db.with_polymorphic(Product, '*')).filter(
+                Product.id.in_(product_ids)
+            )
+        }
+        quantities = dict(db.session.query(cls.product_id, cls.quantity).filter(
+            cls.user_id == user_id,
+            cls.status == 'in_cart',
+            cls.product_id.in_(product_ids)
+        ).all())
+
+        results, changed = cls.plan_bulk(items, products, quantities)
+
+        upserts = [(products[product_id], quantity)
+                   for product_id, quantity in changed.items() if quantity > 0]
+        removals = [product_id for product_id, quantity in changed.items() if quantity == 0]
+
         try:
-            product = Product.query.get(product_id)
-            if not product:
-                return None, "Product not found"
+            cls.upsert_lines(user_id, upserts, replace=True)
+            if removals:
+                cls.query.filter(
+                    cls.user_id == user_id,
+                    cls.status == 'in_cart',
+                    cls.product_id.in_(removals)
+                ).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cart_summary_cache.invalidate(user_id)
+        return results, len(changed)
 
-            cart_item = cls.query.filter_by(
-                product_id=product_id,
-                user_id=user_id,
-                status='in_cart'
-            ).first()
+    @staticmethod
+    def plan_bulk(items, products, quantities):
+        """Validate bulk cart changes against the products and current line quantities.
+
+        ``products`` maps product id to product and ``quantities`` product id
+        to the current in-cart quantity; ``quantities`` is updated as items
+        apply. Returns (results, changed) where changed maps product id to
+        its new quantity, 0 meaning the line is removed.
+        """
+        results = []
+        changed = {}
+        for item in items:
+            if not isinstance(item, dict):
+                results.append({'status': 'error', 'error': 'Invalid item'})
+                continue
+
+            product_id = item.get('product_id')
+            action = item.get('action', 'add')
+            quantity = item.get('quantity', 1)
+            result = {'product_id': product_id, 'action': action}
+            results.append(result)
 
-            if cart_item:
-                cart_item.quantity += quantity
-                cart_item.total_price = product.price * cart_item.quantity
+            error = None
+            if action not in ('add', 'set', 'remove'):
+                error = 'Invalid action'
+            elif not _is_int(product_id):
+                error = 'Product ID must be an integer'
+            elif product_id not in products:
+                error = 'Product not found'
+            elif action != 'remove' and (not _is_int(quantity) or quantity < 0
+                                         or (action == 'add' and quantity == 0)):
+                error = 'Quantity must be a positive integer'
+            if error:
+                result.update({'status': 'error', 'error': error})
+                continue
+
+            current = quantities.get(product_id, 0)
+            if action == 'remove':
+                new_quantity = 0
+            elif action == 'set':
+                new_quantity = quantity
             else:
-                cart_item = cls(
-                    product_id=product_id,
-                    quantity=quantity,
-                    total_price=product.price * quantity,
-                    user_id=user_id,
-                    status='in_cart'
+                new_quantity = current + quantity
+
+            product = products[product_id]
+            if isinstance(product, PhysicalProduct) and new_quantity > (product.stock or 0):
+                if not product.stock:
+                    message = "Product out of stock"
+                else:
+                    message = f"Only {product.stock} items available"
+                result.update({'status': 'error', 'error': message})
+                continue
+
+            quantities[product_id] = new_quantity
+            changed[product_id] = new_quantity
+            result.update({'status': 'ok', 'quantity': new_quantity})
+
+        return results, changed
+
+    @classmethod
+    def sweep(cls, abandoned_days=30, batch_size=1000):
+        """Purge completed cart lines and lines abandoned for ``abandoned_days``.
+
+        Rows are deleted in batches of ``batch_size``, committing after each
+        batch to keep locks and transactions short. Returns the number of
+        rows reclaimed per category.
+        """
+        cutoff = datetime.utcnow() - timedelta(days=abandoned_days)
+        criteria = {
+            'completed': (cls.status == 'completed',),
+            'abandoned': (cls.status == 'in_cart', cls.created_at < cutoff)
+        }
+
+        reclaimed = {}
+        for category, conditions in criteria.items():
+            reclaimed[category] = 0
+            while True:
+                ids = [row.id for row in db.session.query(cls.id).filter(
+                    *conditions
+                ).order_by(cls.created_at).limit(batch_size)]
+                if not ids:
+                    break
+                reclaimed[category] += cls.query.filter(cls.id.in_(ids)).delete(
+                    synchronize_session=False
                 )
+                db.session.commit()
 
-            # Check stock availability
-            stock_available, message = cart_item.check_stock(product)
-            if not stock_available:
-                return None, message
+        if reclaimed['abandoned']:
+            cart_summary_cache.clear()
+        return reclaimed
 
-            if not cart_item.id:
-                db.session.add(cart_item)
-            db.session.commit()
-            
-            return cart_item, "Item added to cart successfully"
-            
-        except Exception as e:
-            db.session.rollback()
-            return None, str(e)
+    @classmethod
+    def compact_lines(cls):
+        """Merge duplicate in-cart lines left over from before the unique index.
+
+        Keeps the oldest line per (user_id, product_id) with the summed
+        quantity and price, deletes the rest, then creates the unique index.
+        Returns the number of rows removed.
+        """
+        table = cls.__table__
+        in_cart = table.c.status == 'in_cart'
+        duplicates = db.select(db.func.min(table.c.id)).where(in_cart).group_by(
+            table.c.user_id, table.c.product_id
+        ).having(db.func.count() > 1)
+        keepers = db.select(db.func.min(table.c.id)).where(in_cart).group_by(
+            table.c.user_id, table.c.product_id
+        )
+
+        siblings = table.alias('siblings')
+        same_line = db.and_(
+            siblings.c.user_id == table.c.user_id,
+            siblings.c.product_id == table.c.product_id,
+            siblings.c.status == 'in_cart'
+        )
+        db.session.execute(table.update().where(
+            in_cart, table.c.id.in_(duplicates)
+        ).values(
+            quantity=db.select(db.func.sum(siblings.c.quantity)).where(same_line).scalar_subquery(),
+            total_price=db.select(db.func.sum(siblings.c.total_price)).where(same_line).scalar_subquery()
+        ))
+        removed = db.session.execute(table.delete().where(
+            in_cart, table.c.id.notin_(keepers)
+        )).rowcount
+        db.session.commit()
+
+        for index in table.indexes:
+            if index.name == 'uq_cart_items_user_product_in_cart':
+                index.create(db.engine, checkfirst=True)
+        cart_summary_cache.clear()
+        return removed
 
     @classmethod
     def clear_cart(cls, user_id):
         """Clear user's cart"""
         try:
-            cart_items = cls.query.filter_by(
+            cls.query.filter_by(
                 user_id=user_id,
                 status='in_cart'
-            ).all()
-            
-            for item in cart_items:
-                db.session.delete(item)
+            ).delete(synchronize_session=False)
             
             db.session.commit()
+            cart_summary_cache.invalidate(user_id)
             return True, "Cart cleared successfully"
             
         except Exception as e:
@@ -130,27 +477,20 @@ class Cart(db.Model):
                 logger.warning(f"No items in cart for user {user_email}")
                 return None, "No items in cart"
 
-            purchases = []
+            products = {product.id: product for product in Product.query.filter(
+                Product.id.in_({cart_item.product_id for cart_item in cart_items})
+            )}
+
+            # One order header per checkout, with a purchase line per cart item
+            order = OrderHeader.from_cart(user_id, cart_items, products)
+            db.session.add(order)
             for cart_item in cart_items:
-              
-                purchase = Purchase(
-                    user_id=user_id,
-                    product_id=cart_item.product_id,
-                    quantity=cart_item.quantity,
-                    total_price=cart_item.total_price,
-                    customer_email=user_email,
-                    customer_name=user_name
-                )
-                
-                # Process the purchase
-                purchase.process()
-                db.session.add(purchase)
-                
                 # Mark cart item as completed
                 cart_item.status = 'completed'
-                purchases.append(purchase)
+            purchases = order.lines
             
             db.session.commit()
+            cart_summary_cache.invalidate(user_id)
             cart_logger.info(
                 f"Purchase completed for user {user_email}. "
                 f"Total items: {len(purchases)}. "
@@ -0,0 +1,497 @@
+"""Where in-progress carts are kept.
+
+With CART_BACKEND=database (the default) every cart change is written to
+cart_items and committed. With CART_BACKEND=write_behind cart lines live
+in a key-value store while the user browses and reach cart_items only at
+checkout or when the flusher writes out changed carts, every
+CART_FLUSH_INTERVAL seconds in the web process or from ``flask
+flush-carts``. CART_KV_URL chooses the key-value store: empty for the
+in-process stand-in (a single process, and carts that have not been
+flushed are lost when it exits), or a redis:// URL shared by every worker.
+
+A cart the key-value store does not hold, because it was saved before
+the switch, expired, or lived in a process that restarted, is loaded from
+cart_items the first time it is used. A flush writes a cart's whole state
+under a lock on its user row and only marks the cart clean once that
+commit succeeded and nobody changed the cart in between, so a flush that
+fails or dies half way is simply redone.
+"""
+from copy import deepcopy
+from datetime import datetime
+from threading import Event, Lock, Thread
+import json
+from flask import current_app
+from sqlalchemy.orm import Session
+from db import db
+from orders.cart import Cart, bulk_product_ids, cart_summary_cache, _stock_status
+from product.product import Product
+from product.physical import PhysicalProduct
+from user import User
+from utils.logger import logger
+
+try:
+    import redis
+except ImportError:  # Only needed for a shared CART_KV_URL
+    redis = None
+
+
+class LocalCartKV:
+    """In-process stand-in for a shared cart store, for tests and development"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._carts = {}
+        self._dirty = set()
+
+    def get(self, user_id):
+        """The cart's (version, lines), or None if it is not held here.
+
+        Lines map str(product id) to a line dict.
+        """
+        with self._lock:
+            cart = self._carts.get(user_id)
+            return (cart[0], deepcopy(cart[1])) if cart is not None else None
+
+    def seed(self, user_id, lines):
+        """Hold ``lines``, loaded from cart_items, unless the cart is already held"""
+        with self._lock:
+            self._carts.setdefault(user_id, (0, deepcopy(lines)))
+
+    def update(self, user_id, func):
+        """Apply ``func(lines)`` atomically and return its result.
+
+        ``func`` edits the lines in place. If it changed them the cart gets a
+        new version and is marked dirty.
+        """
+        with self._lock:
+            version, lines = self._carts.get(user_id, (0, {}))
+            lines = deepcopy(lines)
+            original = deepcopy(lines)
+            result = func(lines)
+            if lines != original:
+                self._carts[user_id] = (version + 1, lines)
+                self._dirty.add(user_id)
+            return result
+
+    def dirty(self, limit=100):
+        with self._lock:
+            return sorted(self._dirty)[:limit]
+
+    def mark_flushed(self, user_id, version):
+        """Mark the cart clean if it is still at ``version`` (None: not held). Empty carts are dropped"""
+        with self._lock:
+            current, lines = self._carts.get(user_id, (None, {}))
+            if current != version:
+                return False
+            self._dirty.discard(user_id)
+            if not lines:
+                self._carts.pop(user_id, None)
+            return True
+
+
+class RedisCartKV:
+    """Carts in Redis, shared by every worker; one JSON document per cart.
+
+    Updates run as WATCH/MULTI transactions, so ``func`` may be called more
+    than once and must not have side effects. Carts expire after ``ttl``
+    seconds without a change.
+    """
+
+    DIRTY = 'carts:dirty'
+
+    def __init__(self, url, ttl=30 * 24 * 3600):
+        if redis is None:
+            raise RuntimeError("CART_KV_URL needs the redis package")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(user_id):
+        return f'cart:{user_id}'
+
+    @staticmethod
+    def _decode(raw):
+        if raw is None:
+            return {'version': None, 'lines': {}}
+        return json.loads(raw)
+
+    def get(self, user_id):
+        raw = self.client.get(self._key(user_id))
+        if raw is None:
+            return None
+        document = json.loads(raw)
+        return document['version'], document['lines']
+
+    def seed(self, user_id, lines):
+        self.client.set(self._key(user_id), json.dumps({'version': 0, 'lines': lines}), ex=self.ttl, nx=True)
+
+    def update(self, user_id, func):
+        key = self._key(user_id)
+
+        def transaction(pipe):
+            document = self._decode(pipe.get(key))
+            lines = document['lines']
+            original = deepcopy(lines)
+            result = func(lines)
+            pipe.multi()
+            if lines != original:
+                document['version'] = (document['version'] or 0) + 1
+                pipe.set(key, json.dumps(document), ex=self.ttl)
+                pipe.sadd(self.DIRTY, user_id)
+            return result
+
+        return self.client.transaction(transaction, key, value_from_callable=True)
+
+    def dirty(self, limit=100):
+        if limit is None:
+            user_ids = self.client.smembers(self.DIRTY)
+        else:
+            user_ids = self.client.srandmember(self.DIRTY, limit)
+        return sorted(int(user_id) for user_id in user_ids)
+
+    def mark_flushed(self, user_id, version):
+        key = self._key(user_id)
+
+        def transaction(pipe):
+            document = self._decode(pipe.get(key))
+            if document['version'] != version:
+                pipe.multi()
+                return False
+            pipe.multi()
+            pipe.srem(self.DIRTY, user_id)
+            if not document['lines']:
+                pipe.delete(key)
+            return True
+
+        return self.client.transaction(transaction, key, value_from_callable=True)
+
+
+class DatabaseCartStore:
+    """Every cart change is committed to cart_items straight away"""
+
+    def add(self, user_id, product, quantity):
+        """Add ``quantity`` of ``product``. Returns (line dict, None) or (None, error)"""
+        # Merge into the user's existing line for this product in one upsert
+        Cart.upsert_lines(user_id, [(product, quantity)])
+        cart_item = Cart.query.filter_by(
+            user_id=user_id,
+            product_id=product.id,
+            status='in_cart'
+        ).populate_existing().one()
+
+        # Check stock availability for the merged quantity
+        stock_available, message = cart_item.check_stock(product)
+        if not stock_available:
+            db.session.rollback()
+            return None, message
+
+        db.session.commit()
+        cart_summary_cache.invalidate(user_id)
+        return cart_item.to_dict(), None
+
+    def apply_bulk(self, user_id, items):
+        return Cart.apply_bulk(user_id, items)
+
+    def summary(self, user_id):
+        return Cart.get_summary(user_id)
+
+    def clear(self, user_id):
+        return Cart.clear_cart(user_id)
+
+    def take(self, user_id):
+        """Load the in-cart lines for checkout, in the current transaction.
+
+        Returns (cart items, taken) where ``taken`` is what ``put_back``
+        needs to restore the cart if the checkout fails.
+        """
+        return Cart.query.filter_by(user_id=user_id, status='in_cart').all(), None
+
+    def put_back(self, user_id, taken):
+        """Nothing to do, the checkout's rollback restored the cart"""
+
+    def flush(self, limit=100):
+        return 0
+
+
+class WriteBehindCartStore:
+    """Cart lines live in ``kv`` and are written to cart_items later"""
+
+    def __init__(self, kv):
+        self.kv = kv
+
+    def _load(self, user_id):
+        """The cart's (version, lines), loading it from cart_items if the store does not hold it"""
+        cart = self.kv.get(user_id)
+        if cart is not None:
+            return cart
+        # Read from the primary: a lagging replica could bring back removed lines
+        with Session(db.engine) as session:
+            lines = {str(row.product_id): {
+                'quantity': row.quantity,
+                'total_price': row.total_price,
+                'created_at': (row.created_at or datetime.utcnow()).isoformat()
+            } for row in session.query(Cart).filter_by(user_id=user_id, status='in_cart')}
+        self.kv.seed(user_id, lines)
+        return self.kv.get(user_id) or (0, lines)
+
+    def add(self, user_id, product, quantity):
+        price = product.price * quantity
+        self._load(user_id)
+
+        def add_line(lines):
+            line = lines.get(str(product.id))
+            new_quantity = (line['quantity'] if line else 0) + quantity
+            stock_available, message = Cart(quantity=new_quantity).check_stock(product)
+            if not stock_available:
+                return None, message
+            if line:
+                line['quantity'] = new_quantity
+                line['total_price'] += price
+            else:
+                line = lines[str(product.id)] = {
+                    'quantity': quantity,
+                    'total_price': price,
+                    'created_at': datetime.utcnow().isoformat()
+                }
+            return dict(line), None
+
+        line, message = self.kv.update(user_id, add_line)
+        if line is None:
+            return None, message
+        cart_summary_cache.invalidate(user_id)
+        return {
+            'id': None,  # Known once the line has been flushed
+            'product_id': product.id,
+            'quantity': line['quantity'],
+            'total_price': line['total_price'],
+            'status': 'in_cart',
+            'created_at': line['created_at']
+        }, None
+
+    def apply_bulk(self, user_id, items):
+        product_ids = bulk_product_ids(items)
+        products = {
+            product.id: product
+            for product in db.session.query(db.with_polymorphic(Product, '*')).filter(
+                Product.id.in_(product_ids)
+            )
+        }
+
+        self._load(user_id)
+
+        def apply(lines):
+            quantities = {int(product_id): line['quantity'] for product_id, line in lines.items()}
+            results, changed = Cart.plan_bulk(items, products, quantities)
+            now = datetime.utcnow().isoformat()
+            for product_id, quantity in changed.items():
+                if quantity == 0:
+                    lines.pop(str(product_id), None)
+                    continue
+                line = lines.setdefault(str(product_id), {'created_at': now})
+                line['quantity'] = quantity
+                line['total_price'] = products[product_id].price * quantity
+            return results, len(changed)
+
+        results, applied = self.kv.update(user_id, apply)
+        cart_summary_cache.invalidate(user_id)
+        return results, applied
+
+    def summary(self, user_id):
+        """Same shape as ``Cart.get_summary``; ids are null until a line is flushed"""
+        summary = cart_summary_cache.get(user_id)
+        if summary is not None:
+            return summary
+
+        _, lines = self._load(user_id)
+        physical = PhysicalProduct.__table__
+        rows = db.session.query(
+            Product.id,
+            Product.name,
+            Product.price,
+            Product.type,
+            physical.c.stock,
+            Cart.id.label('line_id')
+        ).outerjoin(
+            physical, physical.c.id == Product.id
+        ).outerjoin(
+            Cart, db.and_(
+                Cart.product_id == Product.id,
+                Cart.user_id == user_id,
+                Cart.status == 'in_cart'
+            )
+        ).filter(
+            Product.id.in_([int(product_id) for product_id in lines])
+        ).all() if lines else []
+
+        items = []
+        for row in sorted(rows, key=lambda row: (lines[str(row.id)]['created_at'], row.id)):
+            line = lines[str(row.id)]
+            items.append({
+                'id': row.line_id,
+                'product_id': row.id,
+                'name': row.name,
+                'type': row.type,
+                'quantity': line['quantity'],
+                'price': row.price,
+                'total_price': line['quantity'] * row.price,
+                'stock': row.stock,
+                'stock_status': _stock_status(row.type, row.stock, line['quantity']),
+                'status': 'in_cart',
+                'created_at': line['created_at']
+            })
+        summary = {'items': items, 'total': sum(item['total_price'] for item in items)}
+        cart_summary_cache.set(user_id, summary, current_app.config.get('CART_SUMMARY_CACHE_TTL', 0))
+        return summary
+
+    def clear(self, user_id):
+        self._load(user_id)
+        self.kv.update(user_id, lambda lines: lines.clear())
+        cart_summary_cache.invalidate(user_id)
+        return True, "Cart cleared successfully"
+
+    def _lock_user(self, user_id):
+        # Flushes and checkouts of one cart take turns, so the last one to
+        # commit always wrote the newest lines
+        db.session.query(User.id).filter(User.id == user_id).with_for_update().scalar()
+
+    def _write_lines(self, user_id, lines):
+        """Make the user's in-cart rows match ``lines``, without committing"""
+        existing = {row.product_id: row for row in Cart.query.filter_by(
+            user_id=user_id, status='in_cart'
+        )}
+        live = {product_id for (product_id,) in db.session.query(Product.id).filter(
+            Product.id.in_([int(product_id) for product_id in lines])
+        )} if lines else set()
+
+        rows = []
+        for product_id, line in lines.items():
+            product_id = int(product_id)
+            if product_id not in live:
+                continue  # Deleted while it sat in the cart
+            row = existing.pop(product_id, None)
+            if row is None:
+                row = Cart(
+                    user_id=user_id,
+                    product_id=product_id,
+                    status='in_cart',
+                    created_at=datetime.fromisoformat(line['created_at'])
+                )
+                db.session.add(row)
+            row.quantity = line['quantity']
+            row.total_price = line['total_price']
+            rows.append(row)
+        for row in existing.values():
+            db.session.delete(row)
+        db.session.flush()
+        return rows
+
+    def take(self, user_id):
+        """Move the cart into cart_items for checkout.
+
+        The lines leave the key-value store before the checkout commits and
+        ``put_back`` restores them if it fails: a crash in between can lose
+        the cart, but never leaves behind a cart that was also ordered.
+        """
+        self._load(user_id)
+        self._lock_user(user_id)
+        taken = self.kv.update(user_id, _take_lines)
+        try:
+            return self._write_lines(user_id, taken), taken
+        except Exception:
+            self.put_back(user_id, taken)
+            raise
+
+    def put_back(self, user_id, taken):
+        def restore(lines):
+            for product_id, line in taken.items():
+                current = lines.get(product_id)
+                if current:
+                    current['quantity'] += line['quantity']
+                    current['total_price'] += line['total_price']
+                else:
+                    lines[product_id] = dict(line)
+
+        if taken:
+            self.kv.update(user_id, restore)
+            cart_summary_cache.invalidate(user_id)
+
+    def flush_cart(self, user_id):
+        """Write one cart to cart_items and commit"""
+        try:
+            self._lock_user(user_id)
+            # Read after taking the lock, so no older flush can commit after us
+            cart = self.kv.get(user_id)
+            if cart is None:
+                # Expired or lost before it was flushed; never delete rows we have not seen
+                version = None
+            else:
+                version, lines = cart
+                self._write_lines(user_id, lines)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        self.kv.mark_flushed(user_id, version)
+        cart_summary_cache.invalidate(user_id)  # Lines now have ids
+
+    def flush(self, limit=100):
+        """Flush up to ``limit`` changed carts, all if None. Returns how many were written"""
+        flushed = 0
+        for user_id in self.kv.dirty(limit):
+            try:
+                self.flush_cart(user_id)
+                flushed += 1
+            except Exception as e:
+                # Still dirty, so the next flush tries again
+                logger.error(f"Could not flush cart of user {user_id}: {str(e)}")
+        return flushed
+
+
+def _take_lines(lines):
+    taken = dict(lines)
+    lines.clear()
+    return taken
+
+
+def _flush_periodically(app, store, interval, stop):
+    with app.app_context():
+        while not stop.wait(interval):
+            try:
+                while store.flush() >= 100:
+                    pass
+            except Exception as e:
+                logger.error(f"Cart flush failed: {str(e)}")
+            finally:
+                db.session.remove()
+
+
+def get_cart_store(app=None):
+    """Get the app's cart store, chosen by CART_BACKEND"""
+    app = app or current_app
+    store = app.extensions.get('cart_store')
+    if store is None:
+        backend = app.config.get('CART_BACKEND', 'database')
+        if backend == 'database':
+            store = DatabaseCartStore()
+        elif backend == 'write_behind':
+            url = app.config.get('CART_KV_URL')
+            store = WriteBehindCartStore(RedisCartKV(url) if url else LocalCartKV())
+            interval = app.config.get('CART_FLUSH_INTERVAL', 5)
+            if interval > 0:
+                store.stop_flusher = Event()
+                Thread(
+                    target=_flush_periodically,
+                    args=(app, store, interval, store.stop_flusher),
+                    name='cart-flusher',
+                    daemon=True
+                ).start()
+        else:
+            raise ValueError(f"Invalid cart backend: {backend}")
+        app.extensions['cart_store'] = store
+    return store
+
+
+def reset_cart_store(app=None):
+    store = (app or current_app).extensions.pop('cart_store', None)
+    if getattr(store, 'stop_flusher', None) is not None:
+        store.stop_flusher.set()
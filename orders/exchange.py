@@ -16,6 +16,14 @@ class Exchange(Order):
     approved_at = db.Column(db.DateTime)
     rejected_by = db.Column(db.Integer, db.ForeignKey('users.id'))
     rejected_at = db.Column(db.DateTime)
+    # True while the request is open, NULL once decided. NULLs never collide,
+    # so the constraint below allows one active request per purchase. Its
+    # index also serves lookups by original_purchase_id alone.
+    active_request = db.Column(db.Boolean, default=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('original_purchase_id', 'active_request', name='uq_exchanges_active_purchase'),
+    )
     
     __mapper_args__ = {
         'polymorphic_identity': 'exchange'
@@ -0,0 +1,210 @@
+from datetime import datetime
+import csv
+import io
+import json
+from sqlalchemy import Numeric, Text, and_, case, cast, func, not_, select
+from db import db
+from orders.purchase import Purchase
+from orders.return_order import Return
+from orders.exchange import Exchange
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet'
+}
+DEFAULT_CHUNK_SIZE = 5000
+
+ORDER_COLUMNS = ['id', 'user_id', 'product_id', 'quantity', 'total_price', 'status', 'date']
+
+# Model, exported columns and the column the date range filters on, per export type
+EXPORTS = {
+    'purchase': (Purchase, ORDER_COLUMNS[:-1] + ['created_at', 'order_header_id'], 'created_at'),
+    'return': (Return, ORDER_COLUMNS + [
+        'reason', 'refund_amount', 'original_purchase_id', 'approved_at', 'rejected_at'
+    ], 'date'),
+    'exchange': (Exchange, ORDER_COLUMNS + [
+        'new_product_id', 'reason', 'original_purchase_id', 'approved_at', 'rejected_at'
+    ], 'date'),
+}
+
+
+def export_query(order_type, since=None, until=None, after_id=None):
+    """SELECT for one export type, ordered by id.
+
+    ``since`` is inclusive and ``until`` exclusive. ``after_id`` resumes an
+    interrupted export after the last id it delivered.
+    """
+    if order_type not in EXPORTS:
+        raise ValueError(f"Invalid export type: {order_type}")
+    model, columns, date_column = EXPORTS[order_type]
+    id_column, date_column = model.id, getattr(model, date_column)
+    # Purchases export created_at as date so every export has the same core columns
+    stmt = select(*[getattr(model, name).label('date' if name == 'created_at' else name) for name in columns])
+    stmt = stmt.select_from(model).order_by(id_column)
+    if since is not None:
+        stmt = stmt.where(date_column >= since)
+    if until is not None:
+        stmt = stmt.where(date_column < until)
+    if after_id is not None:
+        stmt = stmt.where(id_column > after_id)
+    return stmt
+
+
+def iter_chunks(order_type, since=None, until=None, after_id=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield lists of row dicts, ``chunk_size`` rows at a time.
+
+    Rows come from a server-side cursor on PostgreSQL, so memory use does
+    not grow with the size of the export.
+    """
+    stmt = export_query(order_type, since, until, after_id)
+    result = db.session.execute(stmt.execution_options(stream_results=True))
+    for partition in result.mappings().partitions(chunk_size):
+        yield [dict(row) for row in partition]
+
+
+def export_columns(order_type):
+    return [column.key for column in export_query(order_type).selected_columns]
+
+
+def _text_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _csv_text(column):
+    """``column`` as PostgreSQL text in the form write_csv gives it.
+
+    Timestamps use isoformat() (``T`` separator, microseconds only when
+    set), booleans True/False, whole floats keep their ``.0`` and empty
+    strings become NULL, which csv writes the same way as None.
+    """
+    python_type = column.type.python_type
+    if python_type is datetime:
+        seconds = func.to_char(column, 'YYYY-MM-DD"T"HH24:MI:SS')
+        value = case(
+            (func.date_trunc('second', column) == column, seconds),
+            else_=func.to_char(column, 'YYYY-MM-DD"T"HH24:MI:SS.US')
+        )
+    elif python_type is bool:
+        value = case((column, 'True'), (not_(column), 'False'))
+    elif python_type is float:
+        # repr() switches to exponent notation from 1e16, as float8 text does
+        whole = and_(column == func.trunc(column), func.abs(column) < 1e16)
+        value = case((whole, cast(cast(column, Numeric), Text) + '.0'), else_=cast(column, Text))
+    elif python_type is str:
+        value = func.nullif(column, '')
+    else:
+        return column
+    return value.label(column.key)
+
+
+def write_csv(chunks, columns):
+    buffer = io.StringIO()
+    # Unix line endings, like COPY in copy_csv
+    writer = csv.DictWriter(buffer, fieldnames=columns, lineterminator='\n')
+    writer.writeheader()
+    for rows in chunks:
+        writer.writerows({key: _text_value(value) for key, value in row.items()} for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def write_ndjson(chunks, columns):
+    for rows in chunks:
+        yield ''.join(json.dumps({key: _text_value(value) for key, value in row.items()}) + '\n'
+                      for row in rows)
+
+
+class _Sink:
+    """Write-only file object whose contents are drained after each row group"""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.position += len(data)
+        return self.buffer.write(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+def _arrow_schema(order_type):
+    types = {int: pyarrow.int64(), float: pyarrow.float64(), str: pyarrow.string(),
+             bool: pyarrow.bool_(), datetime: pyarrow.timestamp('us')}
+    return pyarrow.schema([
+        (column.key, types[column.type.python_type])
+        for column in export_query(order_type).selected_columns
+    ])
+
+
+def write_parquet(chunks, order_type):
+    """Yield a Parquet file in pieces, one row group per chunk. Needs pyarrow"""
+    if pyarrow is None:
+        raise RuntimeError("Parquet export requires pyarrow")
+    schema = _arrow_schema(order_type)
+    sink = _Sink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for rows in chunks:
+        writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export_orders(order_type, export_format, since=None, until=None, after_id=None,
+                  chunk_size=DEFAULT_CHUNK_SIZE):
+    """Stream an export as an iterator of str (csv, ndjson) or bytes (parquet) pieces"""
+    if order_type not in EXPORTS:
+        raise ValueError(f"Invalid export type: {order_type}")
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Invalid export format: {export_format}")
+    if export_format == 'parquet' and pyarrow is None:
+        raise ValueError("Parquet export requires pyarrow")
+    chunks = iter_chunks(order_type, since, until, after_id, chunk_size)
+    if export_format == 'parquet':
+        return write_parquet(chunks, order_type)
+    writer = write_csv if export_format == 'csv' else write_ndjson
+    return writer(chunks, export_columns(order_type))
+
+
+def copy_csv(order_type, out, since=None, until=None, after_id=None):
+    """Write a CSV export to the binary file ``out`` with PostgreSQL's COPY TO.
+
+    Much faster than fetching rows for large exports, but only available on
+    PostgreSQL with psycopg2. Values are formatted in SQL so the file is the
+    same as the one write_csv streams.
+    """
+    rows = export_query(order_type, since, until, after_id).subquery()
+    stmt = select(*[_csv_text(column) for column in rows.c]).order_by(rows.c.id)
+    compiled = stmt.compile(dialect=db.engine.dialect)
+    connection = db.engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            sql = cursor.mogrify(str(compiled), compiled.params).decode()
+            cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)", out)
+    finally:
+        connection.close()
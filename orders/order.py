@@ -19,6 +19,11 @@ class Order(db.Model):
     quantity = db.Column(db.Integer, default=1)
     total_price = db.Column(db.Float)
 
+    # Backs the admin approval queue: WHERE type IN (...) AND status = ... ORDER BY date
+    __table_args__ = (
+        db.Index('ix_orders_type_status_date', 'type', 'status', 'date'),
+    )
+
     __mapper_args__ = {
         'polymorphic_identity': 'order',
         'polymorphic_on': type
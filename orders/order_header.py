@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+from db import db
+from orders.purchase import Purchase
+
+# Lines share their order's created_at, except orders grouped from older
+# purchases by migration 0008, whose lines can be up to this much later
+LINE_WINDOW = timedelta(seconds=1)
+
+
+class OrderHeader(db.Model):
+    """One checkout. Its purchases are the line items.
+
+    Returns and exchanges still reference individual purchase lines.
+    """
+    __tablename__ = 'order_headers'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='completed')
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    total_price = db.Column(db.Float, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_order_headers_user_id_created_at', 'user_id', 'created_at'),
+    )
+
+    lines = db.relationship('Purchase', backref='order_header', order_by=Purchase.id)
+
+    @classmethod
+    def from_cart(cls, user_id, cart_items, products):
+        """Build a header with one purchase line per cart item.
+
+        Lines are charged at the current price from ``products`` ({id:
+        product}), not the price the item had when it was added to the cart.
+        Adding the header to the session inserts it and then all of its
+        lines in one batched INSERT at flush.
+        """
+        now = datetime.utcnow()
+        header = cls(
+            user_id=user_id,
+            status='completed',
+            item_count=sum(cart_item.quantity for cart_item in cart_items),
+            created_at=now
+        )
+        header.lines = [Purchase(
+            user_id=user_id,
+            product_id=cart_item.product_id,
+            quantity=cart_item.quantity,
+            total_price=cart_item.quantity * products[cart_item.product_id].price,
+            status='completed',
+            created_at=now
+        ) for cart_item in cart_items]
+        header.total_price = sum(line.total_price for line in header.lines)
+        return header
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'item_count': self.item_count,
+            'total_price': self.total_price,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'lines': [line.to_dict() for line in self.lines]
+        }
@@ -0,0 +1,235 @@
+"""Monthly range partitions for order history on PostgreSQL.
+
+``order_headers`` and ``purchases`` can be converted to tables partitioned
+by ``created_at``, one partition per month plus a default partition.
+Queries that filter on ``created_at`` (GET /orders with since/until, the
+exports) then only touch the months they ask for, and old months can be
+detached and archived without touching the live ones.
+
+``orders``/``returns``/``exchanges`` are not partitioned: the subtype
+tables join to ``orders`` on id alone, which a partitioned table cannot
+guarantee unique.
+"""
+from datetime import date, datetime
+import gzip
+import os
+import re
+from sqlalchemy import text
+from sqlalchemy.schema import AddConstraint, CreateIndex
+from db import db
+from utils.logger import logger
+
+PARTITIONED_TABLES = {
+    'order_headers': 'created_at',
+    'purchases': 'created_at',
+}
+ARCHIVE_SCHEMA = 'archive'
+# Rows without a timestamp are moved to the start of time so they archive first
+MISSING_TIMESTAMP = '1970-01-01'
+
+_PARTITION_NAME = re.compile(r'^(?P<table>\w+)_y(?P<year>\d{4})m(?P<month>\d{2})$')
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f'{table}_y{month.year:04d}m{month.month:02d}'
+
+
+def monthly_partitions(table, first_month, last_month):
+    """(name, lower, upper) for every month from first_month to last_month inclusive"""
+    month = date(first_month.year, first_month.month, 1)
+    partitions = []
+    while month <= last_month:
+        upper = add_months(month, 1)
+        partitions.append((partition_name(table, month), month, upper))
+        month = upper
+    return partitions
+
+
+def is_partitioned(connection, table):
+    return connection.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))"
+    ), {'table': table}).scalar()
+
+
+def list_partitions(connection, table):
+    """Names of the monthly partitions attached to ``table``, oldest first"""
+    names = connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass(:table)"
+    ), {'table': table}).scalars()
+    return sorted(name for name in names if _PARTITION_NAME.match(name))
+
+
+def _partition_month(name):
+    match = _PARTITION_NAME.match(name)
+    return date(int(match.group('year')), int(match.group('month')), 1)
+
+
+def default_partition(table):
+    return f'{table}_default'
+
+
+def _create_partitions(connection, table, column, first_month, last_month):
+    created = []
+    existing = set(list_partitions(connection, table))
+    default = default_partition(table)
+    has_default = connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {'name': default}).scalar()
+    for name, lower, upper in monthly_partitions(table, first_month, last_month):
+        if name in existing:
+            continue
+        bounds = f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"
+        in_range = f"{column} >= '{lower.isoformat()}' AND {column} < '{upper.isoformat()}'"
+        if has_default and connection.execute(text(
+            f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {in_range})"
+        )).scalar():
+            # Attaching over rows the default partition holds would fail, so
+            # move them into the new table first and attach it afterwards
+            connection.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)"))
+            connection.execute(text(
+                f"WITH moved AS (DELETE FROM {default} WHERE {in_range} RETURNING *) "
+                f"INSERT INTO {name} SELECT * FROM moved"
+            ))
+            connection.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {name} {bounds}"))
+        else:
+            connection.execute(text(f"CREATE TABLE {name} PARTITION OF {table} {bounds}"))
+        created.append(name)
+    return created
+
+
+def _split_default(connection, table, before):
+    """Give the months of the default partition that end by ``before`` their own partitions"""
+    column = PARTITIONED_TABLES[table]
+    months = connection.execute(text(
+        f"SELECT DISTINCT date_trunc('month', {column})::date FROM {default_partition(table)} "
+        f"WHERE {column} < :before"
+    ), {'before': before}).scalars()
+    created = []
+    for month in sorted(month for month in months if add_months(month, 1) <= before):
+        created += _create_partitions(connection, table, column, month, month)
+    return created
+
+
+def partition_table(table, months_ahead=3):
+    """Convert ``table`` into a partitioned table, in one transaction.
+
+    Rewrites the table, so run it in a maintenance window. Foreign keys
+    that point at the table are dropped, since a partitioned table can only
+    be referenced through a key that includes the partition column; the
+    application keeps those references consistent. Returns False if the
+    table is already partitioned.
+    """
+    column = PARTITIONED_TABLES[table]
+    model_table = db.metadata.tables[table]
+    staging = f'{table}_partitioned'
+
+    with db.engine.begin() as connection:
+        if is_partitioned(connection, table):
+            return False
+
+        referencing = connection.execute(text(
+            "SELECT conname, conrelid::regclass::text FROM pg_constraint "
+            "WHERE contype = 'f' AND confrelid = to_regclass(:table)"
+        ), {'table': table}).fetchall()
+        for constraint, referencing_table in referencing:
+            connection.execute(text(f"ALTER TABLE {referencing_table} DROP CONSTRAINT {constraint}"))
+            logger.warning(f"Dropped foreign key {constraint} on {referencing_table} to partition {table}")
+
+        connection.execute(text(f"UPDATE {table} SET {column} = '{MISSING_TIMESTAMP}' WHERE {column} IS NULL"))
+        connection.execute(text(
+            f"CREATE TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) PARTITION BY RANGE ({column})"
+        ))
+        connection.execute(text(f"ALTER TABLE {staging} ALTER COLUMN {column} SET NOT NULL"))
+        connection.execute(text(f"ALTER TABLE {staging} ADD PRIMARY KEY (id, {column})"))
+
+        first = connection.execute(text(f"SELECT MIN({column}) FROM {table}")).scalar() or datetime.utcnow()
+        _create_partitions(connection, staging, column, first.date(), add_months(date.today(), months_ahead))
+        connection.execute(text(f"CREATE TABLE {default_partition(table)} PARTITION OF {staging} DEFAULT"))
+        connection.execute(text(f"INSERT INTO {staging} SELECT * FROM {table}"))
+
+        # Keep the id sequence when the old table goes
+        sequence = connection.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': table}).scalar()
+        if sequence:
+            connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+        connection.execute(text(f"DROP TABLE {table}"))
+        connection.execute(text(f"ALTER TABLE {staging} RENAME TO {table}"))
+        if sequence:
+            connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id"))
+        for name in list_partitions(connection, table):
+            connection.execute(text(f"ALTER TABLE {name} RENAME TO {name.replace(staging, table, 1)}"))
+
+        # Indexes and outgoing foreign keys are created on the parent and cascade to partitions
+        for index in model_table.indexes:
+            connection.execute(CreateIndex(index))
+        for constraint in model_table.foreign_key_constraints:
+            connection.execute(AddConstraint(constraint))
+    logger.info(f"Partitioned {table} by {column}")
+    return True
+
+
+def ensure_partitions(months_ahead=3, today=None):
+    """Create the monthly partitions up to ``months_ahead`` months from now.
+
+    Run daily (see the job runner or cron); it is a no-op for tables that are
+    not partitioned and on other databases. Rows the default partition holds
+    for a new month are moved into it. Returns the partitions created.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return []
+    today = today or date.today()
+    created = []
+    with db.engine.begin() as connection:
+        for table in PARTITIONED_TABLES:
+            if is_partitioned(connection, table):
+                created += _create_partitions(
+                    connection, table, PARTITIONED_TABLES[table], today, add_months(today, months_ahead)
+                )
+    for name in created:
+        logger.info(f"Created partition {name}")
+    return created
+
+
+def archive_partitions(before, mode='schema', directory='archive'):
+    """Detach the monthly partitions that end on or before ``before``.
+
+    ``mode='schema'`` moves each detached partition into the archive schema,
+    where it can still be queried. ``mode='export'`` writes it to a gzipped CSV
+    in ``directory`` and drops it. Old months that only exist in the default
+    partition are split out into their own partitions first, so they are
+    archived too. Returns the names of the archived partitions.
+    """
+    if mode not in ('schema', 'export'):
+        raise ValueError(f"Invalid archive mode: {mode}")
+    if db.engine.dialect.name != 'postgresql':
+        return []
+
+    archived = []
+    for table in PARTITIONED_TABLES:
+        with db.engine.begin() as connection:
+            if not is_partitioned(connection, table):
+                continue
+            for name in _split_default(connection, table, before):
+                logger.info(f"Moved {name} out of the default partition")
+            cold = [name for name in list_partitions(connection, table)
+                    if add_months(_partition_month(name), 1) <= before]
+
+        for name in cold:
+            with db.engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+                if mode == 'schema':
+                    connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+                    connection.execute(text(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+                else:
+                    os.makedirs(directory, exist_ok=True)
+                    with gzip.open(os.path.join(directory, f'{name}.csv.gz'), 'wb') as out:
+                        cursor = connection.connection.cursor()
+                        cursor.copy_expert(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)", out)
+                    connection.execute(text(f"DROP TABLE {name}"))
+            logger.info(f"Archived partition {name} ({mode})")
+            archived.append(name)
+    return archived
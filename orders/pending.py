@@ -0,0 +1,94 @@
+from threading import Lock
+import time
+from sqlalchemy.orm import with_polymorphic
+from db import db
+from orders.order import Order
+from orders.return_order import Return
+from orders.exchange import Exchange
+
+PENDING_STATUS = 'pending_approval'
+QUEUE_TYPES = ('return', 'exchange')
+
+
+class PendingApprovalCounter:
+    """In-memory count of returns/exchanges waiting for admin approval.
+
+    Counts are primed from the database on first read and then kept up to
+    date by the create/approve routes, so badge reads are O(1). Each process
+    keeps its own copy, so the counts are re-primed every ``ttl`` seconds to
+    pick up changes made by other workers.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._counts = None
+        self._primed_at = 0.0
+
+    def _prime(self):
+        rows = db.session.query(Order.type, db.func.count(Order.id)).filter(
+            Order.type.in_(QUEUE_TYPES),
+            Order.status == PENDING_STATUS
+        ).group_by(Order.type).all()
+
+        counts = {order_type: 0 for order_type in QUEUE_TYPES}
+        counts.update({order_type: count for order_type, count in rows})
+        self._counts = counts
+        self._primed_at = time.monotonic()
+
+    def counts(self):
+        """Return a copy of the pending counts keyed by order type"""
+        with self._lock:
+            if self._counts is None or time.monotonic() - self._primed_at > self.ttl:
+                self._prime()
+            return dict(self._counts)
+
+    def increment(self, order_type, amount=1):
+        with self._lock:
+            # Nothing to adjust until the first read primes the cache
+            if self._counts is not None and order_type in self._counts:
+                self._counts[order_type] = max(self._counts[order_type] + amount, 0)
+
+    def decrement(self, order_type):
+        self.increment(order_type, -1)
+
+    def reset(self):
+        with self._lock:
+            self._counts = None
+            self._primed_at = 0.0
+
+
+pending_counter = PendingApprovalCounter()
+
+
+def get_pending_queue(order_type=None, page=1, per_page=20):
+    """Get one page of pending returns/exchanges, oldest first"""
+    order_types = (order_type,) if order_type else QUEUE_TYPES
+    pending = with_polymorphic(Order, [Return, Exchange])
+
+    return db.session.query(pending).filter(
+        pending.type.in_(order_types),
+        pending.status == PENDING_STATUS
+    ).order_by(
+        pending.date, pending.id
+    ).limit(per_page).offset((page - 1) * per_page).all()
+
+
+def queue_entry(order):
+    """Serialize a pending return/exchange for the admin queue"""
+    entry = {
+        'id': order.id,
+        'type': order.type,
+        'status': order.status,
+        'date': order.date.strftime('%Y-%m-%d %H:%M:%S'),
+        'product_id': order.product_id,
+        'original_purchase_id': order.original_purchase_id,
+        'customer_name': order.customer_name,
+        'customer_email': order.customer_email,
+        'reason': order.reason
+    }
+    if order.type == 'return':
+        entry['refund_amount'] = order.refund_amount
+    else:
+        entry['new_product_id'] = order.new_product_id
+    return entry
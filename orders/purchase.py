@@ -14,6 +14,14 @@ class Purchase(db.Model):
     total_price = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), nullable=False, default='completed')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    order_header_id = db.Column(db.Integer, db.ForeignKey('order_headers.id'))
+
+    __table_args__ = (
+        db.Index('ix_purchases_order_header_id', 'order_header_id'),
+        # Order history: WHERE user_id = ? ORDER BY created_at
+        db.Index('ix_purchases_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_purchases_product_id', 'product_id'),
+    )
 
     # Relationships
     user = db.relationship('User', backref='purchases')
@@ -22,6 +30,7 @@ class Purchase(db.Model):
     def to_dict(self):
         return {
             'id': self.id,
+            'order_header_id': self.order_header_id,
             'product_id': self.product_id,
             'quantity': self.quantity,
             'total_price': self.total_price,
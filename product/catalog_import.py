@@ -0,0 +1,261 @@
+from datetime import datetime
+import csv
+import io
+import json
+from sqlalchemy import text
+from db import db
+from product.changes import record_product_changes
+from product.events import mark_products_changed
+from utils.logger import product_logger
+
+STAGING_TABLE = 'catalog_staging'
+STAGING_COLUMNS = ('line', 'sku', 'name', 'description', 'price', 'type',
+                   'weight', 'stock', 'file_size', 'download_link')
+PRODUCT_TYPES = ('physical', 'digital')
+DEFAULT_BATCH_SIZE = 10000
+
+
+class CatalogRowError(ValueError):
+    pass
+
+
+def read_feed(path, feed_format=None):
+    """Yield the records of a CSV or NDJSON feed one at a time.
+
+    The format defaults to the file extension.
+    """
+    feed_format = feed_format or ('ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+    with open(path, newline='', encoding='utf-8') as feed:
+        if feed_format == 'csv':
+            yield from csv.DictReader(feed)
+        elif feed_format == 'ndjson':
+            for line in feed:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError(f"Invalid feed format: {feed_format}")
+
+
+def _number(record, key, cast):
+    value = record.get(key)
+    if value in (None, ''):
+        return None
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise CatalogRowError(f"{key} must be a number")
+
+
+def clean_row(record, line):
+    """Validate one feed record and return it as a staging row"""
+    sku = (record.get('sku') or '').strip()
+    name = (record.get('name') or '').strip()
+    product_type = record.get('type') or record.get('product_type')
+    if not sku:
+        raise CatalogRowError("sku is required")
+    if not name:
+        raise CatalogRowError("name is required")
+    if product_type not in PRODUCT_TYPES:
+        raise CatalogRowError(f"Invalid product type: {product_type}")
+    price = _number(record, 'price', float)
+    if price is None or price < 0:
+        raise CatalogRowError("price must be a non-negative number")
+    stock = _number(record, 'stock', int)
+    if stock is not None and stock < 0:
+        raise CatalogRowError("stock cannot be negative")
+
+    return {
+        'line': line,
+        'sku': sku[:64],
+        'name': name[:100],
+        'description': (record.get('description') or '')[:500],
+        'price': price,
+        'type': product_type,
+        'weight': _number(record, 'weight', float),
+        'stock': stock,
+        'file_size': _number(record, 'file_size', float),
+        'download_link': record.get('download_link') or None
+    }
+
+
+def _batches(records, batch_size, errors):
+    batch = []
+    for line, record in enumerate(records, start=1):
+        try:
+            batch.append(clean_row(record, line))
+        except CatalogRowError as e:
+            errors.append((line, str(e)))
+            continue
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _copy_batch(connection, batch):
+    """Load a batch into the staging table with COPY FROM STDIN (PostgreSQL)"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([row[column] for column in STAGING_COLUMNS] for row in batch)
+    buffer.seek(0)
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {STAGING_TABLE} ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+
+
+def _insert_batch(connection, batch):
+    connection.execute(text(
+        f"INSERT INTO {STAGING_TABLE} ({', '.join(STAGING_COLUMNS)}) "
+        f"VALUES ({', '.join(':' + column for column in STAGING_COLUMNS)})"
+    ), batch)
+
+
+# Set-based merge of the staged feed, in order. Existing products are matched
+# on SKU and only updated (and their version bumped) where something changed;
+# a SKU whose type changed is left alone. Stock changes are recorded in the
+# inventory ledger like any other.
+MERGE_STATEMENTS = {
+    'updated': f"""
+        UPDATE products SET name = s.name, description = s.description, price = s.price,
+            version_id = products.version_id + 1
+        FROM {STAGING_TABLE} s
+        WHERE products.sku = s.sku AND products.type = s.type
+          AND (products.name <> s.name OR COALESCE(products.description, '') <> s.description
+               OR products.price <> s.price
+               OR EXISTS (SELECT 1 FROM physical_products pp WHERE pp.id = products.id
+                          AND (COALESCE(pp.weight, -1) <> COALESCE(s.weight, -1)
+                               OR (s.stock IS NOT NULL AND s.stock <> COALESCE(pp.stock, 0))))
+               OR EXISTS (SELECT 1 FROM digital_products dp WHERE dp.id = products.id
+                          AND (COALESCE(dp.file_size, -1) <> COALESCE(s.file_size, -1)
+                               OR COALESCE(dp.download_link, '') <> COALESCE(s.download_link, ''))))""",
+    'inserted': f"""
+        INSERT INTO products (sku, name, description, price, type, version_id)
+        SELECT s.sku, s.name, s.description, s.price, s.type, 1 FROM {STAGING_TABLE} s
+        WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.sku = s.sku)""",
+    'physical_inserted': f"""
+        INSERT INTO physical_products (id, weight, stock)
+        SELECT p.id, s.weight, 0 FROM {STAGING_TABLE} s JOIN products p ON p.sku = s.sku
+        WHERE s.type = 'physical' AND p.type = 'physical'
+          AND NOT EXISTS (SELECT 1 FROM physical_products pp WHERE pp.id = p.id)""",
+    'digital_inserted': f"""
+        INSERT INTO digital_products (id, file_size, download_link)
+        SELECT p.id, s.file_size, s.download_link FROM {STAGING_TABLE} s JOIN products p ON p.sku = s.sku
+        WHERE s.type = 'digital' AND p.type = 'digital'
+          AND NOT EXISTS (SELECT 1 FROM digital_products dp WHERE dp.id = p.id)""",
+    'physical_updated': f"""
+        UPDATE physical_products SET weight = s.weight
+        FROM {STAGING_TABLE} s JOIN products p ON p.sku = s.sku
+        WHERE physical_products.id = p.id AND s.type = 'physical'
+          AND COALESCE(physical_products.weight, -1) <> COALESCE(s.weight, -1)""",
+    'digital_updated': f"""
+        UPDATE digital_products SET file_size = s.file_size, download_link = s.download_link
+        FROM {STAGING_TABLE} s JOIN products p ON p.sku = s.sku
+        WHERE digital_products.id = p.id AND s.type = 'digital'
+          AND (COALESCE(digital_products.file_size, -1) <> COALESCE(s.file_size, -1)
+               OR COALESCE(digital_products.download_link, '') <> COALESCE(s.download_link, ''))""",
+    'stock_movements': f"""
+        INSERT INTO inventory_movements (product_id, quantity, reason, user_id, created_at)
+        SELECT pp.id, s.stock - COALESCE(pp.stock, 0), 'adjust', :user_id, :now
+        FROM {STAGING_TABLE} s JOIN products p ON p.sku = s.sku
+        JOIN physical_products pp ON pp.id = p.id
+        WHERE s.type = 'physical' AND s.stock IS NOT NULL AND s.stock <> COALESCE(pp.stock, 0)""",
+    'stock_updated': f"""
+        UPDATE physical_products SET stock = s.stock
+        FROM {STAGING_TABLE} s JOIN products p ON p.sku = s.sku
+        WHERE physical_products.id = p.id AND s.type = 'physical'
+          AND s.stock IS NOT NULL AND s.stock <> COALESCE(physical_products.stock, 0)""",
+}
+
+
+CHANGES_TABLE = 'catalog_changes'
+
+# Run before the merge: note each SKU the merge will insert or change, and
+# how, so only those products are logged and refreshed afterwards. The
+# conditions mirror the ones in MERGE_STATEMENTS.
+CHANGE_STATEMENTS = (
+    f"""
+    INSERT INTO {CHANGES_TABLE} (sku, operation)
+    SELECT s.sku, 'insert' FROM {STAGING_TABLE} s
+    WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.sku = s.sku)""",
+    f"""
+    INSERT INTO {CHANGES_TABLE} (sku, operation)
+    SELECT sku, CASE WHEN fields_changed = 1 THEN 'update' ELSE 'stock' END FROM (
+        SELECT s.sku,
+            CASE WHEN p.name <> s.name OR COALESCE(p.description, '') <> s.description OR p.price <> s.price
+                      OR COALESCE(pp.weight, -1) <> COALESCE(s.weight, -1)
+                      OR COALESCE(dp.file_size, -1) <> COALESCE(s.file_size, -1)
+                      OR COALESCE(dp.download_link, '') <> COALESCE(s.download_link, '')
+                 THEN 1 ELSE 0 END AS fields_changed,
+            CASE WHEN s.stock IS NOT NULL AND s.stock <> COALESCE(pp.stock, 0)
+                 THEN 1 ELSE 0 END AS stock_changed
+        FROM {STAGING_TABLE} s JOIN products p ON p.sku = s.sku AND p.type = s.type
+        LEFT JOIN physical_products pp ON pp.id = p.id AND s.type = 'physical'
+        LEFT JOIN digital_products dp ON dp.id = p.id AND s.type = 'digital'
+    ) compared
+    WHERE fields_changed = 1 OR stock_changed = 1""",
+)
+
+
+def import_catalog(records, batch_size=DEFAULT_BATCH_SIZE, user_id=None):
+    """Load feed records into the catalog, keyed by SKU, in one transaction.
+
+    Records are validated and staged in batches: COPY on PostgreSQL,
+    executemany elsewhere. The staged feed is then merged with the
+    set-based statements above, after CHANGE_STATEMENTS have noted which
+    products it will change. When a SKU appears more than once, the last
+    occurrence wins. Returns a dict of row counts and the list of
+    rejected (line, error) pairs.
+    """
+    errors = []
+    connection = db.session.connection()
+    load_batch = _copy_batch if connection.dialect.name == 'postgresql' else _insert_batch
+
+    connection.execute(text(f"DROP TABLE IF EXISTS {STAGING_TABLE}"))
+    connection.execute(text(
+        f"CREATE TEMPORARY TABLE {STAGING_TABLE} (line INTEGER NOT NULL, sku VARCHAR(64) NOT NULL, "
+        f"name VARCHAR(100) NOT NULL, description VARCHAR(500), price FLOAT NOT NULL, "
+        f"type VARCHAR(50) NOT NULL, weight FLOAT, stock INTEGER, file_size FLOAT, download_link VARCHAR(500))"
+    ))
+    connection.execute(text(f"DROP TABLE IF EXISTS {CHANGES_TABLE}"))
+    connection.execute(text(
+        f"CREATE TEMPORARY TABLE {CHANGES_TABLE} (sku VARCHAR(64) NOT NULL, operation VARCHAR(10) NOT NULL)"
+    ))
+    try:
+        staged = 0
+        for batch in _batches(records, batch_size, errors):
+            load_batch(connection, batch)
+            staged += len(batch)
+
+        connection.execute(text(f"CREATE INDEX ix_{STAGING_TABLE}_sku ON {STAGING_TABLE} (sku, line)"))
+        connection.execute(text(
+            f"DELETE FROM {STAGING_TABLE} WHERE line < "
+            f"(SELECT MAX(s.line) FROM {STAGING_TABLE} s WHERE s.sku = {STAGING_TABLE}.sku)"
+        ))
+
+        counts = {'staged': staged}
+        params = {'user_id': user_id, 'now': datetime.utcnow()}
+        for statement in CHANGE_STATEMENTS:
+            connection.execute(text(statement))
+        for name, statement in MERGE_STATEMENTS.items():
+            counts[name] = connection.execute(text(statement), params).rowcount
+
+        # Only products the merge actually touched are logged and refreshed
+        changes = {}
+        for product_id, operation in connection.execute(text(
+            f"SELECT p.id, c.operation FROM {CHANGES_TABLE} c JOIN products p ON p.sku = c.sku"
+        )):
+            changes.setdefault(operation, []).append(product_id)
+        for operation, product_ids in changes.items():
+            record_product_changes(db.session, product_ids, operation)
+        mark_products_changed(db.session, [product_id for ids in changes.values() for product_id in ids])
+        connection.execute(text(f"DROP TABLE {STAGING_TABLE}"))
+        connection.execute(text(f"DROP TABLE {CHANGES_TABLE}"))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    product_logger.info(f"Catalog import: {counts}, {len(errors)} rejected rows")
+    return counts, errors
@@ -0,0 +1,214 @@
+from array import array
+from threading import Lock
+import time
+from flask import has_app_context
+from sqlalchemy import func, select
+from db import db
+from product.product import Product
+from product.physical import PhysicalProduct
+from product.changes import ProductChange
+from product.events import on_products_changed
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TYPE_CODES = {'physical': 1, 'digital': 2}
+SORTS = ('price', '-price')
+
+
+def _rows_query(product_ids=None):
+    products, physical = Product.__table__, PhysicalProduct.__table__
+    stmt = select(products.c.id, products.c.price, products.c.type, physical.c.stock).select_from(
+        products.outerjoin(physical, physical.c.id == products.c.id)
+    )
+    if product_ids is not None:
+        stmt = stmt.where(products.c.id.in_(product_ids))
+    return stmt
+
+
+class CatalogIndex:
+    """Column arrays of product id, price, type and stock for browsing.
+
+    Filters and sorts by price, type and stock run over the arrays (NumPy
+    when installed, the array module otherwise) instead of joining and
+    sorting in the database; only the requested page of products is then
+    loaded. Product commits in this process update the arrays in place.
+    Each process keeps its own copy, so at most every ``poll_interval``
+    seconds a read also applies the product_changes entries logged since
+    the last one, which picks up changes made by other workers without
+    rebuilding the whole index.
+    """
+
+    def __init__(self, poll_interval=1, batch_size=1000):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._lock = Lock()
+        self._columns = None
+        self._positions = {}
+        self._dead = 0
+        self._seq = 0
+        self._polled_at = 0.0
+
+    def _new_columns(self, rows):
+        values = {
+            'id': [row[0] for row in rows],
+            'price': [row[1] for row in rows],
+            'type': [TYPE_CODES.get(row[2], 0) for row in rows],
+            'stock': [row[3] or 0 for row in rows],
+            'alive': [1] * len(rows)
+        }
+        if numpy is not None:
+            dtypes = {'id': numpy.int64, 'price': numpy.float64, 'type': numpy.int8,
+                      'stock': numpy.int64, 'alive': numpy.bool_}
+            return {name: numpy.array(values[name], dtype=dtypes[name]) for name in values}
+        typecodes = {'id': 'q', 'price': 'd', 'type': 'b', 'stock': 'q', 'alive': 'b'}
+        return {name: array(typecodes[name], values[name]) for name in values}
+
+    def _build(self):
+        # Read the change log position first; anything logged after it is applied by _catch_up
+        self._seq = db.session.query(func.coalesce(func.max(ProductChange.seq), 0)).scalar()
+        rows = db.session.execute(_rows_query()).fetchall()
+        self._columns = self._new_columns(rows)
+        self._positions = {row[0]: position for position, row in enumerate(rows)}
+        self._dead = 0
+        self._polled_at = time.monotonic()
+
+    def _catch_up(self):
+        """Apply the change log entries after the last seen seq, a batch at a time"""
+        while self._columns is not None:
+            changes = db.session.execute(
+                select(ProductChange.seq, ProductChange.product_id)
+                .where(ProductChange.seq > self._seq)
+                .order_by(ProductChange.seq)
+                .limit(self.batch_size)
+            ).fetchall()
+            if changes:
+                self._apply({change.product_id for change in changes})
+                self._seq = changes[-1].seq
+            if len(changes) < self.batch_size:
+                break
+        self._polled_at = time.monotonic()
+
+    def _columns_for_read(self):
+        if self._columns is not None and time.monotonic() - self._polled_at >= self.poll_interval:
+            self._catch_up()
+        if self._columns is None:
+            self._build()
+        return self._columns
+
+    def apply(self, product_ids):
+        """Reload the given products from the database; deleted ones drop out"""
+        with self._lock:
+            self._apply(product_ids)
+
+    def _apply(self, product_ids):
+        if self._columns is None:
+            return
+        with db.engine.connect() as connection:
+            rows = {row[0]: row for row in connection.execute(_rows_query(product_ids))}
+
+        columns = self._columns
+        added = []
+        for product_id in product_ids:
+            position = self._positions.get(product_id)
+            row = rows.get(product_id)
+            if row is None:
+                if position is not None:
+                    columns['alive'][position] = 0
+                    del self._positions[product_id]
+                    self._dead += 1
+            elif position is None:
+                added.append(row)
+            else:
+                columns['price'][position] = row[1]
+                columns['type'][position] = TYPE_CODES.get(row[2], 0)
+                columns['stock'][position] = row[3] or 0
+        self._append(added)
+
+        # Rebuilt on the next read once deleted products make up half the arrays
+        if self._dead * 2 > len(columns['id']):
+            self._columns = None
+
+    def _append(self, rows):
+        if not rows:
+            return
+        start = len(self._columns['id'])
+        new = self._new_columns(rows)
+        if numpy is not None:
+            self._columns = {name: numpy.concatenate([self._columns[name], new[name]]) for name in new}
+        else:
+            for name in new:
+                self._columns[name].extend(new[name])
+        for offset, row in enumerate(rows):
+            self._positions[row[0]] = start + offset
+
+    def query(self, min_price=None, max_price=None, product_type=None, in_stock=False,
+              sort=None, page=1, per_page=20):
+        """Return (ids of the requested page, total number of matches)"""
+        with self._lock:
+            columns = self._columns_for_read()
+            start = (page - 1) * per_page
+            if numpy is not None:
+                return self._query_numpy(columns, min_price, max_price, product_type, in_stock,
+                                         sort, start, per_page)
+            return self._query_python(columns, min_price, max_price, product_type, in_stock,
+                                      sort, start, per_page)
+
+    def _query_numpy(self, columns, min_price, max_price, product_type, in_stock, sort, start, per_page):
+        mask = columns['alive'].copy()
+        if min_price is not None:
+            mask &= columns['price'] >= min_price
+        if max_price is not None:
+            mask &= columns['price'] <= max_price
+        if product_type is not None:
+            mask &= columns['type'] == TYPE_CODES[product_type]
+        if in_stock:
+            mask &= (columns['type'] != TYPE_CODES['physical']) | (columns['stock'] > 0)
+
+        matches = numpy.flatnonzero(mask)
+        ids = columns['id'][matches]
+        if sort == 'price':
+            order = numpy.lexsort((ids, columns['price'][matches]))
+        elif sort == '-price':
+            order = numpy.lexsort((ids, -columns['price'][matches]))
+        else:
+            order = numpy.argsort(ids, kind='stable')
+        return ids[order[start:start + per_page]].tolist(), len(matches)
+
+    def _query_python(self, columns, min_price, max_price, product_type, in_stock, sort, start, per_page):
+        ids, prices, types, stock, alive = (columns[name] for name in ('id', 'price', 'type', 'stock', 'alive'))
+        type_code = TYPE_CODES[product_type] if product_type is not None else None
+        matches = [
+            position for position in range(len(ids))
+            if alive[position]
+            and (min_price is None or prices[position] >= min_price)
+            and (max_price is None or prices[position] <= max_price)
+            and (type_code is None or types[position] == type_code)
+            and (not in_stock or types[position] != TYPE_CODES['physical'] or stock[position] > 0)
+        ]
+        if sort == 'price':
+            matches.sort(key=lambda position: (prices[position], ids[position]))
+        elif sort == '-price':
+            matches.sort(key=lambda position: (-prices[position], ids[position]))
+        else:
+            matches.sort(key=lambda position: ids[position])
+        return [ids[position] for position in matches[start:start + per_page]], len(matches)
+
+    def reset(self):
+        with self._lock:
+            self._columns = None
+            self._positions = {}
+            self._dead = 0
+            self._seq = 0
+            self._polled_at = 0.0
+
+
+catalog_index = CatalogIndex()
+
+
+@on_products_changed
+def _refresh_catalog_index(product_ids):
+    if has_app_context():
+        catalog_index.apply(product_ids)
@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+from db import db
+from product.product import Product
+
+CHANGE_OPERATIONS = ('insert', 'update', 'delete', 'stock')
+# Attributes whose change alone is logged as a stock change
+STOCK_ATTRIBUTES = {'stock', 'version_id'}
+# Arbitrary key for the PostgreSQL advisory lock that orders change log writers
+CHANGE_LOG_LOCK = 7305
+
+
+class ProductChange(db.Model):
+    """Sequenced log of catalog changes, for clients that sync incrementally.
+
+    Rows are written at the end of the transaction that made the change,
+    in commit order, so a client that has read up to ``seq`` and asks for
+    what came after never misses a committed change. Deleted products keep their last entry as a
+    tombstone; compaction only drops entries a later one supersedes.
+    """
+    __tablename__ = 'product_changes'
+
+    seq = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)  # no FK, deletes are logged too
+    operation = db.Column(db.String(10), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_product_changes_product_id', 'product_id', 'seq'),
+    )
+
+    def to_dict(self):
+        return {
+            'seq': self.seq,
+            'product_id': self.product_id,
+            'operation': self.operation,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+def record_product_changes(session, product_ids, operation):
+    """Queue change log entries for the session's transaction.
+
+    Bulk Core updates of products call this directly; ORM changes are
+    recorded at flush. The entries are written just before commit, see
+    ``_write_product_changes``.
+    """
+    if operation not in CHANGE_OPERATIONS:
+        raise ValueError(f"Invalid change operation: {operation}")
+    pending = session.info.setdefault('product_changes', [])
+    pending.extend((product_id, operation) for product_id in sorted(product_ids))
+
+
+@event.listens_for(Session, 'before_commit')
+def _write_product_changes(session):
+    """Insert the queued entries as the last statement before COMMIT.
+
+    Sequence numbers have to become visible in order, so on PostgreSQL the
+    insert takes an advisory lock that is released by the commit right
+    after it; the lock covers only that insert and the commit, not the
+    rest of the transaction (checkouts would otherwise queue behind each
+    other's stock changes).
+    """
+    # The commit's own flush runs after this hook; flush first so its changes are queued too
+    session.flush()
+    pending = session.info.pop('product_changes', None)
+    if not pending:
+        return
+    connection = session.connection()
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': CHANGE_LOG_LOCK})
+    now = datetime.utcnow()
+    connection.execute(ProductChange.__table__.insert(), [
+        {'product_id': product_id, 'operation': operation, 'created_at': now}
+        for product_id, operation in pending
+    ])
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_product_changes(session):
+    session.info.pop('product_changes', None)
+
+
+def _operation(session, product):
+    if product in session.new:
+        return 'insert'
+    if product in session.deleted:
+        return 'delete'
+    changed = {attr.key for attr in inspect(product).attrs if attr.history.has_changes()}
+    if not changed:
+        return None
+    return 'stock' if changed <= STOCK_ATTRIBUTES and 'stock' in changed else 'update'
+
+
+@event.listens_for(Session, 'after_flush')
+def _log_product_changes(session, flush_context):
+    by_operation = {}
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Product) and obj.id is not None:
+            operation = _operation(session, obj)
+            if operation:
+                by_operation.setdefault(operation, set()).add(obj.id)
+    for operation, product_ids in by_operation.items():
+        record_product_changes(session, product_ids, operation)
+
+
+def get_changes(since=0, limit=100):
+    """Entries after ``since``, oldest first, and whether more follow"""
+    changes = ProductChange.query.filter(ProductChange.seq > since).order_by(
+        ProductChange.seq
+    ).limit(limit + 1).all()
+    return changes[:limit], len(changes) > limit
+
+
+def compact_changes(keep=timedelta(hours=24)):
+    """Drop entries that a later entry for the same product supersedes.
+
+    Only entries older than ``keep`` are dropped, so recent history stays
+    readable. A client resuming from any seq still ends up with every
+    product's latest state. Returns the number of entries removed.
+    """
+    removed = db.session.execute(text(
+        "DELETE FROM product_changes WHERE created_at < :cutoff AND seq < "
+        "(SELECT MAX(c.seq) FROM product_changes c WHERE c.product_id = product_changes.product_id)"
+    ), {'cutoff': datetime.utcnow() - keep}).rowcount
+    db.session.commit()
+    return removed
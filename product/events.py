@@ -0,0 +1,47 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from product.product import Product
+from utils.logger import logger
+
+_listeners = []
+
+
+def on_products_changed(func):
+    """Register ``func(product_ids)`` to run after a commit that changed products.
+
+    Inserts, updates and deletes made through the ORM are picked up
+    automatically; bulk Core statements must call ``mark_products_changed``.
+    """
+    _listeners.append(func)
+    return func
+
+
+def mark_products_changed(session, product_ids):
+    session.info.setdefault('changed_products', set()).update(product_ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_products(session, flush_context):
+    changed = [
+        obj.id for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+        if isinstance(obj, Product) and obj.id is not None
+    ]
+    if changed:
+        mark_products_changed(session, changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_changed_products(session):
+    product_ids = session.info.pop('changed_products', None)
+    if not product_ids:
+        return
+    for listener in _listeners:
+        try:
+            listener(product_ids)
+        except Exception as e:
+            logger.error(f"Product change listener {listener.__name__} failed: {str(e)}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_products(session):
+    session.info.pop('changed_products', None)
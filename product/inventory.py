@@ -0,0 +1,171 @@
+from datetime import datetime
+from sqlalchemy import event, bindparam
+from sqlalchemy.orm import Session
+from db import db
+from product.product import Product
+from product.physical import PhysicalProduct
+from product.changes import record_product_changes
+from product.events import mark_products_changed
+from utils.outbox import publish
+
+MOVEMENT_REASONS = ('checkout', 'return', 'exchange', 'adjust')
+
+
+class InventoryMovement(db.Model):
+    """Append-only record of every stock change.
+
+    ``PhysicalProduct.stock`` is the materialized sum of a product's
+    movements and is kept current incrementally; ``rebuild_stock`` replays
+    the ledger to repair it.
+    """
+    __tablename__ = 'inventory_movements'
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)  # signed delta
+    reason = db.Column(db.String(20), nullable=False)
+    reference_id = db.Column(db.Integer)  # purchase/return/exchange id
+    user_id = db.Column(db.Integer)  # who made the change
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_inventory_movements_product_id', 'product_id', 'id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'product_id': self.product_id,
+            'quantity': self.quantity,
+            'reason': self.reason,
+            'reference_id': self.reference_id,
+            'user_id': self.user_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+def adjust_stock(product, quantity, reason, reference=None, user_id=None):
+    """Change a physical product's stock by ``quantity`` and record the movement.
+
+    The stock update goes through the ORM (and so through the product's
+    version check); the movement is queued on the session and written with
+    the other movements of the transaction in one batched INSERT at commit.
+    ``reference`` may be an id or a not-yet-flushed order object.
+    """
+    if not isinstance(product, PhysicalProduct) or quantity == 0:
+        return
+    if reason not in MOVEMENT_REASONS:
+        raise ValueError(f"Invalid movement reason: {reason}")
+
+    product.stock = (product.stock or 0) + quantity
+    db.session.info.setdefault('inventory_movements', []).append(
+        (product, quantity, reason, reference, user_id, datetime.utcnow())
+    )
+
+
+def set_stock(product, stock, reason='adjust', reference=None, user_id=None):
+    """Set a physical product's stock, recording the difference as a movement"""
+    if isinstance(product, PhysicalProduct):
+        adjust_stock(product, stock - (product.stock or 0), reason, reference, user_id)
+
+
+@event.listens_for(Session, 'before_commit')
+def _write_movements(session):
+    pending = session.info.pop('inventory_movements', None)
+    if not pending:
+        return
+
+    # Assign ids to new products and orders before resolving references
+    session.flush()
+    movements = [{
+        'product_id': product.id,
+        'quantity': quantity,
+        'reason': reason,
+        'reference_id': getattr(reference, 'id', reference),
+        'user_id': user_id,
+        'created_at': created_at
+    } for product, quantity, reason, reference, user_id, created_at in pending]
+    session.execute(InventoryMovement.__table__.insert(), movements)
+    publish('stock.changed', {'movements': [
+        {**movement, 'stock': product.stock, 'created_at': movement['created_at'].isoformat()}
+        for movement, (product, *_) in zip(movements, pending)
+    ]}, session=session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_movements(session):
+    session.info.pop('inventory_movements', None)
+
+
+def open_ledger():
+    """Record an opening balance for physical products that have no movements yet.
+
+    Run once when the ledger is introduced on an existing catalog. Returns
+    the number of products seeded.
+    """
+    has_movements = db.session.query(InventoryMovement.id).filter(
+        InventoryMovement.product_id == PhysicalProduct.id
+    ).exists()
+    rows = db.session.query(PhysicalProduct.id, PhysicalProduct.stock).filter(
+        ~has_movements,
+        PhysicalProduct.stock != 0
+    ).all()
+
+    now = datetime.utcnow()
+    if rows:
+        db.session.execute(InventoryMovement.__table__.insert(), [{
+            'product_id': product_id,
+            'quantity': stock,
+            'reason': 'adjust',
+            'created_at': now
+        } for product_id, stock in rows])
+    db.session.commit()
+    return len(rows)
+
+
+def rebuild_stock(dry_run=False):
+    """Replay the ledger and repair any materialized stock that drifted.
+
+    The per-product sums are computed with a single GROUP BY in the
+    database and only drifted rows are written back, in one executemany.
+    Returns {product_id: (stored_stock, ledger_stock)} for drifted products.
+    """
+    ledger_totals = db.session.query(
+        InventoryMovement.product_id,
+        db.func.sum(InventoryMovement.quantity).label('total')
+    ).group_by(InventoryMovement.product_id).subquery()
+
+    rows = db.session.query(
+        PhysicalProduct.id,
+        PhysicalProduct.stock,
+        db.func.coalesce(ledger_totals.c.total, 0)
+    ).outerjoin(
+        ledger_totals, ledger_totals.c.product_id == PhysicalProduct.id
+    ).all()
+
+    drifted = {
+        product_id: (stored or 0, int(expected))
+        for product_id, stored, expected in rows
+        if (stored or 0) != expected
+    }
+
+    if drifted and not dry_run:
+        params = [{'b_id': product_id, 'b_stock': expected}
+                  for product_id, (_, expected) in drifted.items()]
+        db.session.execute(
+            PhysicalProduct.__table__.update()
+            .where(PhysicalProduct.__table__.c.id == bindparam('b_id'))
+            .values(stock=bindparam('b_stock')),
+            params
+        )
+        # Bump versions so in-flight ORM updates of these rows fail and retry
+        db.session.execute(
+            Product.__table__.update()
+            .where(Product.__table__.c.id == bindparam('b_id'))
+            .values(version_id=Product.__table__.c.version_id + 1),
+            [{'b_id': product_id} for product_id in drifted]
+        )
+        mark_products_changed(db.session, drifted)
+        record_product_changes(db.session, drifted, 'stock')
+    db.session.commit()
+    return drifted
@@ -15,11 +15,20 @@ class Product(db.Model):
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(500))
     price = db.Column(db.Float, nullable=False)
-    type = db.Column(db.String(50))
+    type = db.Column(db.String(50), index=True)
+    # Bumped on every UPDATE; a stale read fails with StaleDataError instead of overwriting
+    version_id = db.Column(db.Integer, nullable=False)
+    # External key from the supplier feed; catalog imports update by SKU
+    sku = db.Column(db.String(64))
+
+    __table_args__ = (
+        db.Index('uq_products_sku', 'sku', unique=True),
+    )
 
     __mapper_args__ = {
         'polymorphic_identity': 'product',
-        'polymorphic_on': type
+        'polymorphic_on': type,
+        'version_id_col': version_id
     }
 
     @abstractmethod
@@ -0,0 +1,436 @@
+"""Catalog snapshot shared by every worker on a node.
+
+The snapshot is one file, normally on tmpfs (/dev/shm), holding each
+product already serialized as the JSON that GET /products/<id> returns.
+Workers map it read-only, so the catalog is held in memory once per node
+and a new worker starts with it warm instead of querying the products
+table. A read is a binary search of the index and a memoryview of the
+mapping; nothing is queried, serialized or copied per request.
+
+Layout (little endian)::
+
+    header   magic, generation, product count, data start, data end,
+             last product_changes seq applied
+    index    (product id, offset, length, version_id) per product, sorted by id
+    data     the product JSON documents in id order, separated by commas
+
+so the data region is also the body of the GET /products listing.
+
+Changes since the snapshot was written go to a delta file next to it
+(``<path>.delta``) in the same layout, holding only the changed products
+and a zero length entry for each deleted one. Its generation is that of
+the snapshot it applies to, and readers look products up in the delta
+before the snapshot. The delta is small, so keeping it current is cheap;
+once it holds ``delta_limit`` products it is merged into a new snapshot.
+
+Writes replace files atomically and readers pick the new files up on
+their next request. One refresher per node (``CatalogRefresher``) keeps
+them current: it tails the product change log from the seq recorded in
+the delta (or the snapshot), rewrites the delta once per batch of
+changes, and rebuilds the snapshot from scratch now and then to catch
+changes made behind the ORM.
+"""
+from threading import Lock, Thread
+import json
+import mmap
+import os
+import struct
+import time
+from flask import current_app
+from sqlalchemy.orm import Session, with_polymorphic
+from db import db
+from product.product import Product
+from product.changes import ProductChange
+from utils.logger import product_logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAGIC = b'CATSNAP2'
+HEADER = struct.Struct('<8sQIQQQ')
+ENTRY = struct.Struct('<qQII')
+
+
+def product_document(product):
+    """The GET /products/<id> body for ``product``, as bytes"""
+    return json.dumps({
+        'id': product.id,
+        'name': product.name,
+        'description': product.description,
+        'price': product.price,
+        'type': product.type,
+        'details': product.get_details()
+    }, sort_keys=True, separators=(',', ':')).encode()
+
+
+def write_snapshot(path, documents, generation, seq=0):
+    """Atomically write ``documents`` ({product_id: (version_id, bytes)}) to ``path``.
+
+    ``seq`` is the last product change the documents include. A document
+    of None records a deleted product, which only deltas hold.
+    """
+    ids = sorted(documents)
+    data_start = HEADER.size + ENTRY.size * len(ids)
+    entries, chunks, offset = [], [], data_start
+    for product_id in ids:
+        if documents[product_id] is None:
+            entries.append(ENTRY.pack(product_id, 0, 0, 0))
+            continue
+        version_id, document = documents[product_id]
+        if chunks:
+            chunks.append(b',')
+            offset += 1
+        entries.append(ENTRY.pack(product_id, offset, len(document), version_id))
+        chunks.append(document)
+        offset += len(document)
+
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, generation, len(ids), data_start, offset, seq))
+        out.writelines(entries)
+        out.writelines(chunks)
+    os.replace(temporary, path)
+
+
+class CatalogSnapshot:
+    """Read-only view of one snapshot or delta file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            self.stat = os.fstat(snapshot_file.fileno())
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        magic, self.generation, self.count, self._data_start, self._data_end, self.seq = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, position):
+        return ENTRY.unpack_from(self._map, HEADER.size + position * ENTRY.size)
+
+    def _search(self, product_id):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < product_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find(self, product_id):
+        position = self._search(product_id)
+        if position < self.count:
+            entry = self._entry(position)
+            if entry[0] == product_id:
+                return entry
+        return None
+
+    def _span(self, start, end):
+        """The data, commas included, of the entries at positions ``start`` to ``end`` - 1"""
+        first = self._entry(start)
+        last = self._entry(end - 1)
+        return self._view[first[1]:last[1] + last[2]]
+
+    def _document(self, entry):
+        _, offset, length, version_id = entry
+        if not length:
+            return None
+        return self._view[offset:offset + length], version_id
+
+    def get(self, product_id):
+        """(document memoryview, version_id) for a product, or None if it is not in the snapshot"""
+        entry = self._find(product_id)
+        return self._document(entry) if entry is not None else None
+
+    def listing(self):
+        """All product documents as the comma separated body of a JSON array"""
+        return self._view[self._data_start:self._data_end]
+
+    def documents(self):
+        """{product_id: (version_id, memoryview)} for every product, None for a deleted one"""
+        documents = {}
+        for position in range(self.count):
+            product_id, offset, length, version_id = self._entry(position)
+            documents[product_id] = (version_id, self._view[offset:offset + length]) if length else None
+        return documents
+
+
+class CatalogView:
+    """A snapshot with its delta, if there is one, applied"""
+
+    def __init__(self, snapshot, delta=None, key=None):
+        self.snapshot = snapshot
+        self.delta = delta
+        self.key = key
+        self.generation = snapshot.generation
+        self.seq = delta.seq if delta is not None else snapshot.seq
+        self._listing = None
+
+    def get(self, product_id):
+        """(document memoryview, version_id) for a product, or None if it is not in the catalog"""
+        if self.delta is not None:
+            entry = self.delta._find(product_id)
+            if entry is not None:
+                return self.delta._document(entry)
+        return self.snapshot.get(product_id)
+
+    def listing(self):
+        """All product documents as the comma separated body of a JSON array.
+
+        Without a delta this is the snapshot's data region itself. With one,
+        the unchanged runs of the snapshot and the changed documents are
+        joined once per delta and kept for the following requests.
+        """
+        if self.delta is None:
+            return self.snapshot.listing()
+        if self._listing is None:
+            snapshot, delta = self.snapshot, self.delta
+            pieces, position = [], 0
+            for delta_position in range(delta.count):
+                entry = delta._entry(delta_position)
+                split = snapshot._search(entry[0])
+                if split > position:
+                    pieces.append(snapshot._span(position, split))
+                position = split
+                if split < snapshot.count and snapshot._entry(split)[0] == entry[0]:
+                    position += 1
+                document = delta._document(entry)
+                if document is not None:
+                    pieces.append(document[0])
+            if position < snapshot.count:
+                pieces.append(snapshot._span(position, snapshot.count))
+            self._listing = b','.join(pieces)
+        return self._listing
+
+
+class CatalogStore:
+    """A worker's handle on the node's catalog snapshot at ``path``, and its delta"""
+
+    def __init__(self, path, delta_limit=1000):
+        self.path = path
+        self.delta_path = f'{path}.delta'
+        self.delta_limit = delta_limit
+        self._lock = Lock()
+        self._view = None
+
+    def current(self):
+        """The latest snapshot with its delta, building it first if there is none yet.
+
+        Returns None if the snapshot cannot be read or built, and callers
+        fall back to the database.
+        """
+        # The delta is looked at first: a merge writes the new snapshot
+        # before removing the delta, so a delta seen here is never newer
+        # than the snapshot read after it
+        delta_stat = _file_key(self.delta_path)
+        snapshot_stat = _file_key(self.path)
+        if snapshot_stat is None:
+            return self.rebuild(only_if_missing=True)
+
+        view = self._view
+        if view is not None and view.key == (snapshot_stat, delta_stat):
+            return view
+        with self._lock:
+            try:
+                delta = self._read_delta(None)
+                snapshot = view.snapshot if view is not None and _key(view.snapshot.stat) == snapshot_stat else None
+                # The previous mappings are released once no request is using them
+                snapshot = snapshot or CatalogSnapshot(self.path)
+                if delta is not None and delta.generation != snapshot.generation:
+                    delta = None
+                self._view = CatalogView(snapshot, delta, key=(snapshot_stat, delta_stat))
+            except (OSError, ValueError) as e:
+                product_logger.error(f"Could not map catalog snapshot: {str(e)}")
+                self._view = None
+            return self._view
+
+    def _locked(self):
+        lock_file = open(f'{self.path}.lock', 'a')
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _read(self):
+        try:
+            return CatalogSnapshot(self.path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _read_delta(self, snapshot):
+        """The delta, or None if there is none for ``snapshot`` (any snapshot if None)"""
+        try:
+            delta = CatalogSnapshot(self.delta_path)
+        except (FileNotFoundError, ValueError):
+            return None
+        if snapshot is not None and delta.generation != snapshot.generation:
+            return None
+        return delta
+
+    def _write(self, documents, generation, seq):
+        write_snapshot(self.path, documents, generation, seq)
+        # Readers ignore a delta left from an older generation, so a
+        # failure here only leaves a stale file behind
+        try:
+            os.remove(self.delta_path)
+        except FileNotFoundError:
+            pass
+
+    def _build(self, existing):
+        with Session(db.engine) as session:
+            # Taken before the products are read, so a change committed in
+            # between is applied again by the next refresh rather than missed
+            seq = session.query(db.func.max(ProductChange.seq)).scalar() or 0
+            products = session.query(with_polymorphic(Product, '*')).all()
+            documents = {product.id: (product.version_id, product_document(product)) for product in products}
+        generation = existing.generation + 1 if existing else 1
+        self._write(documents, generation, seq)
+        product_logger.info(f"Built catalog snapshot {generation} with {len(documents)} products")
+
+    def rebuild(self, only_if_missing=False):
+        """Write a snapshot of the whole catalog and return it"""
+        try:
+            with self._locked():
+                # Another worker may have built it while we waited for the lock
+                existing = self._read()
+                if only_if_missing and existing is not None:
+                    return self.current()
+                self._build(existing)
+        except Exception as e:
+            product_logger.error(f"Catalog snapshot build failed: {str(e)}")
+            return None
+        return self.current()
+
+    def refresh(self, batch_size=1000):
+        """Apply up to ``batch_size`` product changes newer than the snapshot and its delta.
+
+        The changed products are re-read and the delta is rewritten once
+        for the whole batch; deleted products are recorded in it as such.
+        Once the delta holds ``delta_limit`` products it is merged into a
+        new snapshot. Builds the snapshot if there is none. Returns the
+        number of changes applied.
+        """
+        with self._locked():
+            existing = self._read()
+            if existing is None:
+                self._build(None)
+                return 0
+            delta = self._read_delta(existing)
+            products = with_polymorphic(Product, '*')
+            with Session(db.engine) as session:
+                changes = session.query(ProductChange.seq, ProductChange.product_id).filter(
+                    ProductChange.seq > (delta or existing).seq
+                ).order_by(ProductChange.seq).limit(batch_size).all()
+                if not changes:
+                    return 0
+                product_ids = {change.product_id for change in changes}
+                changed = delta.documents() if delta is not None else {}
+                changed.update(dict.fromkeys(product_ids))
+                for product in session.query(products).filter(products.id.in_(product_ids)):
+                    changed[product.id] = (product.version_id, product_document(product))
+            seq = changes[-1].seq
+            if len(changed) < self.delta_limit:
+                write_snapshot(self.delta_path, changed, existing.generation, seq)
+                return len(changes)
+
+            documents = existing.documents()
+            for product_id, document in changed.items():
+                if document is None:
+                    documents.pop(product_id, None)
+                else:
+                    documents[product_id] = document
+            self._write(documents, existing.generation + 1, seq)
+            product_logger.info(f"Merged {len(changed)} changed products into catalog snapshot {existing.generation + 1}")
+        return len(changes)
+
+
+class CatalogRefresher:
+    """Keeps a node's catalog snapshot current, off the request path.
+
+    Every worker may start one, but they take turns on a lock file: one
+    refreshes and the others wait to take over if its process exits. Each
+    round applies the new product changes in batches of ``batch_size``
+    and every ``rebuild_interval`` seconds the snapshot is rebuilt.
+    """
+
+    def __init__(self, app, store, interval=1.0, rebuild_interval=3600, batch_size=1000):
+        self.app = app
+        self.store = store
+        self.interval = interval
+        self.rebuild_interval = rebuild_interval
+        self.batch_size = batch_size
+        self._rebuilt_at = time.monotonic()
+
+    def refresh_once(self):
+        """One round of refreshing. Returns the number of changes applied"""
+        if time.monotonic() - self._rebuilt_at >= self.rebuild_interval:
+            self._rebuilt_at = time.monotonic()
+            self.store.rebuild()
+        applied = total = self.store.refresh(self.batch_size)
+        while applied == self.batch_size:
+            applied = self.store.refresh(self.batch_size)
+            total += applied
+        return total
+
+    def run(self, should_stop=lambda: False):
+        """Refresh every ``interval`` seconds once this process holds the refresher lock"""
+        with open(f'{self.store.path}.refresher', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            product_logger.info(f"Refreshing catalog snapshot {self.store.path} in process {os.getpid()}")
+            with self.app.app_context():
+                while not should_stop():
+                    try:
+                        self.refresh_once()
+                    except Exception as e:
+                        product_logger.error(f"Catalog snapshot refresh failed: {str(e)}")
+                    finally:
+                        db.session.remove()
+                    time.sleep(self.interval)
+
+
+def _key(stat):
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _file_key(path):
+    try:
+        return _key(os.stat(path))
+    except FileNotFoundError:
+        return None
+
+
+def start_catalog_refresher(app):
+    """Start a refresher thread for the app's snapshot, if it has one"""
+    store = get_catalog(app)
+    if store is None:
+        return None
+    refresher = CatalogRefresher(
+        app, store,
+        interval=app.config.get('CATALOG_REFRESH_INTERVAL', 1.0),
+        rebuild_interval=app.config.get('CATALOG_REBUILD_INTERVAL', 3600)
+    )
+    Thread(target=refresher.run, name='catalog-refresher', daemon=True).start()
+    return refresher
+
+
+def get_catalog(app=None):
+    """The app's catalog snapshot store, or None unless CATALOG_SNAPSHOT_PATH is set"""
+    app = app or current_app
+    path = app.config.get('CATALOG_SNAPSHOT_PATH')
+    if not path:
+        return None
+    store = app.extensions.get('catalog_snapshot')
+    if store is None or store.path != path:
+        store = app.extensions['catalog_snapshot'] = CatalogStore(
+            path, delta_limit=app.config.get('CATALOG_DELTA_LIMIT', 1000)
+        )
+    return store
+
+
+def reset_catalog(app=None):
+    (app or current_app).extensions.pop('catalog_snapshot', None)
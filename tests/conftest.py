@@ -11,18 +11,49 @@ from db import db, init_db
 from sqlalchemy import text
 from main import app as flask_app
 from product import ProductFactory
+from orders.pending import pending_counter
+from orders.cart import cart_summary_cache
+from orders.cart_store import reset_cart_store
+from utils.idempotency import reset_store
+from utils.replicas import reset_replicas
+from product.snapshot import reset_catalog
+from product.catalog_index import catalog_index
 
 @pytest.fixture
 def app():
     flask_app.config['TESTING'] = True
     flask_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
     flask_app.config['SECRET_KEY'] = 'test-secret-key'
+    flask_app.config['IDEMPOTENCY_BACKEND'] = 'local'
     
     with flask_app.app_context():
         db.create_all()
         yield flask_app
         db.session.remove()
         db.drop_all()
+        pending_counter.reset()
+        cart_summary_cache.clear()
+        reset_cart_store(flask_app)
+        catalog_index.reset()
+        reset_store(flask_app)
+        reset_replicas(flask_app)
+        reset_catalog(flask_app)
+
+@pytest.fixture
+def postgres_app(app):
+    """``app`` on the PostgreSQL database in TEST_POSTGRES_URL, skipped when unset"""
+    url = os.getenv('TEST_POSTGRES_URL')
+    if not url:
+        pytest.skip('TEST_POSTGRES_URL is not set')
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    yield app
+    db.session.remove()
+    with db.engine.begin() as connection:
+        connection.execute(text('DROP SCHEMA IF EXISTS archive CASCADE'))
+    db.drop_all()
 
 @pytest.fixture
 def client(app):
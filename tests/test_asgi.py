@@ -0,0 +1,74 @@
+import asyncio
+import json
+import pytest
+from sqlalchemy import create_engine
+from db import db
+from asgi import AsyncApp, async_database_url
+
+
+def test_async_database_url():
+    url, connect_args = async_database_url('postgresql+psycopg2://u:p@db:5432/shop?sslmode=require')
+    assert url.drivername == 'postgresql+asyncpg'
+    assert 'sslmode' not in url.query
+    assert connect_args == {'ssl': 'require'}
+
+    url, connect_args = async_database_url('sqlite:///shop.db')
+    assert url.drivername == 'sqlite+aiosqlite'
+
+
+def request(asgi_app, path, query_string=b''):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        await asgi_app({'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string},
+                       receive, send)
+        await asgi_app.engine.dispose()
+
+    asyncio.run(run())
+    return messages[0]['status'], json.loads(messages[1]['body'])
+
+
+def test_native_catalog_routes(app, tmp_path):
+    pytest.importorskip('aiosqlite')
+    url = f'sqlite:///{tmp_path}/shop.db'
+    engine = create_engine(url)
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(db.text(
+            "INSERT INTO products (id, name, price, type, version_id) VALUES (1, 'Lamp', 10, 'physical', 3)"
+        ))
+        connection.execute(db.text("INSERT INTO physical_products (id, weight, stock) VALUES (1, 2, 5)"))
+    engine.dispose()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    try:
+        status, body = request(AsyncApp(app), '/products')
+        assert status == 200
+        assert body['products'][0]['details'] == {'weight': 2, 'stock': 5}
+
+        status, body = request(AsyncApp(app), '/products/search', b'q=lam')
+        assert body['message'] == 'Found 1 products'
+
+        status, body = request(AsyncApp(app), '/products/2')
+        assert status == 404
+    finally:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+
+
+def test_browse_parameters_go_to_flask(app):
+    asgi_app = AsyncApp(app)
+    delegated = []
+
+    async def wsgi(scope, receive, send):
+        delegated.append(scope['query_string'])
+
+    asgi_app.wsgi = wsgi
+    scope = {'type': 'http', 'method': 'GET', 'path': '/products', 'query_string': b'min_price=5&sort=price'}
+    asyncio.run(asgi_app(scope, None, None))
+    assert delegated == [b'min_price=5&sort=price']
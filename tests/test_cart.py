@@ -96,4 +96,125 @@ def test_clear_cart(client, app, test_product):
     )
     assert response.status_code == 200
     data = json.loads(response.data)
-    assert 'message' in data 
\ No newline at end of file
+    assert 'message' in data 
+
+
+def test_get_cart_uses_current_product_info(client, admin_token, test_product, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'CART_SUMMARY_CACHE_TTL', 30)
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    client.post('/cart/add',
+        json={'product_id': test_product['id'], 'quantity': 2},
+        headers=headers
+    )
+    data = json.loads(client.get('/cart', headers=headers).data)
+    assert data['items'][0]['name'] == 'Test Product'
+    assert data['items'][0]['stock_status'] == 'in_stock'
+    assert data['total'] == pytest.approx(199.98)
+
+    # Price and stock changes show up in the (cached) summary
+    client.put(f"/products/{test_product['id']}",
+        json={'price': 50.0, 'stock': 1},
+        headers=headers
+    )
+    data = json.loads(client.get('/cart', headers=headers).data)
+    assert data['items'][0]['price'] == 50.0
+    assert data['items'][0]['stock_status'] == 'insufficient_stock'
+    assert data['total'] == pytest.approx(100.0)
+
+def test_add_to_cart_merges_lines(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    for quantity in (2, 3):
+        response = client.post('/cart/add',
+            json={'product_id': test_product['id'], 'quantity': quantity},
+            headers=headers
+        )
+        assert response.status_code == 201
+    assert json.loads(response.data)['cart_item']['quantity'] == 5
+
+    data = json.loads(client.get('/cart', headers=headers).data)
+    assert len(data['items']) == 1
+
+    # The merged quantity is checked against stock
+    response = client.post('/cart/add',
+        json={'product_id': test_product['id'], 'quantity': 6},
+        headers=headers
+    )
+    assert response.status_code == 400
+    data = json.loads(client.get('/cart', headers=headers).data)
+    assert data['items'][0]['quantity'] == 5
+
+def test_compact_cart_merges_duplicates(app, runner, test_product):
+    from db import db
+    from orders.cart import Cart
+
+    db.session.execute(db.text('DROP INDEX uq_cart_items_user_product_in_cart'))
+    for _ in range(3):
+        db.session.add(Cart(user_id=1, product_id=test_product['id'], quantity=1, total_price=99.99))
+    db.session.commit()
+
+    result = runner.invoke(args=['compact-cart'])
+    assert 'removed 2 rows' in result.output
+    lines = Cart.query.all()
+    assert len(lines) == 1
+    assert lines[0].quantity == 3
+    assert lines[0].total_price == pytest.approx(299.97)
+
+def test_bulk_update_cart(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    response = client.post('/cart/bulk',
+        json={'items': [
+            {'product_id': test_product['id'], 'quantity': 2},
+            {'product_id': test_product['id'], 'quantity': 1},
+            {'product_id': 9999, 'quantity': 1},
+            {'product_id': test_product['id'], 'quantity': 50, 'action': 'set'}
+        ]},
+        headers=headers
+    )
+    assert response.status_code == 200
+    results = json.loads(response.data)['results']
+    assert [r['status'] for r in results] == ['ok', 'ok', 'error', 'error']
+    assert results[1]['quantity'] == 3
+    assert results[2]['error'] == 'Product not found'
+
+    data = json.loads(client.get('/cart', headers=headers).data)
+    assert [(i['product_id'], i['quantity']) for i in data['items']] == [(test_product['id'], 3)]
+
+    response = client.post('/cart/bulk',
+        json={'items': [{'product_id': test_product['id'], 'action': 'remove'}]},
+        headers=headers
+    )
+    assert response.status_code == 200
+    assert json.loads(client.get('/cart', headers=headers).data)['items'] == []
+
+    response = client.post('/cart/bulk',
+        json={'items': [
+            {'product_id': test_product['id'], 'quantity': True},
+            {'product_id': [test_product['id']], 'quantity': 1},
+            {'product_id': {'id': 1}, 'quantity': 1}
+        ]},
+        headers=headers
+    )
+    assert response.status_code == 400
+    assert [r['error'] for r in json.loads(response.data)['results']] == [
+        'Quantity must be a positive integer',
+        'Product ID must be an integer',
+        'Product ID must be an integer'
+    ]
+
+def test_sweep_carts(app, runner, test_product):
+    from datetime import datetime, timedelta
+    from db import db
+    from orders.cart import Cart
+
+    old = datetime.utcnow() - timedelta(days=45)
+    db.session.add_all([
+        Cart(user_id=1, product_id=test_product['id'], total_price=1, status='completed'),
+        Cart(user_id=1, product_id=test_product['id'], total_price=1, status='completed'),
+        Cart(user_id=2, product_id=test_product['id'], total_price=1, created_at=old),
+        Cart(user_id=3, product_id=test_product['id'], total_price=1)
+    ])
+    db.session.commit()
+
+    result = runner.invoke(args=['sweep-carts', '--days', '30', '--batch-size', '1'])
+    assert 'Reclaimed 3 cart rows (2 completed, 1 abandoned)' in result.output
+    assert [line.user_id for line in Cart.query.all()] == [3]
@@ -0,0 +1,149 @@
+import json
+import os
+import pytest
+from orders.cart import Cart
+from orders.cart_store import LocalCartKV, RedisCartKV, WriteBehindCartStore, get_cart_store, reset_cart_store
+
+
+@pytest.fixture
+def write_behind(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'CART_BACKEND', 'write_behind')
+    monkeypatch.setitem(app.config, 'CART_FLUSH_INTERVAL', 0)
+    return get_cart_store(app)
+
+
+def cart(client, headers):
+    return json.loads(client.get('/cart', headers=headers).data)
+
+
+def test_cart_lines_stay_out_of_the_database_until_flushed(client, admin_token, test_product, write_behind):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    response = client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 2}, headers=headers)
+    assert response.status_code == 201
+    assert json.loads(response.data)['cart_item']['quantity'] == 2
+    client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 1}, headers=headers)
+    assert client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 8},
+                       headers=headers).status_code == 400
+    assert Cart.query.count() == 0
+
+    summary = cart(client, headers)
+    assert [(item['id'], item['quantity'], item['stock_status']) for item in summary['items']] == [(None, 3, 'in_stock')]
+    assert summary['total'] == pytest.approx(3 * 99.99)
+
+    assert write_behind.flush() == 1
+    assert write_behind.flush() == 0
+    row = Cart.query.one()
+    assert (row.quantity, row.total_price) == (3, pytest.approx(3 * 99.99))
+    assert cart(client, headers)['items'][0]['id'] == row.id
+
+    assert client.delete('/cart/clear', headers=headers).status_code == 200
+    assert cart(client, headers)['items'] == []
+    write_behind.flush()
+    assert Cart.query.count() == 0
+
+
+def test_checkout_persists_the_cart(client, admin_token, test_product, write_behind):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    client.post('/cart/bulk', json={'items': [
+        {'product_id': test_product['id'], 'quantity': 4, 'action': 'set'},
+        {'product_id': 999, 'quantity': 1}
+    ]}, headers=headers)
+
+    response = client.post('/cart/complete', headers=headers)
+    assert response.status_code == 200
+    order = json.loads(client.get('/orders', headers=headers).data)['orders'][0]
+    assert order['id'] == json.loads(response.data)['order_id']
+    assert order['lines'][0]['quantity'] == 4
+    assert cart(client, headers)['items'] == []
+    assert Cart.query.count() == 0
+    assert client.post('/cart/complete', headers=headers).status_code == 400
+
+
+def test_failed_checkout_keeps_the_cart(client, admin_token, test_product, write_behind, monkeypatch):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 2}, headers=headers)
+
+    def unavailable(*args, **kwargs):
+        raise RuntimeError('outbox unavailable')
+    monkeypatch.setattr('main.publish', unavailable)
+    assert client.post('/cart/complete', headers=headers).status_code == 500
+    assert [item['quantity'] for item in cart(client, headers)['items']] == [2]
+
+    monkeypatch.undo()
+    monkeypatch.setitem(client.application.config, 'CART_BACKEND', 'write_behind')
+    assert client.post('/cart/complete', headers=headers).status_code == 200
+
+
+def test_saved_carts_survive_a_switch_and_a_restart(client, app, admin_token, test_product, monkeypatch):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    other = json.loads(client.post('/products', json={
+        'name': 'Other', 'price': 5, 'product_type': 'digital', 'download_link': 'http://example.com/o'
+    }, headers=headers).data)
+    # Saved under the database backend
+    client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 2}, headers=headers)
+
+    monkeypatch.setitem(app.config, 'CART_BACKEND', 'write_behind')
+    monkeypatch.setitem(app.config, 'CART_FLUSH_INTERVAL', 0)
+    assert [item['quantity'] for item in cart(client, headers)['items']] == [2]
+    client.post('/cart/add', json={'product_id': other['id'], 'quantity': 1}, headers=headers)
+    get_cart_store(app).flush()
+    assert sorted((row.product_id, row.quantity) for row in Cart.query) == [
+        (test_product['id'], 2), (other['id'], 1)
+    ]
+
+    # A new process starts with an empty store and loads the cart again
+    reset_cart_store(app)
+    client.post('/cart/add', json={'product_id': other['id'], 'quantity': 1}, headers=headers)
+    assert [item['quantity'] for item in cart(client, headers)['items']] == [2, 2]
+    get_cart_store(app).flush()
+    assert sorted((row.product_id, row.quantity) for row in Cart.query) == [
+        (test_product['id'], 2), (other['id'], 2)
+    ]
+
+    # A cart that vanished before it was flushed leaves the saved rows alone
+    store = get_cart_store(app)
+    store.kv._carts.clear()
+    store.kv._dirty.add(1)
+    store.flush()
+    assert Cart.query.count() == 2
+
+
+def test_flush_keeps_carts_dirty_until_written(app, test_product, monkeypatch):
+    kv = LocalCartKV()
+    store = WriteBehindCartStore(kv)
+    kv.update(1, lambda lines: lines.update({str(test_product['id']): {
+        'quantity': 1, 'total_price': 99.99, 'created_at': '2024-01-01T00:00:00'
+    }}))
+
+    # A failed write leaves the cart for the next flush
+    monkeypatch.setattr(store, '_write_lines', lambda *args: 1 / 0)
+    assert store.flush() == 0
+    assert kv.dirty() == [1]
+    monkeypatch.undo()
+
+    # A change made while the flush ran is not marked clean
+    version, _ = kv.get(1)
+    kv.update(1, lambda lines: lines[str(test_product['id'])].update(quantity=2))
+    assert kv.mark_flushed(1, version) is False
+    assert store.flush() == 1
+    assert kv.dirty() == []
+    assert Cart.query.one().quantity == 2
+
+
+def test_redis_kv():
+    url = os.getenv('TEST_REDIS_URL')
+    if not url:
+        pytest.skip('TEST_REDIS_URL is not set')
+    pytest.importorskip('redis')
+
+    kv = RedisCartKV(url)
+    kv.client.delete(kv._key(-1))
+    kv.client.srem(kv.DIRTY, -1)
+    assert kv.update(-1, lambda lines: lines.update({'1': {'quantity': 1}})) is None
+    version, lines = kv.get(-1)
+    assert (version, lines) == (1, {'1': {'quantity': 1}})
+    assert -1 in kv.dirty(None)
+    assert kv.mark_flushed(-1, version) is True
+    kv.update(-1, lambda lines: lines.clear())
+    assert kv.mark_flushed(-1, version + 1) is True
+    assert kv.client.get(kv._key(-1)) is None
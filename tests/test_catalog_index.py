@@ -0,0 +1,89 @@
+import json
+from datetime import datetime
+import pytest
+import product.catalog_index as catalog_index_module
+from db import db
+from product import Product
+from product.catalog_index import catalog_index
+from product.changes import ProductChange
+
+
+@pytest.fixture(params=['array', 'numpy'])
+def backend(request, monkeypatch):
+    if request.param == 'numpy':
+        monkeypatch.setattr(catalog_index_module, 'numpy', pytest.importorskip('numpy'))
+    else:
+        monkeypatch.setattr(catalog_index_module, 'numpy', None)
+    return request.param
+
+
+@pytest.fixture
+def catalog(client, admin_token):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    products = [
+        {'name': 'Desk', 'price': 150, 'product_type': 'physical', 'weight': 20, 'stock': 3},
+        {'name': 'Lamp', 'price': 30, 'product_type': 'physical', 'weight': 2, 'stock': 0},
+        {'name': 'Manual', 'price': 10, 'product_type': 'digital', 'file_size': 1, 'download_link': 'x'},
+        {'name': 'Chair', 'price': 80, 'product_type': 'physical', 'weight': 8, 'stock': 5},
+        {'name': 'Course', 'price': 80, 'product_type': 'digital', 'file_size': 900, 'download_link': 'y'},
+    ]
+    ids = {}
+    for product in products:
+        response = client.post('/products', json=product, headers=headers)
+        assert response.status_code == 201
+        ids[product['name']] = json.loads(response.data)['id']
+    return ids
+
+
+def browse(client, query):
+    response = client.get(f'/products?{query}')
+    assert response.status_code == 200
+    return json.loads(response.data)
+
+
+def test_filter_and_sort(client, backend, catalog):
+    data = browse(client, 'sort=price')
+    assert [product['name'] for product in data['products']] == ['Manual', 'Lamp', 'Chair', 'Course', 'Desk']
+    assert data['total'] == 5
+
+    data = browse(client, 'min_price=20&max_price=100&sort=-price')
+    assert [product['name'] for product in data['products']] == ['Chair', 'Course', 'Lamp']
+
+    data = browse(client, 'type=physical&in_stock=true&sort=price')
+    assert [product['name'] for product in data['products']] == ['Chair', 'Desk']
+
+    data = browse(client, 'sort=price&page=2&per_page=2')
+    assert [product['name'] for product in data['products']] == ['Chair', 'Course']
+    assert (data['total'], data['page'], data['per_page']) == (5, 2, 2)
+
+    assert client.get('/products?type=service').status_code == 400
+    assert client.get('/products?sort=name').status_code == 400
+
+
+def test_index_follows_product_writes(client, admin_token, backend, catalog):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    assert browse(client, 'in_stock=true')['total'] == 4
+
+    client.put(f"/products/{catalog['Lamp']}", json={'price': 200, 'stock': 4}, headers=headers)
+    client.delete(f"/products/{catalog['Desk']}", headers=headers)
+    client.post('/products', json={
+        'name': 'Ebook', 'price': 5, 'product_type': 'digital', 'file_size': 2, 'download_link': 'z'
+    }, headers=headers)
+
+    data = browse(client, 'in_stock=true&sort=-price')
+    assert [product['name'] for product in data['products']] == ['Lamp', 'Chair', 'Course', 'Manual', 'Ebook']
+    assert data['products'][0]['price'] == 200
+
+
+def test_index_applies_changes_from_other_workers(app, client, backend, catalog):
+    assert browse(client, 'type=digital&sort=price')['total'] == 2
+    # Another worker changes a price; only the change log tells this one about it
+    db.session.execute(Product.__table__.update().where(Product.id == catalog['Manual']).values(price=500))
+    db.session.execute(ProductChange.__table__.insert().values(
+        product_id=catalog['Manual'], operation='update', created_at=datetime.utcnow()
+    ))
+    db.session.commit()
+
+    catalog_index._polled_at = 0.0
+    data = browse(client, 'type=digital&sort=-price')
+    assert [product['name'] for product in data['products']] == ['Manual', 'Course']
@@ -0,0 +1,140 @@
+import json
+import os
+import pytest
+from db import db
+from product import Product
+from product.snapshot import CatalogSnapshot, CatalogStore, CatalogRefresher, CatalogView, get_catalog, write_snapshot
+
+
+@pytest.fixture
+def snapshot_path(app, tmp_path):
+    path = str(tmp_path / 'catalog.snapshot')
+    app.config['CATALOG_SNAPSHOT_PATH'] = path
+    yield path
+    app.config['CATALOG_SNAPSHOT_PATH'] = None
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'catalog.snapshot')
+    documents = {id: (id * 10, json.dumps({'id': id}).encode()) for id in (7, 3, 12)}
+    write_snapshot(path, documents, generation=4, seq=17)
+
+    snapshot = CatalogSnapshot(path)
+    assert (snapshot.generation, len(snapshot), snapshot.seq) == (4, 3, 17)
+    assert snapshot.get(12) == (b'{"id": 12}', 120)
+    assert snapshot.get(5) is None
+    assert snapshot.get(99) is None
+    assert json.loads(b'[' + snapshot.listing() + b']') == [{'id': 3}, {'id': 7}, {'id': 12}]
+    assert isinstance(snapshot.get(12)[0], memoryview)
+
+
+def test_delta_applied_over_snapshot(tmp_path):
+    path = str(tmp_path / 'catalog.snapshot')
+    write_snapshot(path, {id: (1, json.dumps({'id': id}).encode()) for id in (1, 2, 3, 4, 5)}, generation=1, seq=10)
+    write_snapshot(f'{path}.delta', {
+        0: (1, b'{"id": 0}'), 2: None, 3: (2, b'{"id": 3, "new": true}'), 4: None, 9: (1, b'{"id": 9}')
+    }, generation=1, seq=12)
+
+    view = CatalogStore(path).current()
+    assert (view.generation, view.seq) == (1, 12)
+    assert view.get(3) == (b'{"id": 3, "new": true}', 2)
+    assert view.get(2) is None
+    assert view.get(1) == (b'{"id": 1}', 1)
+    assert json.loads(b'[' + view.listing() + b']') == [
+        {'id': 0}, {'id': 1}, {'id': 3, 'new': True}, {'id': 5}, {'id': 9}
+    ]
+    snapshot = CatalogSnapshot(path)
+    assert CatalogView(snapshot, CatalogSnapshot(f'{path}.delta')).listing() == view.listing()
+
+    # A delta left from an older snapshot is ignored
+    write_snapshot(path, {1: (1, b'{"id": 1}')}, generation=2, seq=12)
+    view = CatalogStore(path).current()
+    assert view.get(0) is None
+    assert view.listing() == b'{"id": 1}'
+
+
+def test_reads_served_from_snapshot(client, snapshot_path, test_product):
+    from_db = json.loads(client.get(f"/products/{test_product['id']}").data)
+
+    # Changes that bypass the ORM are not seen until the snapshot is rebuilt
+    db.session.execute(Product.__table__.update().values(name='Changed behind the cache'))
+    db.session.commit()
+
+    response = client.get(f"/products/{test_product['id']}")
+    assert response.status_code == 200
+    assert json.loads(response.data) == from_db
+    assert response.headers['ETag'] == '"1"'
+    listing = json.loads(client.get('/products').data)
+    assert listing['products'] == [from_db]
+
+
+def test_refresher_applies_product_changes(client, app, admin_token, snapshot_path, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    assert client.get('/products').status_code == 200
+
+    # Another worker on the node maps the same file
+    other_worker = CatalogStore(snapshot_path)
+    generation = other_worker.current().generation
+    refresher = CatalogRefresher(app, get_catalog(app), batch_size=2)
+    assert refresher.refresh_once() == 0
+
+    # Commits leave the files alone; checkouts and edits reach the delta in one rewrite per batch
+    for _ in range(3):
+        client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 1}, headers=headers)
+        client.post('/cart/complete', headers=headers)
+    response = client.put(f"/products/{test_product['id']}", json={'price': 42.5}, headers=headers)
+    assert response.status_code == 200
+    assert other_worker.current().generation == generation
+
+    inode = os.stat(snapshot_path).st_ino
+    assert refresher.refresh_once() == 4
+    snapshot = other_worker.current()
+    assert snapshot.generation == generation
+    assert os.stat(snapshot_path).st_ino == inode
+    body, version_id = snapshot.get(test_product['id'])
+    assert json.loads(bytes(body))['price'] == 42.5
+    assert json.loads(bytes(body))['details']['stock'] == 7
+    assert version_id == 5
+    assert json.loads(client.get('/products').data)['products'][0]['price'] == 42.5
+
+    extra = json.loads(client.post('/products', json={
+        'name': 'Extra', 'price': 5, 'product_type': 'digital', 'download_link': 'http://example.com/x'
+    }, headers=headers).data)
+    refresher.refresh_once()
+    assert other_worker.current().get(extra['id']) is not None
+    assert client.delete(f"/products/{extra['id']}", headers=headers).status_code == 200
+    refresher.refresh_once()
+    assert other_worker.current().get(extra['id']) is None
+    assert [product['id'] for product in json.loads(client.get('/products').data)['products']] == [test_product['id']]
+
+
+def test_refresh_merges_a_full_delta(client, app, admin_token, snapshot_path, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    store = CatalogStore(snapshot_path, delta_limit=2)
+    generation = store.current().generation
+
+    client.put(f"/products/{test_product['id']}", json={'price': 42.5}, headers=headers)
+    assert store.refresh() == 1
+    assert os.path.exists(f'{snapshot_path}.delta')
+    assert store.current().generation == generation
+
+    extra = json.loads(client.post('/products', json={
+        'name': 'Extra', 'price': 5, 'product_type': 'digital', 'download_link': 'http://example.com/x'
+    }, headers=headers).data)
+    assert store.refresh() == 1
+    assert not os.path.exists(f'{snapshot_path}.delta')
+    snapshot = store.current()
+    assert snapshot.generation == generation + 1
+    assert snapshot.delta is None
+    assert json.loads(bytes(snapshot.get(test_product['id'])[0]))['price'] == 42.5
+    assert snapshot.get(extra['id']) is not None
+
+
+def test_refresher_rebuilds_periodically(app, snapshot_path, test_product):
+    refresher = CatalogRefresher(app, get_catalog(app), rebuild_interval=0)
+    refresher.refresh_once()
+    db.session.execute(Product.__table__.update().values(name='Changed behind the cache'))
+    db.session.commit()
+    refresher.refresh_once()
+    body, _ = get_catalog(app).current().get(test_product['id'])
+    assert json.loads(bytes(body))['name'] == 'Changed behind the cache'
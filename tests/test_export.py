@@ -0,0 +1,86 @@
+import csv
+import io
+import json
+from datetime import datetime
+import pytest
+from db import db
+from orders import Purchase, Return
+from orders.export import copy_csv, export_orders
+
+
+def seed_orders():
+    for day in range(1, 4):
+        db.session.add(Purchase(user_id=1, product_id=1, quantity=day, total_price=10.0 * day,
+                                status='completed', created_at=datetime(2024, 1, day)))
+    db.session.add(Return(user_id=1, product_id=1, status='pending_approval', date=datetime(2024, 1, 5),
+                          customer_email='c@example.com', customer_name='C', reason='Broken',
+                          purchase_date=datetime(2024, 1, 1), original_purchase_id=1))
+    db.session.commit()
+
+
+def test_export_purchases_csv(client, admin_token):
+    seed_orders()
+    response = client.get('/orders/export?type=purchase&format=csv&since=2024-01-02',
+                          headers={'Authorization': f'Bearer {admin_token}'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [row['quantity'] for row in rows] == ['2', '3']
+    assert rows[0]['date'] == '2024-01-02T00:00:00'
+
+
+def test_export_resumes_after_id(client, admin_token):
+    seed_orders()
+    response = client.get('/orders/export?type=purchase&format=ndjson&after_id=2',
+                          headers={'Authorization': f'Bearer {admin_token}'})
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row['id'] for row in rows] == [3]
+
+
+def test_export_returns_and_validation(client, admin_token):
+    seed_orders()
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    response = client.get('/orders/export?type=return&format=ndjson', headers=headers)
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert rows[0]['reason'] == 'Broken'
+    assert rows[0]['original_purchase_id'] == 1
+
+    assert client.get('/orders/export?type=refund', headers=headers).status_code == 400
+    assert client.get('/orders/export?type=return&format=xml', headers=headers).status_code == 400
+    assert client.get('/orders/export?type=return&since=yesterday', headers=headers).status_code == 400
+
+
+def test_export_orders_command(app, runner, tmp_path):
+    seed_orders()
+    output = tmp_path / 'purchases.csv'
+    result = runner.invoke(args=['export-orders', '--type', 'purchase', '--until', '2024-01-03',
+                                 '--output', str(output)])
+    assert result.exit_code == 0, result.output
+    rows = list(csv.DictReader(output.open()))
+    assert [row['id'] for row in rows] == ['1', '2']
+
+
+def test_export_parquet(app, runner, tmp_path):
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    seed_orders()
+    output = tmp_path / 'purchases.parquet'
+    result = runner.invoke(args=['export-orders', '--type', 'purchase', '--format', 'parquet',
+                                 '--output', str(output)])
+    assert result.exit_code == 0, result.output
+    table = pyarrow_parquet.read_table(output)
+    assert table.column('quantity').to_pylist() == [1, 2, 3]
+
+
+def test_copy_csv_matches_streamed_csv(postgres_app, test_product, tmp_path):
+    seed_orders()
+    # Fractional seconds, a fractional price and an empty string
+    db.session.add(Purchase(user_id=1, product_id=1, quantity=1, total_price=0.1, status='',
+                            created_at=datetime(2024, 1, 4, 12, 30, 5, 250)))
+    db.session.commit()
+
+    for order_type in ('purchase', 'return'):
+        output = tmp_path / f'{order_type}.csv'
+        with output.open('wb') as out:
+            copy_csv(order_type, out)
+        assert output.read_text() == ''.join(export_orders(order_type, 'csv')), order_type
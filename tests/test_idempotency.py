@@ -0,0 +1,77 @@
+import pytest
+import json
+import threading
+from utils.idempotency import (
+    DatabaseIdempotencyStore,
+    LocalIdempotencyStore,
+    RESERVED,
+    IN_PROGRESS,
+    COMPLETED
+)
+
+
+@pytest.mark.parametrize('store_class', [LocalIdempotencyStore, DatabaseIdempotencyStore])
+def test_store_reserve_and_complete(app, store_class):
+    store = store_class()
+    assert store.reserve('key-1', 1, 'POST /cart/add') == (RESERVED, None)
+    assert store.reserve('key-1', 1, 'POST /cart/add') == (IN_PROGRESS, None)
+    # Keys are scoped per user and route
+    assert store.reserve('key-1', 2, 'POST /cart/add') == (RESERVED, None)
+
+    store.complete('key-1', 1, 'POST /cart/add', {'ok': True}, 201)
+    assert store.reserve('key-1', 1, 'POST /cart/add') == (COMPLETED, ({'ok': True}, 201))
+
+    store.release('key-1', 2, 'POST /cart/add')
+    assert store.reserve('key-1', 2, 'POST /cart/add') == (RESERVED, None)
+
+
+def test_local_store_duplicates_wait_for_first_result():
+    store = LocalIdempotencyStore()
+    assert store.reserve('key-1', None, 'POST /users')[0] == RESERVED
+    results = []
+
+    def duplicate():
+        while True:
+            state, stored = store.reserve('key-1', None, 'POST /users')
+            if state == COMPLETED:
+                results.append(stored)
+                return
+            store.wait('key-1', None, 'POST /users')
+
+    waiter = threading.Thread(target=duplicate)
+    waiter.start()
+    store.complete('key-1', None, 'POST /users', {'id': 1}, 201)
+    waiter.join(timeout=5)
+    assert results == [({'id': 1}, 201)]
+
+
+def test_retried_cart_add_creates_one_line(client, admin_token, test_product):
+    headers = {
+        'Authorization': f'Bearer {admin_token}',
+        'Idempotency-Key': 'add-1'
+    }
+    responses = [
+        client.post('/cart/add',
+            json={'product_id': test_product['id'], 'quantity': 1},
+            headers=headers
+        )
+        for _ in range(2)
+    ]
+    assert [response.status_code for response in responses] == [201, 201]
+    assert 'Idempotent-Replayed' not in responses[0].headers
+    assert responses[1].headers.get('Idempotent-Replayed') == 'true'
+
+    cart = json.loads(client.get('/cart', headers=headers).data)
+    assert [item['quantity'] for item in cart['items']] == [1]
+
+
+def test_retried_signup_replays_with_database_store(client, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'IDEMPOTENCY_BACKEND', 'database')
+    headers = {'Idempotency-Key': 'signup-1'}
+    body = {'username': 'new', 'email': 'new@example.com', 'password': 'secret123', 'user_type': 'customer'}
+
+    first = client.post('/users', json=body, headers=headers)
+    retry = client.post('/users', json=body, headers=headers)
+    assert first.status_code == retry.status_code == 201
+    assert retry.headers.get('Idempotent-Replayed') == 'true'
+    assert json.loads(retry.data) == json.loads(first.data)
@@ -0,0 +1,120 @@
+import os
+import pytest
+from sqlalchemy import text
+from sqlalchemy.orm import with_polymorphic
+from db import db, ensure_indexes
+from orders import Order, Purchase, Return, Exchange
+from orders.cart import Cart
+from product import Product
+
+# Set to e.g. postgresql+psycopg2://postgres@localhost/flask_commerce_test
+# to also check plans against a seeded local PostgreSQL
+POSTGRES_URL = os.getenv('TEST_POSTGRES_URL')
+
+
+def hot_queries():
+    """The predicates behind the busiest endpoints, keyed by the index they should use"""
+    pending = with_polymorphic(Order, [Return, Exchange])
+    return {
+        'ix_cart_items_user_id_status': Cart.query.filter_by(user_id=7, status='in_cart'),
+        'ix_purchases_user_id_created_at': Purchase.query.filter_by(user_id=7).order_by(Purchase.created_at),
+        'ix_purchases_product_id': Purchase.query.filter_by(product_id=7),
+        'ix_orders_type_status_date': db.session.query(pending).filter(
+            pending.type == 'return', pending.status == 'pending_approval'
+        ).order_by(pending.date),
+        'uq_returns_active_purchase': Return.query.filter_by(original_purchase_id=7, active_request=True),
+        'ix_products_type': Product.query.filter_by(type='digital'),
+    }
+
+
+def uses_index(plan, index_name):
+    # SQLite names the index behind a UNIQUE constraint sqlite_autoindex_<table>_N
+    if index_name.startswith('uq_') and 'sqlite_autoindex' in plan:
+        return True
+    return index_name in plan
+
+
+def query_plan(query):
+    dialect = db.engine.dialect
+    sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect.name == 'sqlite' else 'EXPLAIN '
+    return '\n'.join(str(row[-1]) for row in db.session.execute(text(prefix + sql)))
+
+
+@pytest.mark.parametrize('index_name', [
+    'ix_cart_items_user_id_status',
+    'ix_purchases_user_id_created_at',
+    'ix_purchases_product_id',
+    'ix_orders_type_status_date',
+    'uq_returns_active_purchase',
+    'ix_products_type',
+])
+def test_hot_queries_use_indexes(app, index_name):
+    plan = query_plan(hot_queries()[index_name])
+    assert uses_index(plan, index_name), plan
+
+
+def test_ensure_indexes_creates_missing(app):
+    db.session.execute(text('DROP INDEX ix_purchases_product_id'))
+    db.session.commit()
+    assert ensure_indexes() == ['ix_purchases_product_id']
+    assert ensure_indexes() == []
+
+
+@pytest.fixture
+def postgres_app(app):
+    if not POSTGRES_URL:
+        pytest.skip('TEST_POSTGRES_URL not set')
+    sqlite_url = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config['SQLALCHEMY_DATABASE_URI'] = POSTGRES_URL
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    seed_postgres()
+    yield app
+    db.session.remove()
+    db.drop_all()
+    app.config['SQLALCHEMY_DATABASE_URI'] = sqlite_url
+
+
+def seed_postgres(rows=20000):
+    """Load enough rows that the planner prefers index scans, then ANALYZE"""
+    statements = [
+        "INSERT INTO users (id, username, email, password_hash, type) "
+        "SELECT g, 'user' || g, 'user' || g || '@example.com', 'x', 'customer' "
+        "FROM generate_series(1, 1000) g",
+        "INSERT INTO products (id, name, price, type, version_id) "
+        "SELECT g, 'product ' || g, g % 100, CASE WHEN g % 50 = 0 THEN 'digital' ELSE 'physical' END, 1 "
+        "FROM generate_series(1, 1000) g",
+        f"INSERT INTO cart_items (user_id, product_id, quantity, total_price, status, created_at) "
+        f"SELECT g % 1000 + 1, g % 997 + 1, 1, 1, CASE WHEN g % 10 = 0 THEN 'in_cart' ELSE 'completed' END, now() "
+        f"FROM generate_series(1, {rows}) g",
+        f"INSERT INTO purchases (user_id, product_id, quantity, total_price, status, created_at) "
+        f"SELECT g % 1000 + 1, g % 1000 + 1, 1, 1, 'completed', now() - g * interval '1 minute' "
+        f"FROM generate_series(1, {rows}) g",
+        f"INSERT INTO orders (id, user_id, product_id, date, status, type) "
+        f"SELECT g, g % 1000 + 1, g % 1000 + 1, now(), "
+        f"CASE WHEN g % 100 = 0 THEN 'pending_approval' ELSE 'approved' END, 'return' "
+        f"FROM generate_series(1, {rows}) g",
+        f"INSERT INTO returns (id, customer_email, customer_name, purchase_date, original_purchase_id, active_request) "
+        f"SELECT g, 'c@example.com', 'c', now(), g, CASE WHEN g % 100 = 0 THEN true END "
+        f"FROM generate_series(1, {rows}) g",
+    ]
+    for statement in statements:
+        db.session.execute(text(statement))
+    db.session.commit()
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text('ANALYZE'))
+
+
+@pytest.mark.parametrize('index_name', [
+    'ix_cart_items_user_id_status',
+    'ix_purchases_user_id_created_at',
+    'ix_purchases_product_id',
+    'ix_orders_type_status_date',
+    'uq_returns_active_purchase',
+])
+def test_hot_queries_use_index_scans_on_postgres(postgres_app, index_name):
+    plan = query_plan(hot_queries()[index_name])
+    assert uses_index(plan, index_name), plan
+    assert 'Index' in plan or 'Bitmap' in plan, plan
@@ -0,0 +1,41 @@
+import json
+from db import db
+from product import Product
+from product.inventory import InventoryMovement
+
+
+def test_checkout_records_movement(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    client.post('/cart/add',
+        json={'product_id': test_product['id'], 'quantity': 3},
+        headers=headers
+    )
+    client.post('/cart/complete', headers=headers)
+
+    response = client.get(f"/products/{test_product['id']}/movements", headers=headers)
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['stock'] == 7
+    assert [(m['reason'], m['quantity']) for m in data['movements']] == [
+        ('checkout', -3),
+        ('adjust', 10)
+    ]
+    assert data['movements'][0]['reference_id'] is not None
+
+
+def test_rebuild_stock_repairs_drift(app, runner, test_product):
+    db.session.execute(
+        db.text('UPDATE physical_products SET stock = 42 WHERE id = :id'),
+        {'id': test_product['id']}
+    )
+    db.session.commit()
+
+    result = runner.invoke(args=['rebuild-stock', '--dry-run'])
+    assert 'stock 42 -> 10' in result.output
+    assert Product.query.get(test_product['id']).stock == 42
+
+    result = runner.invoke(args=['rebuild-stock'])
+    assert 'Repaired 1 drifted products' in result.output
+    db.session.expire_all()
+    assert Product.query.get(test_product['id']).stock == 10
+    assert InventoryMovement.query.count() == 1
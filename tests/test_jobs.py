@@ -0,0 +1,90 @@
+import json
+from datetime import datetime, timedelta
+from db import db
+from product import Product
+from utils.jobs import Job, JobRunner, enqueue
+
+
+def queue(client, headers, job_type, params=None):
+    response = client.post('/jobs', json={'type': job_type, 'params': params or {}}, headers=headers)
+    assert response.status_code == 202
+    return json.loads(response.data)['job_id']
+
+
+def job_status(client, headers, job_id):
+    return json.loads(client.get(f'/jobs/{job_id}', headers=headers).data)
+
+
+def test_bulk_create_runs_off_the_request(client, app, admin_token):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    products = [{'name': f'Bulk {n}', 'price': n, 'product_type': 'physical', 'stock': 1} for n in range(150)]
+    job_id = queue(client, headers, 'create_products', {'products': products + [{'name': 'Broken'}]})
+
+    assert job_status(client, headers, job_id)['status'] == 'queued'
+    assert Product.query.count() == 0
+
+    assert JobRunner(app).run_once() is True
+    status = job_status(client, headers, job_id)
+    assert (status['status'], status['progress']) == ('succeeded', 1)
+    assert status['message'] == 'Processed 100 of 151 products'
+    assert len(status['result']['created']) == 150
+    assert len(status['result']['errors']) == 1
+    assert Product.query.count() == 150
+    assert JobRunner(app).run_once() is False
+
+
+def test_failed_and_invalid_jobs(client, app, admin_token):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    assert client.post('/jobs', json={'type': 'mine_bitcoin'}, headers=headers).status_code == 400
+
+    job_id = queue(client, headers, 'create_users')
+    JobRunner(app).run_once()
+    status = job_status(client, headers, job_id)
+    assert status['status'] == 'failed'
+    assert 'users' in status['error']
+
+    listed = json.loads(client.get('/jobs?status=failed', headers=headers).data)
+    assert [job['id'] for job in listed['jobs']] == [job_id]
+    assert client.get('/jobs/999', headers=headers).status_code == 404
+
+
+def test_export_job_result_download(client, app, admin_token, test_product, tmp_path):
+    app.config['EXPORT_DIRECTORY'] = str(tmp_path)
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 1}, headers=headers)
+    client.post('/cart/complete', headers=headers)
+
+    job_id = queue(client, headers, 'export_orders', {'type': 'purchase', 'format': 'csv'})
+    JobRunner(app).run_once()
+    result = job_status(client, headers, job_id)['result']
+    assert result['file'].startswith(str(tmp_path))
+
+    response = client.get(f'/jobs/{job_id}/download', headers=headers)
+    assert response.status_code == 200
+    lines = response.data.decode().splitlines()
+    assert lines[0].startswith('id,user_id,product_id') and len(lines) == 2
+    response.close()
+
+
+def test_export_job_rejects_invalid_params(client, app, admin_token, tmp_path):
+    app.config['EXPORT_DIRECTORY'] = str(tmp_path / 'exports')
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    for params in ({'type': '../escaped'}, {'type': 'purchase', 'format': '../x'}):
+        response = client.post('/jobs', json={'type': 'export_orders', 'params': params}, headers=headers)
+        assert response.status_code == 400
+
+    # Jobs queued some other way are checked again before a file is opened
+    job_id = enqueue('export_orders', {'type': '../escaped'}).id
+    JobRunner(app).run_once()
+    assert job_status(client, headers, job_id)['error'] == 'Invalid export type: ../escaped'
+    assert not list(tmp_path.rglob('*escaped*'))
+
+
+def test_abandoned_jobs_fail(app):
+    stale = datetime.utcnow() - timedelta(hours=1)
+    db.session.add(Job(job_type='export_orders', params='{}', status='running', heartbeat_at=stale))
+    db.session.add(Job(job_type='export_orders', params='{}', status='running', heartbeat_at=datetime.utcnow()))
+    db.session.commit()
+
+    assert JobRunner(app, heartbeat_timeout=60).fail_abandoned() == 1
+    assert [job.status for job in Job.query.order_by(Job.id)] == ['failed', 'running']
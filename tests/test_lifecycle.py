@@ -0,0 +1,42 @@
+from threading import Thread
+import time
+from main import create_app
+
+
+def test_create_app_does_not_connect():
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql+psycopg2://nobody@unreachable.invalid/shop'})
+    assert 'api.readiness' in app.view_functions
+
+
+def test_readiness_fails_while_draining(app, client):
+    assert client.get('/health/ready').status_code == 200
+
+    lifecycle = app.extensions['lifecycle']
+    try:
+        assert lifecycle.drain(timeout=1)
+        response = client.get('/health/ready')
+        assert response.status_code == 503
+        assert response.get_json() == {'status': 'draining'}
+    finally:
+        lifecycle.draining = False
+
+
+def test_drain_waits_for_in_flight_requests(app):
+    lifecycle = app.extensions['lifecycle']
+    lifecycle._request_started()
+    finished = []
+
+    def finish_request():
+        time.sleep(0.2)
+        finished.append(True)
+        lifecycle._request_finished()
+
+    Thread(target=finish_request).start()
+    try:
+        assert lifecycle.drain(timeout=5)
+        assert finished
+        lifecycle._request_started()
+        assert not lifecycle.drain(timeout=0.1)
+        lifecycle._request_finished()
+    finally:
+        lifecycle.draining = False
@@ -0,0 +1,134 @@
+import importlib
+import pytest
+from sqlalchemy import UniqueConstraint, create_engine, inspect, text
+from migrations import model_metadata, upgrade, verify, current_revision, latest_revision, SchemaVersionError
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/migrations.db')
+    yield engine
+    engine.dispose()
+
+
+def assert_matches_models(engine):
+    """The migrated schema has every table, column and index the models declare"""
+    inspector = inspect(engine)
+    for table in model_metadata().sorted_tables:
+        assert {column['name'] for column in inspector.get_columns(table.name)} == set(table.columns.keys())
+        names = {index['name'] for index in inspector.get_indexes(table.name)}
+        names.update(constraint['name'] for constraint in inspector.get_unique_constraints(table.name))
+        declared = {index.name for index in table.indexes}
+        declared.update(constraint.name for constraint in table.constraints
+                        if isinstance(constraint, UniqueConstraint) and constraint.name)
+        assert declared <= names, table.name
+
+
+def test_upgrade_fresh_database(app, engine):
+    with pytest.raises(SchemaVersionError):
+        verify(engine)
+
+    applied = upgrade(engine)
+    assert applied == list(range(1, latest_revision() + 1))
+    assert verify(engine) == latest_revision()
+    assert upgrade(engine) == []
+
+    assert_matches_models(engine)
+
+
+# The tables as the application created them before versioned migrations
+PRE_MIGRATION_SCHEMA = (
+    "CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(80) NOT NULL UNIQUE, "
+    "email VARCHAR(120) NOT NULL UNIQUE, password_hash VARCHAR(500) NOT NULL, type VARCHAR(50))",
+    "CREATE TABLE customers (id INTEGER PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE)",
+    "CREATE TABLE administrators (id INTEGER PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE)",
+    "CREATE TABLE products (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, "
+    "description VARCHAR(500), price FLOAT NOT NULL, type VARCHAR(50))",
+    "CREATE TABLE physical_products (id INTEGER PRIMARY KEY REFERENCES products (id), "
+    "weight FLOAT, stock INTEGER)",
+    "CREATE TABLE digital_products (id INTEGER PRIMARY KEY REFERENCES products (id), "
+    "file_size FLOAT, download_link VARCHAR(500))",
+    "CREATE TABLE cart_items (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id), "
+    "product_id INTEGER NOT NULL REFERENCES products (id), quantity INTEGER NOT NULL, "
+    "total_price FLOAT NOT NULL, status VARCHAR(20) NOT NULL, created_at DATETIME)",
+    "CREATE TABLE purchases (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id), "
+    "product_id INTEGER NOT NULL REFERENCES products (id), quantity INTEGER NOT NULL, "
+    "total_price FLOAT NOT NULL, status VARCHAR(20) NOT NULL, created_at DATETIME)",
+    "CREATE TABLE orders (id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES users (id), "
+    "product_id INTEGER NOT NULL REFERENCES products (id), date DATETIME NOT NULL, "
+    "status VARCHAR(50), type VARCHAR(50), quantity INTEGER, total_price FLOAT)",
+    "CREATE TABLE returns (id INTEGER PRIMARY KEY REFERENCES orders (id), reason VARCHAR(500), "
+    "refund_amount FLOAT, customer_email VARCHAR(100) NOT NULL, customer_name VARCHAR(100) NOT NULL, "
+    "purchase_date DATETIME NOT NULL, original_purchase_id INTEGER NOT NULL REFERENCES purchases (id), "
+    "admin_notes VARCHAR(500), approved_by INTEGER REFERENCES users (id), approved_at DATETIME, "
+    "rejected_by INTEGER REFERENCES users (id), rejected_at DATETIME)",
+    "CREATE TABLE exchanges (id INTEGER PRIMARY KEY REFERENCES orders (id), "
+    "new_product_id INTEGER REFERENCES products (id), reason VARCHAR(500), "
+    "customer_email VARCHAR(100) NOT NULL, customer_name VARCHAR(100) NOT NULL, "
+    "purchase_date DATETIME NOT NULL, original_purchase_id INTEGER NOT NULL REFERENCES purchases (id), "
+    "admin_notes VARCHAR(500), approved_by INTEGER REFERENCES users (id), approved_at DATETIME, "
+    "rejected_by INTEGER REFERENCES users (id), rejected_at DATETIME)",
+)
+
+
+def test_upgrade_evolves_existing_schema(app, engine):
+    with engine.begin() as connection:
+        for ddl in PRE_MIGRATION_SCHEMA:
+            connection.execute(text(ddl))
+        connection.execute(text(
+            "INSERT INTO products (id, name, price, type) VALUES (1, 'Lamp', 10, 'physical')"
+        ))
+        connection.execute(text('INSERT INTO physical_products (id, stock) VALUES (1, 4)'))
+        for _ in range(2):
+            connection.execute(text(
+                "INSERT INTO cart_items (user_id, product_id, quantity, total_price, status) "
+                "VALUES (1, 1, 1, 10, 'in_cart')"
+            ))
+        connection.execute(text(
+            "INSERT INTO orders (id, product_id, date, status, type) "
+            "VALUES (1, 1, '2024-01-01', 'pending_approval', 'return')"
+        ))
+        connection.execute(text(
+            "INSERT INTO returns (id, customer_email, customer_name, purchase_date, original_purchase_id) "
+            "VALUES (1, 'a@example.com', 'A', '2024-01-01', 1)"
+        ))
+
+    assert current_revision(engine) == 0
+    upgrade(engine)
+    assert current_revision(engine) == latest_revision()
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT version_id FROM products')).scalar() == 1
+        assert connection.execute(text('SELECT quantity FROM cart_items')).fetchall() == [(2,)]
+        assert connection.execute(text('SELECT active_request FROM returns')).scalar() == 1
+        assert connection.execute(text(
+            "SELECT quantity, reason FROM inventory_movements"
+        )).fetchall() == [(4, 'adjust')]
+        assert connection.execute(text(
+            'SELECT product_id, operation FROM product_changes'
+        )).fetchall() == [(1, 'insert')]
+    assert_matches_models(engine)
+
+
+def test_backfill_order_headers(app, engine, monkeypatch):
+    # One user per batch, so the backfill has to resume after each commit
+    monkeypatch.setattr(importlib.import_module('migrations.versions.0008_order_headers'), 'BATCH_USERS', 1)
+    upgrade(engine, target=7)
+    with engine.begin() as connection:
+        # Purchases written before checkouts had headers
+        connection.execute(text(
+            "INSERT INTO purchases (user_id, product_id, quantity, total_price, status, created_at) VALUES "
+            "(1, 1, 1, 10, 'completed', '2024-01-01 10:00:00.100000'), "
+            "(1, 2, 2, 20, 'completed', '2024-01-01 10:00:00.300000'), "
+            "(1, 1, 1, 10, 'completed', '2024-01-02 09:00:00'), "
+            "(2, 1, 1, 10, 'completed', '2024-01-01 10:00:00.200000')"
+        ))
+
+    upgrade(engine)
+    with engine.connect() as connection:
+        headers = connection.execute(text(
+            'SELECT user_id, item_count, total_price FROM order_headers ORDER BY user_id, created_at'
+        )).fetchall()
+        assert headers == [(1, 3, 30.0), (1, 1, 10.0), (2, 1, 10.0)]
+        assert connection.execute(text(
+            'SELECT COUNT(*) FROM purchases WHERE order_header_id IS NULL'
+        )).scalar() == 0
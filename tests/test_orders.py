@@ -1,6 +1,5 @@
 import pytest
 import json
-from datetime import datetime
 import jwt
 
 def test_get_orders_as_admin(client, admin_token, test_product):
@@ -77,4 +76,102 @@ def test_get_orders_as_customer(client, app, test_product):
     assert 'orders' in data
    
     for order in data['orders']:
-        assert order['details']['product_id'] == test_product['id']
\ No newline at end of file
+        for line in order['lines']:
+            assert line['details']['product_id'] == test_product['id']
+
+def test_pending_approval_queue(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    client.post('/cart/add',
+        json={'product_id': test_product['id'], 'quantity': 1},
+        headers=headers
+    )
+    client.post('/cart/complete', headers=headers)
+    purchase_id = json.loads(client.get('/orders', headers=headers).data)['orders'][0]['lines'][0]['id']
+
+    counts_response = client.get('/orders/pending/counts', headers=headers)
+    assert json.loads(counts_response.data)['total'] == 0
+
+    return_response = client.post('/orders/return',
+        json={'purchase_id': purchase_id, 'reason': 'Damaged', 'refund_amount': 10},
+        headers=headers
+    )
+    assert return_response.status_code == 201
+    return_id = json.loads(return_response.data)['return_id']
+
+    queue_response = client.get('/orders/pending?type=return', headers=headers)
+    assert queue_response.status_code == 200
+    data = json.loads(queue_response.data)
+    assert data['total'] == 1
+    assert data['orders'][0]['id'] == return_id
+    assert data['orders'][0]['original_purchase_id'] == purchase_id
+
+    client.post(f'/orders/return/{return_id}/approve',
+        json={'approved': True},
+        headers=headers
+    )
+    data = json.loads(client.get('/orders/pending', headers=headers).data)
+    assert data['orders'] == []
+    assert data['counts'] == {'return': 0, 'exchange': 0}
+
+
+def test_duplicate_return_requests(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    client.post('/cart/add',
+        json={'product_id': test_product['id'], 'quantity': 1},
+        headers=headers
+    )
+    client.post('/cart/complete', headers=headers)
+    purchase_id = json.loads(client.get('/orders', headers=headers).data)['orders'][0]['lines'][0]['id']
+    return_data = {'purchase_id': purchase_id, 'reason': 'Damaged', 'refund_amount': 10}
+
+    # A retry with the same Idempotency-Key replays the first response
+    retry_headers = dict(headers, **{'Idempotency-Key': 'return-1'})
+    first = client.post('/orders/return', json=return_data, headers=retry_headers)
+    retry = client.post('/orders/return', json=return_data, headers=retry_headers)
+    assert first.status_code == retry.status_code == 201
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert json.loads(retry.data)['return_id'] == json.loads(first.data)['return_id']
+
+    # A new request for the same purchase is rejected while the first is pending
+    duplicate = client.post('/orders/return', json=return_data, headers=headers)
+    assert duplicate.status_code == 409
+    assert json.loads(duplicate.data)['return_id'] == json.loads(first.data)['return_id']
+
+
+def test_checkout_creates_one_order_with_lines(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    second = json.loads(client.post('/products', json={
+        'name': 'Second', 'price': 5, 'product_type': 'digital',
+        'file_size': 1, 'download_link': 'x'
+    }, headers=headers).data)
+
+    for checkout in range(3):
+        client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 2}, headers=headers)
+        client.post('/cart/add', json={'product_id': second['id'], 'quantity': 1}, headers=headers)
+        complete = json.loads(client.post('/cart/complete', headers=headers).data)
+        assert len(complete['purchase_ids']) == 2
+        assert None not in complete['purchase_ids']
+
+    data = json.loads(client.get('/orders?per_page=2', headers=headers).data)
+    assert len(data['orders']) == 2
+    order = data['orders'][0]
+    assert order['id'] == complete['order_id']
+    assert order['item_count'] == 3
+    assert order['total_price'] == pytest.approx(2 * 99.99 + 5)
+    assert [line['id'] for line in order['lines']] == complete['purchase_ids']
+
+    data = json.loads(client.get('/orders?page=2&per_page=2', headers=headers).data)
+    assert len(data['orders']) == 1
+
+
+def test_checkout_charges_the_current_price(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 2}, headers=headers)
+    # The price changes after the item went into the cart
+    client.put(f"/products/{test_product['id']}", json={'price': 120.0}, headers=headers)
+
+    complete = json.loads(client.post('/cart/complete', headers=headers).data)
+    order = json.loads(client.get('/orders', headers=headers).data)['orders'][0]
+    assert order['id'] == complete['order_id']
+    assert order['total_price'] == pytest.approx(240.0)
+    assert order['lines'][0]['total_price'] == pytest.approx(240.0)
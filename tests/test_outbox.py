@@ -0,0 +1,151 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+from sqlalchemy import event
+from db import db
+from utils.outbox import OutboxEvent, Dispatcher, FileSink, HttpSink, publish, sinks_from_config
+
+
+def checkout_and_return(client, headers, product_id):
+    client.post('/cart/add', json={'product_id': product_id, 'quantity': 2}, headers=headers)
+    order_id = json.loads(client.post('/cart/complete', headers=headers).data)['order_id']
+    purchase_id = json.loads(client.get('/orders', headers=headers).data)['orders'][0]['lines'][0]['id']
+    return_id = json.loads(client.post('/orders/return',
+        json={'purchase_id': purchase_id, 'reason': 'Damaged', 'refund_amount': 10},
+        headers=headers
+    ).data)['return_id']
+    client.post(f'/orders/return/{return_id}/approve', json={'approved': True}, headers=headers)
+    return order_id, return_id
+
+
+def test_order_events_written_with_the_change(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    # Creating the product recorded its opening stock
+    assert [event.event_type for event in OutboxEvent.query] == ['stock.changed']
+    order_id, return_id = checkout_and_return(client, headers, test_product['id'])
+
+    events = [event.to_message() for event in OutboxEvent.query.order_by(OutboxEvent.id)][1:]
+    assert [event['type'] for event in events] == [
+        'order.completed', 'stock.changed', 'return.approved', 'stock.changed'
+    ]
+    assert events[0]['payload']['order_id'] == order_id
+    assert events[0]['payload']['lines'][0]['quantity'] == 2
+    assert events[1]['payload']['movements'][0]['quantity'] == -2
+    assert events[1]['payload']['movements'][0]['stock'] == 8
+    assert events[2]['payload']['return_id'] == return_id
+    assert events[3]['payload']['movements'][0]['stock'] == 9
+
+    # Nothing is published when the transaction rolls back
+    publish('order.completed', {'order_id': 0})
+    db.session.rollback()
+    assert OutboxEvent.query.count() == 5
+
+
+def test_dispatcher_delivers_in_batches(app, tmp_path):
+    for number in range(5):
+        publish('test.event', {'number': number})
+    db.session.commit()
+
+    path = tmp_path / 'events.ndjson'
+    dispatcher = Dispatcher([FileSink(str(path))], batch_size=2)
+    assert [dispatcher.dispatch_once() for _ in range(4)] == [2, 2, 1, 0]
+
+    delivered = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [message['payload']['number'] for message in delivered] == [0, 1, 2, 3, 4]
+    assert dispatcher.metrics['delivered'] == 5
+    assert OutboxEvent.query.filter_by(status='delivered').count() == 5
+
+
+def test_dispatch_statements_do_not_grow_with_the_batch(app, tmp_path):
+    for number in range(50):
+        publish('test.event', {'number': number})
+    db.session.commit()
+
+    statements = []
+    def count(*args):
+        statements.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        assert Dispatcher([FileSink(str(tmp_path / 'events.ndjson'))]).dispatch_once() == 50
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    # Claim select and update, then one update for the delivered batch
+    assert len(statements) == 3
+
+
+class FlakySink:
+    def __init__(self, failures):
+        self.failures = failures
+        self.received = []
+
+    def send(self, messages):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('downstream unavailable')
+        self.received.extend(messages)
+
+
+def test_dispatcher_retries_with_backoff(app):
+    publish('test.event', {})
+    db.session.commit()
+    sink = FlakySink(failures=1)
+    dispatcher = Dispatcher([sink], max_attempts=2)
+
+    assert dispatcher.dispatch_once() == 1
+    event = OutboxEvent.query.one()
+    assert (event.status, event.attempts, event.last_error) == ('pending', 1, 'downstream unavailable')
+    assert event.available_at > datetime.utcnow()
+    # Not claimed again until the backoff has passed
+    assert dispatcher.dispatch_once() == 0
+
+    event.available_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    assert dispatcher.dispatch_once() == 1
+    assert OutboxEvent.query.one().status == 'delivered'
+    assert len(sink.received) == 1
+
+    publish('test.event', {})
+    db.session.commit()
+    sink.failures = 5
+    dispatcher.backoff = 0
+    dispatcher.dispatch_once()
+    dispatcher.dispatch_once()
+    assert OutboxEvent.query.filter_by(status='failed').count() == 1
+    assert dispatcher.metrics['failed'] == 1
+
+
+def test_http_sink_and_metrics(client, admin_token):
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        publish('test.event', {'hello': 'world'})
+        db.session.commit()
+        headers = {'Authorization': f'Bearer {admin_token}'}
+        assert json.loads(client.get('/outbox/metrics', headers=headers).data)['pending'] == 1
+
+        sinks = sinks_from_config(f'http://127.0.0.1:{server.server_port}/events')
+        assert isinstance(sinks[0], HttpSink)
+        Dispatcher(sinks).dispatch_once()
+        assert received[0][0]['payload'] == {'hello': 'world'}
+
+        metrics = json.loads(client.get('/outbox/metrics', headers=headers).data)
+        assert (metrics['pending'], metrics['delivered'], metrics['lag_seconds']) == (0, 1, 0.0)
+        assert metrics['delivered_per_minute'] == 1
+    finally:
+        server.shutdown()
+
+    with pytest.raises(ValueError):
+        sinks_from_config('ftp://example.com')
@@ -0,0 +1,99 @@
+import json
+from datetime import date, datetime
+import pytest
+from sqlalchemy import text
+from db import db
+from orders import OrderHeader, Purchase
+from orders.partitions import (
+    add_months, monthly_partitions, ensure_partitions, archive_partitions, partition_name,
+    partition_table, list_partitions
+)
+
+
+def test_monthly_partitions_cross_year_boundary():
+    partitions = monthly_partitions('purchases', date(2023, 11, 17), date(2024, 2, 1))
+    assert partitions == [
+        ('purchases_y2023m11', date(2023, 11, 1), date(2023, 12, 1)),
+        ('purchases_y2023m12', date(2023, 12, 1), date(2024, 1, 1)),
+        ('purchases_y2024m01', date(2024, 1, 1), date(2024, 2, 1)),
+        ('purchases_y2024m02', date(2024, 2, 1), date(2024, 3, 1)),
+    ]
+
+
+def test_partition_maintenance_is_a_no_op_without_postgres(app):
+    assert ensure_partitions() == []
+    assert archive_partitions(date(2024, 1, 1)) == []
+    with pytest.raises(ValueError):
+        archive_partitions(date(2024, 1, 1), mode='truncate')
+
+
+def test_orders_date_range(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    for month in (1, 2, 3):
+        client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 1}, headers=headers)
+        order_id = json.loads(client.post('/cart/complete', headers=headers).data)['order_id']
+        created_at = datetime(2024, month, 15)
+        OrderHeader.query.filter_by(id=order_id).update({'created_at': created_at})
+        Purchase.query.filter_by(order_header_id=order_id).update({'created_at': created_at})
+    db.session.commit()
+
+    data = json.loads(client.get('/orders?since=2024-02-01&until=2024-03-01', headers=headers).data)
+    assert [order['created_at'][:7] for order in data['orders']] == ['2024-02']
+    assert len(data['orders'][0]['lines']) == 1
+
+    data = json.loads(client.get('/orders?since=2024-02-01', headers=headers).data)
+    assert [order['created_at'][:7] for order in data['orders']] == ['2024-03', '2024-02']
+
+    response = client.get('/orders?since=yesterday', headers=headers)
+    assert response.status_code == 400
+
+
+def test_partition_and_archive_on_postgres(postgres_app, client, admin_token, test_product, tmp_path):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 1}, headers=headers)
+    order_id = json.loads(client.post('/cart/complete', headers=headers).data)['order_id']
+    OrderHeader.query.filter_by(id=order_id).update({'created_at': datetime(2020, 1, 15)})
+    Purchase.query.filter_by(order_header_id=order_id).update({'created_at': datetime(2020, 1, 15)})
+    db.session.commit()
+    db.session.remove()
+
+    assert partition_table('purchases') is True
+    assert partition_table('order_headers') is True
+    assert partition_table('purchases') is False
+    with db.engine.connect() as connection:
+        assert 'purchases_y2020m01' in list_partitions(connection, 'purchases')
+
+    # New rows still get ids from the original sequence
+    client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 1}, headers=headers)
+    assert client.post('/cart/complete', headers=headers).status_code == 200
+    assert ensure_partitions(today=date.today()) == []
+
+    # Orders outside the monthly partitions land in the default partition
+    def checkout_at(created_at):
+        client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 1}, headers=headers)
+        order_id = json.loads(client.post('/cart/complete', headers=headers).data)['order_id']
+        OrderHeader.query.filter_by(id=order_id).update({'created_at': created_at})
+        Purchase.query.filter_by(order_header_id=order_id).update({'created_at': created_at})
+        db.session.commit()
+        db.session.remove()
+    future = add_months(date.today(), 12)
+    checkout_at(datetime(future.year, future.month, 2))
+    checkout_at(datetime(2019, 6, 2))
+
+    # Creating the future month moves its rows out of the default partition
+    created = ensure_partitions(months_ahead=12, today=date.today())
+    assert partition_name('purchases', future) in created
+    with db.engine.connect() as connection:
+        assert connection.execute(text(
+            f"SELECT COUNT(*) FROM {partition_name('purchases', future)}"
+        )).scalar() == 1
+
+    archived = archive_partitions(date(2020, 2, 1), mode='export', directory=str(tmp_path))
+    assert sorted(archived) == [
+        'order_headers_y2019m06', 'order_headers_y2020m01', 'purchases_y2019m06', 'purchases_y2020m01'
+    ]
+    assert (tmp_path / 'purchases_y2020m01.csv.gz').exists()
+    with db.engine.connect() as connection:
+        assert connection.execute(text('SELECT COUNT(*) FROM purchases_default')).scalar() == 0
+    data = json.loads(client.get('/orders', headers=headers).data)
+    assert len(data['orders']) == 2
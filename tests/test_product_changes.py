@@ -0,0 +1,66 @@
+import json
+from datetime import timedelta
+from db import db
+from product import Product
+from product.changes import ProductChange, compact_changes
+
+
+def changes(client, since=0, limit=100):
+    response = client.get(f'/products/changes?since={since}&limit={limit}')
+    assert response.status_code == 200
+    return json.loads(response.data)
+
+
+def test_change_feed_follows_product_writes(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    product_id = test_product['id']
+    first = changes(client)
+    assert [(c['product_id'], c['operation']) for c in first['changes']] == [(product_id, 'insert')]
+    assert first['changes'][0]['product']['name'] == 'Test Product'
+
+    client.put(f'/products/{product_id}', json={'price': 12.5}, headers=headers)
+    client.put(f'/products/{product_id}', json={'stock': 3}, headers=headers)
+    client.delete(f'/products/{product_id}', headers=headers)
+
+    later = changes(client, since=first['next_since'])
+    assert [c['operation'] for c in later['changes']] == ['update', 'stock', 'delete']
+    seqs = [c['seq'] for c in later['changes']]
+    assert seqs == sorted(seqs) and seqs[0] > first['next_since']
+    # Deleted products carry no document, whatever the entry
+    assert all(c['product'] is None for c in later['changes'])
+    assert later['next_since'] == seqs[-1]
+
+    assert changes(client, since=later['next_since'])['changes'] == []
+
+
+def test_change_feed_paging_and_compaction(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    for price in (1, 2, 3):
+        client.put(f"/products/{test_product['id']}", json={'price': price}, headers=headers)
+
+    page = changes(client, limit=2)
+    assert len(page['changes']) == 2 and page['has_more']
+    rest = changes(client, since=page['next_since'], limit=2)
+    assert len(rest['changes']) == 2 and not rest['has_more']
+
+    assert compact_changes(keep=timedelta(0)) == 3
+    remaining = changes(client)['changes']
+    assert [(c['operation'], c['product']['price']) for c in remaining] == [('update', 3)]
+    assert db.session.query(ProductChange).count() == 1
+
+
+def test_changes_are_written_at_commit(app, test_product):
+    product = db.session.get(Product, test_product['id'])
+    before = db.session.query(ProductChange).count()
+
+    # Nothing is written before commit, and a rollback drops the queued entries
+    product.price = 5
+    db.session.flush()
+    assert db.session.query(ProductChange).count() == before
+    db.session.rollback()
+    db.session.commit()
+    assert db.session.query(ProductChange).count() == before
+
+    product.price = 6
+    db.session.commit()
+    assert db.session.query(ProductChange).order_by(ProductChange.seq.desc()).first().operation == 'update'
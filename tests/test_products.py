@@ -44,4 +44,79 @@ def test_get_products(client):
     response = client.get('/products')
     assert response.status_code == 200
     data = json.loads(response.data)
-    assert 'products' in data 
\ No newline at end of file
+    assert 'products' in data 
+
+def test_update_product_if_match(client, admin_token, test_product):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    response = client.get(f"/products/{test_product['id']}")
+    etag = response.headers['ETag']
+
+    response = client.put(f"/products/{test_product['id']}",
+        json={'stock': 5},
+        headers=dict(headers, **{'If-Match': etag})
+    )
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+    # The old ETag no longer matches
+    response = client.put(f"/products/{test_product['id']}",
+        json={'stock': 4},
+        headers=dict(headers, **{'If-Match': etag})
+    )
+    assert response.status_code == 412
+
+
+def test_stale_stock_update_raises(app, test_product):
+    from sqlalchemy.orm.exc import StaleDataError
+    from product import Product
+    from db import db
+
+    product = Product.query.get(test_product['id'])
+    # Another writer bumps the version after our read
+    db.session.execute(
+        db.text('UPDATE products SET version_id = version_id + 1 WHERE id = :id'),
+        {'id': product.id}
+    )
+    product.stock -= 1
+    with pytest.raises(StaleDataError):
+        db.session.commit()
+    db.session.rollback()
+
+
+def conflicting_set_stock(monkeypatch, conflicts):
+    """Make set_stock lose the race to another writer ``conflicts`` times"""
+    import main
+    from db import db
+    set_stock = main.set_stock
+    calls = []
+
+    def racing(product, *args, **kwargs):
+        calls.append(product.id)
+        if len(calls) <= conflicts:
+            db.session.execute(
+                db.text('UPDATE products SET version_id = version_id + 1 WHERE id = :id'),
+                {'id': product.id}
+            )
+        return set_stock(product, *args, **kwargs)
+    monkeypatch.setattr(main, 'set_stock', racing)
+    return calls
+
+
+def test_update_product_retries_a_version_conflict(client, admin_token, test_product, monkeypatch):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    calls = conflicting_set_stock(monkeypatch, conflicts=1)
+
+    response = client.put(f"/products/{test_product['id']}", json={'stock': 5}, headers=headers)
+    assert response.status_code == 200
+    assert len(calls) == 2
+    assert json.loads(client.get(f"/products/{test_product['id']}").data)['details']['stock'] == 5
+
+
+def test_update_product_gives_up_after_max_attempts(client, admin_token, test_product, monkeypatch):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    calls = conflicting_set_stock(monkeypatch, conflicts=3)
+
+    response = client.put(f"/products/{test_product['id']}", json={'stock': 5}, headers=headers)
+    assert response.status_code == 409
+    assert len(calls) == 3
+    assert json.loads(client.get(f"/products/{test_product['id']}").data)['details']['stock'] == 10
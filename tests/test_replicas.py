@@ -0,0 +1,117 @@
+import json
+import pytest
+from sqlalchemy import create_engine, text
+from db import db
+from product import Product, ProductFactory
+from utils import replicas as replicas_module
+from utils.replicas import STICKY_HEADER, get_replicas, reset_replicas
+
+
+@pytest.fixture
+def replica_urls(app, tmp_path):
+    urls = [f'sqlite:///{tmp_path}/replica{i}.db' for i in range(2)]
+    for url in urls:
+        engine = create_engine(url)
+        db.metadata.create_all(engine)
+        engine.dispose()
+    app.config['SQLALCHEMY_REPLICA_URIS'] = urls
+    reset_replicas(app)
+    yield urls
+    reset_replicas(app)
+    app.config['SQLALCHEMY_REPLICA_URIS'] = []
+
+
+def replicate(app):
+    """Copy the primary's rows to every replica, standing in for streaming replication"""
+    for engine in get_replicas(app).engines:
+        with engine.begin() as connection:
+            for table in reversed(db.metadata.sorted_tables):
+                connection.execute(table.delete())
+            for table in db.metadata.sorted_tables:
+                rows = [dict(row) for row in db.session.execute(table.select()).mappings()]
+                if rows:
+                    connection.execute(table.insert(), rows)
+
+
+def product_names(client, **kwargs):
+    response = client.get('/products', **kwargs)
+    assert response.status_code == 200
+    return [product['name'] for product in json.loads(response.data)['products']]
+
+
+def add_product(name):
+    db.session.add(ProductFactory.create_product('digital', name=name, price=5, file_size=1, download_link='x'))
+    db.session.commit()
+
+
+def test_reads_go_to_replica(app, client, replica_urls):
+    add_product('Replicated')
+    replicate(app)
+    add_product('Not yet replicated')
+
+    assert product_names(client) == ['Replicated']
+
+
+def test_writer_reads_own_writes(app, client, test_product, replica_urls):
+    client.post('/users', json={
+        'username': 'customer', 'email': 'customer@example.com',
+        'password': 'pass123', 'user_type': 'customer'
+    })
+    login_response = client.post('/login', json={'email': 'customer@example.com', 'password': 'pass123'})
+    headers = {'Authorization': f"Bearer {json.loads(login_response.data)['token']}"}
+    replicate(app)
+
+    response = client.post('/cart/add', json={'product_id': test_product['id'], 'quantity': 1}, headers=headers)
+    assert response.status_code == 201
+
+    token = response.headers[STICKY_HEADER]
+
+    # The customer just wrote, so they see their cart line although the
+    # replicas do not have it, also on a worker that did not handle the write
+    reset_replicas(app)
+    response = client.get('/cart', headers=headers)
+    assert len(json.loads(response.data)['items']) == 1
+
+    client.cookie_jar.clear()
+    response = client.get('/cart', headers=headers)
+    assert json.loads(response.data)['items'] == []
+    # Clients that do not keep cookies can send the header back instead
+    response = client.get('/cart', headers=dict(headers, **{STICKY_HEADER: token}))
+    assert len(json.loads(response.data)['items']) == 1
+    # A forged stick-until time is ignored
+    response = client.get('/cart', headers=dict(headers, **{STICKY_HEADER: '9999999999.0'}))
+    assert json.loads(response.data)['items'] == []
+
+
+def test_lagging_replicas_fall_back_to_primary(app, client, replica_urls, monkeypatch):
+    add_product('Primary only')
+    monkeypatch.setattr(replicas_module, 'measure_lag', lambda engine: 60.0)
+
+    assert product_names(client) == ['Primary only']
+
+
+def test_round_robin_and_least_connections(app, replica_urls):
+    replicas = get_replicas(app)
+    first, second = replicas.engines
+    assert [replicas.choose() for _ in range(4)] == [first, second, first, second]
+
+    replicas.policy = 'least_connections'
+    connection = first.connect()
+    try:
+        assert replicas.choose() is second
+    finally:
+        connection.close()
+
+
+def test_writes_go_to_primary(app, client, admin_token, replica_urls):
+    replicate(app)
+    response = client.post('/products', json={
+        'name': 'Written', 'price': 1, 'product_type': 'digital',
+        'file_size': 1, 'download_link': 'x'
+    }, headers={'Authorization': f'Bearer {admin_token}'})
+    assert response.status_code == 201
+
+    assert [product.name for product in Product.query.all()] == ['Written']
+    for engine in get_replicas(app).engines:
+        with engine.connect() as connection:
+            assert connection.execute(text('SELECT COUNT(*) FROM products')).scalar() == 0
@@ -0,0 +1,40 @@
+import logging
+import os
+import subprocess
+import sys
+from utils.logger import LazyFileHandler
+from utils.startup import StartupTimer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds a cold import of the app may take; generous so slow CI machines pass
+STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET', 3))
+
+
+def test_cold_import_within_budget(tmp_path):
+    script = 'import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)'
+    env = dict(os.environ, PYTHONPATH=ROOT, DB_HOST='unreachable.invalid')
+    result = subprocess.run([sys.executable, '-c', script], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, check=True)
+
+    assert float(result.stdout.strip().splitlines()[-1]) < STARTUP_BUDGET
+    # Log files are only opened once something is logged
+    assert not (tmp_path / 'logs').exists()
+
+
+def test_lazy_file_handler_creates_directory_on_first_record(tmp_path):
+    handler = LazyFileHandler(str(tmp_path / 'logs' / 'app.log'))
+    assert not (tmp_path / 'logs').exists()
+
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, 'hello', None, None)
+    handler.emit(record)
+    handler.close()
+    assert (tmp_path / 'logs' / 'app.log').read_text().strip() == 'hello'
+
+
+def test_startup_timer_report():
+    timer = StartupTimer()
+    with timer.step('init_db'):
+        pass
+    timer.mark('rest')
+    assert [name for name, _ in timer.steps] == ['init_db', 'rest']
+    assert timer.report().splitlines()[-1].startswith('total')
@@ -0,0 +1,241 @@
+from functools import wraps
+from datetime import datetime, timedelta
+from threading import Condition
+import json
+import time
+from flask import request, jsonify, current_app, g
+from sqlalchemy.exc import IntegrityError
+from db import db
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+DEFAULT_TTL = timedelta(hours=24)
+# How long an in-progress reservation is honoured before another request may take it over
+LOCK_TIMEOUT = timedelta(seconds=30)
+# Scope of requests without a logged in user; NULL user ids never conflict
+# under the unique constraint, so anonymous keys would never be found again
+ANONYMOUS_USER = 0
+
+RESERVED = 'reserved'
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(255), nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    route = db.Column(db.String(200), nullable=False)
+    state = db.Column(db.String(20), nullable=False, default=IN_PROGRESS)
+    status_code = db.Column(db.Integer)
+    response_body = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('key', 'user_id', 'route', name='uq_idempotency_key_user_route'),
+    )
+
+
+class DatabaseIdempotencyStore:
+    """Keeps idempotency records in the idempotency_keys table.
+
+    The unique constraint on (key, user_id, route) acts as the lock: the
+    request that inserts the in-progress row owns the key, everyone else
+    polls until the owner stores its response.
+    """
+
+    def __init__(self, poll_interval=0.1):
+        self.poll_interval = poll_interval
+
+    def reserve(self, key, user_id, route, now=None):
+        """Claim a key. Returns (state, stored response or None)"""
+        now = now or datetime.utcnow()
+        db.session.add(IdempotencyKey(
+            key=key,
+            user_id=user_id,
+            route=route,
+            state=IN_PROGRESS,
+            created_at=now,
+            expires_at=now + LOCK_TIMEOUT
+        ))
+        try:
+            db.session.commit()
+            return RESERVED, None
+        except IntegrityError:
+            db.session.rollback()
+
+        record = IdempotencyKey.query.filter_by(key=key, user_id=user_id, route=route).first()
+        if record is None:
+            return self.reserve(key, user_id, route)
+        if record.expires_at <= now:
+            # Expired response or abandoned lock, start over
+            db.session.delete(record)
+            db.session.commit()
+            return self.reserve(key, user_id, route)
+        if record.state == COMPLETED:
+            return COMPLETED, (json.loads(record.response_body), record.status_code)
+        return IN_PROGRESS, None
+
+    def wait(self, key, user_id, route):
+        time.sleep(self.poll_interval)
+
+    def complete(self, key, user_id, route, body, status_code, ttl=DEFAULT_TTL):
+        IdempotencyKey.query.filter_by(key=key, user_id=user_id, route=route).update({
+            'state': COMPLETED,
+            'status_code': status_code,
+            'response_body': json.dumps(body),
+            'expires_at': datetime.utcnow() + ttl
+        }, synchronize_session=False)
+        db.session.commit()
+
+    def release(self, key, user_id, route):
+        db.session.rollback()
+        IdempotencyKey.query.filter_by(
+            key=key, user_id=user_id, route=route, state=IN_PROGRESS
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    def purge_expired(self):
+        """Delete expired records and return how many were removed"""
+        deleted = IdempotencyKey.query.filter(
+            IdempotencyKey.expires_at <= datetime.utcnow()
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+class LocalIdempotencyStore:
+    """In-process idempotency store for tests and single-process development.
+
+    Waiting duplicates block on a condition variable instead of polling.
+    """
+
+    def __init__(self):
+        self._records = {}
+        self._condition = Condition()
+
+    def reserve(self, key, user_id, route, now=None):
+        now = now or datetime.utcnow()
+        with self._condition:
+            record = self._records.get((key, user_id, route))
+            if record is None or record['expires_at'] <= now:
+                self._records[(key, user_id, route)] = {
+                    'state': IN_PROGRESS,
+                    'expires_at': now + LOCK_TIMEOUT
+                }
+                return RESERVED, None
+            if record['state'] == COMPLETED:
+                return COMPLETED, (record['body'], record['status_code'])
+            return IN_PROGRESS, None
+
+    def wait(self, key, user_id, route):
+        with self._condition:
+            record = self._records.get((key, user_id, route))
+            if record is not None and record['state'] == IN_PROGRESS:
+                self._condition.wait(timeout=1)
+
+    def complete(self, key, user_id, route, body, status_code, ttl=DEFAULT_TTL):
+        with self._condition:
+            self._records[(key, user_id, route)] = {
+                'state': COMPLETED,
+                'body': body,
+                'status_code': status_code,
+                'expires_at': datetime.utcnow() + ttl
+            }
+            self._condition.notify_all()
+
+    def release(self, key, user_id, route):
+        with self._condition:
+            record = self._records.get((key, user_id, route))
+            if record is not None and record['state'] == IN_PROGRESS:
+                del self._records[(key, user_id, route)]
+            self._condition.notify_all()
+
+    def purge_expired(self):
+        now = datetime.utcnow()
+        with self._condition:
+            expired = [k for k, record in self._records.items() if record['expires_at'] <= now]
+            for k in expired:
+                del self._records[k]
+        return len(expired)
+
+
+STORES = {
+    'database': DatabaseIdempotencyStore,
+    'local': LocalIdempotencyStore
+}
+
+
+def get_store(app=None):
+    """Get the app's idempotency store, chosen by IDEMPOTENCY_BACKEND"""
+    app = app or current_app
+    store = app.extensions.get('idempotency_store')
+    if store is None:
+        backend = app.config.get('IDEMPOTENCY_BACKEND', 'database')
+        if backend not in STORES:
+            raise ValueError(f"Invalid idempotency backend: {backend}")
+        store = app.extensions['idempotency_store'] = STORES[backend]()
+    return store
+
+
+def reset_store(app=None):
+    (app or current_app).extensions.pop('idempotency_store', None)
+
+
+def _replay(body, status_code):
+    response = jsonify(body)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, status_code
+
+
+def idempotent(ttl=DEFAULT_TTL, wait_timeout=10):
+    """Make a mutating route safe to retry with an Idempotency-Key header.
+
+    Keys are scoped to (key, user, route). The first request reserves the
+    key and runs; concurrent duplicates wait for its response instead of
+    running twice, and later retries replay the stored response. Requests
+    without the header run as usual. Server errors release the key so the
+    client can retry. Apply below ``token_required``/``admin_required`` so
+    the caller is known.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(IDEMPOTENCY_HEADER)
+            if not key:
+                return func(*args, **kwargs)
+
+            current_user = getattr(g, 'current_user', None)
+            user_id = current_user.id if current_user is not None else ANONYMOUS_USER
+            route = f'{request.method} {request.path}'
+            store = get_store()
+
+            deadline = time.monotonic() + wait_timeout
+            while True:
+                state, stored = store.reserve(key, user_id, route)
+                if state == RESERVED:
+                    break
+                if state == COMPLETED:
+                    return _replay(*stored)
+                if time.monotonic() >= deadline:
+                    return jsonify({
+                        'error': 'A request with this Idempotency-Key is still in progress'
+                    }), 409
+                store.wait(key, user_id, route)
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                store.release(key, user_id, route)
+                raise
+
+            response, status_code = result if isinstance(result, tuple) else (result, 200)
+            if status_code >= 500:
+                store.release(key, user_id, route)
+            else:
+                store.complete(key, user_id, route, response.get_json(), status_code, ttl)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,221 @@
+"""Database-backed queue for long admin operations.
+
+``POST /jobs`` stores a job and returns its id straight away; a runner
+process (``flask run-jobs``) works through the queue with a pool of
+threads and records progress and results on the job row, which clients
+poll with ``GET /jobs/<id>``. Runners claim jobs with SKIP LOCKED on
+PostgreSQL, so several can share one queue.
+"""
+from datetime import datetime, timedelta
+from threading import Event, Thread
+import json
+import os
+import socket
+import time
+from sqlalchemy import update
+from db import db
+from utils.logger import logger
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+_handlers = {}
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(20), nullable=False, default=QUEUED)
+    progress = db.Column(db.Float, nullable=False, default=0)
+    message = db.Column(db.String(500))
+    result = db.Column(db.Text)
+    error = db.Column(db.String(500))
+    created_by = db.Column(db.Integer)
+    worker = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # Refreshed while the job runs; a stale heartbeat means its runner died
+    heartbeat_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_id', 'status', 'id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'type': self.job_type,
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+def job_handler(job_type):
+    """Register ``func(params, progress)`` to run jobs of ``job_type``.
+
+    ``progress(fraction, message=None)`` records how far the job got. The
+    handler's return value is stored as the job result and must be JSON
+    serializable.
+    """
+    def decorator(func):
+        _handlers[job_type] = func
+        return func
+    return decorator
+
+
+def job_types():
+    return sorted(_handlers)
+
+
+def enqueue(job_type, params=None, created_by=None):
+    """Queue a job and commit. Returns the job"""
+    if job_type not in _handlers:
+        raise ValueError(f"Invalid job type: {job_type}")
+    job = Job(job_type=job_type, params=json.dumps(params or {}), status=QUEUED,
+              progress=0, created_by=created_by, created_at=datetime.utcnow())
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def _update_job(job_id, **values):
+    # Own transaction, so progress is visible while the job's work is still uncommitted
+    with db.engine.begin() as connection:
+        connection.execute(update(Job.__table__).where(Job.__table__.c.id == job_id).values(**values))
+
+
+def _report(job_id, **values):
+    """Best-effort progress write; a failure must not fail the job"""
+    try:
+        _update_job(job_id, **values)
+    except Exception as e:
+        logger.warning(f"Could not record progress of job {job_id}: {str(e)}")
+
+
+class JobRunner:
+    """Runs queued jobs on ``workers`` threads, each with its own app context"""
+
+    def __init__(self, app, workers=4, poll_interval=1.0, heartbeat_timeout=300):
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+        self._stop = Event()
+
+    def claim(self):
+        """Mark the oldest queued job as running and return it, or None"""
+        job = Job.query.filter_by(status=QUEUED).order_by(Job.id).with_for_update(skip_locked=True).first()
+        if job is None:
+            db.session.commit()
+            return None
+        now = datetime.utcnow()
+        job.status = RUNNING
+        job.worker = self.name
+        job.started_at = now
+        job.heartbeat_at = now
+        db.session.commit()
+        return job
+
+    def fail_abandoned(self):
+        """Fail running jobs whose runner stopped sending heartbeats.
+
+        Jobs are not retried automatically: bulk creation is not safe to
+        run twice.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=self.heartbeat_timeout)
+        abandoned = Job.query.filter(Job.status == RUNNING, Job.heartbeat_at < cutoff).update({
+            'status': FAILED,
+            'error': 'Job runner stopped responding',
+            'finished_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        return abandoned
+
+    def run_job(self, job):
+        job_id, job_type = job.id, job.job_type
+
+        def progress(fraction, message=None):
+            values = {'progress': min(max(fraction, 0), 1), 'heartbeat_at': datetime.utcnow()}
+            if message is not None:
+                values['message'] = message[:500]
+            _report(job_id, **values)
+
+        finished = Event()
+
+        def heartbeat():
+            with self.app.app_context():
+                while not finished.wait(self.heartbeat_timeout / 3):
+                    _report(job_id, heartbeat_at=datetime.utcnow())
+
+        Thread(target=heartbeat, name=f'job-heartbeat-{job_id}', daemon=True).start()
+        started = time.monotonic()
+        try:
+            result = _handlers[job_type](json.loads(job.params), progress)
+            db.session.commit()
+            _update_job(job_id, status=SUCCEEDED, progress=1, result=json.dumps(result),
+                        finished_at=datetime.utcnow())
+            logger.info(f"Job {job_id} ({job_type}) finished in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            db.session.rollback()
+            _update_job(job_id, status=FAILED, error=str(e)[:500], finished_at=datetime.utcnow())
+            logger.error(f"Job {job_id} ({job_type}) failed: {str(e)}")
+        finally:
+            finished.set()
+
+    def run_once(self):
+        """Claim and run one job in the current app context. Returns False if the queue was empty"""
+        job = self.claim()
+        if job is None:
+            return False
+        self.run_job(job)
+        return True
+
+    def _work(self):
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    ran = self.run_once()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Job runner error: {str(e)}")
+                    ran = False
+                finally:
+                    db.session.remove()
+                if not ran:
+                    self._stop.wait(self.poll_interval)
+
+    def run(self):
+        """Run until interrupted"""
+        threads = [Thread(target=self._work, name=f'job-worker-{n}', daemon=True) for n in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        checked_at = None
+        try:
+            while any(thread.is_alive() for thread in threads):
+                if checked_at is None or time.monotonic() - checked_at > self.heartbeat_timeout:
+                    with self.app.app_context():
+                        self.fail_abandoned()
+                        db.session.remove()
+                    checked_at = time.monotonic()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            # Running jobs finish; nothing new is claimed
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,72 @@
+from threading import Condition
+import time
+from sqlalchemy import text
+from db import db
+from orders.pending import pending_counter
+from utils.logger import logger
+
+
+class Lifecycle:
+    """Tracks a worker's in-flight requests so it can drain before exiting.
+
+    Once draining starts the readiness probe answers 503, so the load
+    balancer stops routing to the worker while it finishes what it has.
+    """
+
+    def __init__(self):
+        self.draining = False
+        self.in_flight = 0
+        self._condition = Condition()
+
+    def init_app(self, app):
+        app.extensions['lifecycle'] = self
+        app.before_request(self._request_started)
+        app.teardown_request(self._request_finished)
+
+    def _request_started(self):
+        with self._condition:
+            self.in_flight += 1
+
+    def _request_finished(self, exc=None):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    @property
+    def ready(self):
+        return not self.draining
+
+    def start_draining(self):
+        with self._condition:
+            self.draining = True
+
+    def drain(self, timeout=30):
+        """Stop taking traffic and wait for in-flight requests. Returns True if all finished"""
+        self.start_draining()
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self.in_flight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"Shutting down with {self.in_flight} requests in flight")
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+
+def warm_up(app, connections=None):
+    """Open the worker's pool connections and fill its caches before it takes traffic"""
+    started = time.monotonic()
+    with app.app_context():
+        try:
+            size = connections or getattr(db.engine.pool, 'size', lambda: 1)()
+            opened = [db.engine.connect() for _ in range(size)]
+            for connection in opened:
+                connection.execute(text('SELECT 1'))
+                connection.close()
+            pending_counter.counts()
+        except Exception as e:
+            logger.error(f"Worker warm-up failed: {str(e)}")
+        finally:
+            db.session.remove()
+    logger.info(f"Worker warmed up in {time.monotonic() - started:.2f}s")
@@ -4,7 +4,16 @@ from datetime import datetime
 import os
 
 
-os.makedirs('logs', exist_ok=True)
+class LazyFileHandler(logging.FileHandler):
+    """FileHandler that creates its directory and opens the file on the first record"""
+
+    def __init__(self, filename):
+        super().__init__(filename, delay=True)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
 
 logging.basicConfig(level=logging.INFO)
 
@@ -13,31 +22,31 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 
 
 logger = logging.getLogger('ecommerce')
-general_handler = logging.FileHandler('logs/general.log')
+general_handler = LazyFileHandler('logs/general.log')
 general_handler.setFormatter(formatter)
 logger.addHandler(general_handler)
 
 # User operations logger
 user_logger = logging.getLogger('user_operations')
-user_handler = logging.FileHandler('logs/user_operations.log')
+user_handler = LazyFileHandler('logs/user_operations.log')
 user_handler.setFormatter(formatter)
 user_logger.addHandler(user_handler)
 
 # Product operations logger
 product_logger = logging.getLogger('product_operations')
-product_handler = logging.FileHandler('logs/product_operations.log')
+product_handler = LazyFileHandler('logs/product_operations.log')
 product_handler.setFormatter(formatter)
 product_logger.addHandler(product_handler)
 
 # Cart operations logger
 cart_logger = logging.getLogger('cart_operations')
-cart_handler = logging.FileHandler('logs/cart_operations.log')
+cart_handler = LazyFileHandler('logs/cart_operations.log')
 cart_handler.setFormatter(formatter)
 cart_logger.addHandler(cart_handler)
 
 # Order operations logger
 order_logger = logging.getLogger('order_operations')
-order_handler = logging.FileHandler('logs/order_operations.log')
+order_handler = LazyFileHandler('logs/order_operations.log')
 order_handler.setFormatter(formatter)
 order_logger.addHandler(order_handler)
 
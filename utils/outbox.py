@@ -0,0 +1,258 @@
+"""Transactional outbox for order and stock events.
+
+Routes call ``publish`` before they commit, so an event is stored if and
+only if the change it describes is. A dispatcher process (``flask
+dispatch-outbox``) then claims pending events in batches and delivers them
+to the configured sinks, at least once: consumers should de-duplicate on
+the event id.
+"""
+from datetime import datetime, timedelta
+import json
+import os
+import time
+import urllib.request
+from sqlalchemy import select
+from db import db
+from utils.logger import logger
+
+PENDING = 'pending'
+DISPATCHING = 'dispatching'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+
+class OutboxEvent(db.Model):
+    __tablename__ = 'outbox_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default=PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Not claimed again before this time: the retry backoff, or a dispatcher's claim
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    delivered_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(500))
+
+    __table_args__ = (
+        db.Index('ix_outbox_events_status_available_at', 'status', 'available_at', 'id'),
+    )
+
+    def to_message(self):
+        return event_message(self)
+
+
+def event_message(event):
+    """The message delivered for an event, from an OutboxEvent or a row of its columns"""
+    return {
+        'id': event.id,
+        'type': event.event_type,
+        'created_at': event.created_at.isoformat(),
+        'payload': json.loads(event.payload)
+    }
+
+
+def publish(event_type, payload, session=None):
+    """Queue an event in the current transaction; it is stored when the caller commits"""
+    now = datetime.utcnow()
+    (session or db.session).add(OutboxEvent(
+        event_type=event_type,
+        payload=json.dumps(payload),
+        status=PENDING,
+        attempts=0,
+        created_at=now,
+        available_at=now
+    ))
+
+
+class FileSink:
+    """Appends events to a file as JSON lines"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, messages):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a') as out:
+            out.writelines(json.dumps(message) + '\n' for message in messages)
+            out.flush()
+            os.fsync(out.fileno())
+
+
+class HttpSink:
+    """POSTs each batch as a JSON array; any non-2xx answer fails the batch"""
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, messages):
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(messages).encode(),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if not 200 <= response.status < 300:
+                raise RuntimeError(f"{self.url} answered {response.status}")
+
+
+def sinks_from_config(spec):
+    """Build sinks from a comma separated list of URLs and file:<path> entries"""
+    sinks = []
+    for entry in (spec or '').split(','):
+        entry = entry.strip()
+        if entry.startswith(('http://', 'https://')):
+            sinks.append(HttpSink(entry))
+        elif entry.startswith('file:'):
+            sinks.append(FileSink(entry[len('file:'):]))
+        elif entry:
+            raise ValueError(f"Invalid outbox sink: {entry}")
+    return sinks
+
+
+class Dispatcher:
+    """Claims pending outbox events in batches and delivers them to ``sinks``.
+
+    Claims use SELECT ... FOR UPDATE SKIP LOCKED on PostgreSQL, so several
+    dispatchers can run side by side without delivering the same batch. A
+    claim lasts ``claim_timeout`` seconds; if the dispatcher dies first the
+    events become available again. Failed batches are retried with
+    exponential backoff and marked failed after ``max_attempts``.
+    """
+
+    def __init__(self, sinks, batch_size=100, max_attempts=8, backoff=2.0, claim_timeout=60):
+        self.sinks = sinks
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.claim_timeout = claim_timeout
+        self.metrics = {'batches': 0, 'delivered': 0, 'retried': 0, 'failed': 0, 'busy_seconds': 0.0}
+
+    def claim(self, now=None):
+        """Claim a batch of due events. Returns their rows, read before the claim commits"""
+        now = now or datetime.utcnow()
+        table = OutboxEvent.__table__
+        rows = db.session.execute(select(
+            table.c.id, table.c.event_type, table.c.payload, table.c.created_at, table.c.attempts
+        ).where(
+            table.c.status.in_((PENDING, DISPATCHING)),
+            table.c.available_at <= now
+        ).order_by(table.c.id).limit(self.batch_size).with_for_update(skip_locked=True)).all()
+        if rows:
+            db.session.execute(table.update().where(table.c.id.in_([row.id for row in rows])).values(
+                status=DISPATCHING,
+                available_at=now + timedelta(seconds=self.claim_timeout)
+            ))
+        db.session.commit()
+        return rows
+
+    def _finish(self, rows, error):
+        """Record a batch's outcome with one UPDATE per outcome"""
+        table = OutboxEvent.__table__
+        now = datetime.utcnow()
+        outcomes = {}
+        for row in rows:
+            attempts = row.attempts + 1
+            if error is None:
+                values = {'status': DELIVERED, 'delivered_at': now}
+            elif attempts >= self.max_attempts:
+                values = {'status': FAILED, 'last_error': error[:500]}
+            else:
+                values = {
+                    'status': PENDING,
+                    'available_at': now + timedelta(seconds=self.backoff ** attempts),
+                    'last_error': error[:500]
+                }
+            outcomes.setdefault(tuple(sorted(values.items())), []).append(row.id)
+        failed = 0
+        for values, ids in outcomes.items():
+            values = dict(values)
+            if values['status'] == FAILED:
+                failed += len(ids)
+            db.session.execute(table.update().where(table.c.id.in_(ids)).values(
+                attempts=table.c.attempts + 1, **values
+            ))
+        db.session.commit()
+        return failed
+
+    def dispatch_once(self):
+        """Claim and deliver one batch. Returns the number of events in it"""
+        started = time.monotonic()
+        rows = self.claim()
+        if not rows:
+            return 0
+
+        messages = [event_message(row) for row in rows]
+        error = None
+        try:
+            for sink in self.sinks:
+                sink.send(messages)
+        except Exception as e:
+            error = str(e)
+        failed = self._finish(rows, error)
+
+        self.metrics['batches'] += 1
+        self.metrics['busy_seconds'] += time.monotonic() - started
+        if error is None:
+            self.metrics['delivered'] += len(rows)
+        else:
+            self.metrics['failed'] += failed
+            self.metrics['retried'] += len(rows) - failed
+            logger.error(f"Outbox delivery of {len(rows)} events failed: {error}")
+        return len(rows)
+
+    def run(self, interval=1.0, should_stop=lambda: False):
+        """Deliver until ``should_stop()``; sleeps ``interval`` seconds when idle"""
+        while not should_stop():
+            try:
+                delivered = self.dispatch_once()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Outbox dispatch failed: {str(e)}")
+                delivered = 0
+            finally:
+                db.session.remove()
+            if delivered < self.batch_size:
+                time.sleep(interval)
+
+    def throughput(self):
+        """Events delivered per second of dispatching"""
+        busy = self.metrics['busy_seconds']
+        return self.metrics['delivered'] / busy if busy else 0.0
+
+
+def outbox_stats(now=None):
+    """Backlog, lag and recent throughput, from the outbox table"""
+    now = now or datetime.utcnow()
+    counts = dict(db.session.query(OutboxEvent.status, db.func.count(OutboxEvent.id)).group_by(
+        OutboxEvent.status
+    ).all())
+    oldest = db.session.query(db.func.min(OutboxEvent.created_at)).filter(
+        OutboxEvent.status.in_((PENDING, DISPATCHING))
+    ).scalar()
+    delivered_last_minute = OutboxEvent.query.filter(
+        OutboxEvent.status == DELIVERED,
+        OutboxEvent.delivered_at >= now - timedelta(minutes=1)
+    ).count()
+    return {
+        'pending': counts.get(PENDING, 0) + counts.get(DISPATCHING, 0),
+        'failed': counts.get(FAILED, 0),
+        'delivered': counts.get(DELIVERED, 0),
+        'lag_seconds': (now - oldest).total_seconds() if oldest else 0.0,
+        'delivered_per_minute': delivered_last_minute
+    }
+
+
+def prune_outbox(keep=timedelta(days=7)):
+    """Delete delivered events older than ``keep``. Returns the number deleted"""
+    deleted = OutboxEvent.query.filter(
+        OutboxEvent.status == DELIVERED,
+        OutboxEvent.delivered_at < datetime.utcnow() - keep
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
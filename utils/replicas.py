@@ -0,0 +1,195 @@
+from itertools import count
+from math import ceil
+from threading import Lock
+import time
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy import SignallingSession
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.sql.selectable import Select, CompoundSelect
+from utils.logger import logger
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+POLICIES = ('round_robin', 'least_connections')
+
+# Seconds a client's reads stay on the primary after it commits a change
+DEFAULT_STICKY_SECONDS = 5
+# Carry the signed stick-until time, so every worker and node honours it
+STICKY_COOKIE = 'replica_sticky'
+STICKY_HEADER = 'X-Replica-Sticky'
+# Replicas further behind than this many seconds are skipped
+DEFAULT_MAX_LAG = 5
+DEFAULT_LAG_CHECK_INTERVAL = 2
+
+
+def measure_lag(engine):
+    """Seconds the replica behind ``engine`` is behind its primary.
+
+    Only PostgreSQL streaming replicas report lag; a replica that has
+    replayed everything it received counts as current.
+    """
+    if engine.dialect.name != 'postgresql':
+        return 0.0
+    with engine.connect() as connection:
+        lag = connection.execute(text(
+            "SELECT CASE "
+            "WHEN NOT pg_is_in_recovery() THEN 0 "
+            "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        )).scalar()
+    return float(lag or 0)
+
+
+class ReplicaSet:
+    """Read replicas for one app, picked by policy and skipped while lagging"""
+
+    def __init__(self, urls, policy='round_robin', sticky_seconds=DEFAULT_STICKY_SECONDS,
+                 max_lag=DEFAULT_MAX_LAG, lag_check_interval=DEFAULT_LAG_CHECK_INTERVAL):
+        if policy not in POLICIES:
+            raise ValueError(f"Invalid replica policy: {policy}")
+        self.engines = [create_engine(url) for url in urls]
+        self.policy = policy
+        self.sticky_seconds = sticky_seconds
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self._turn = count()
+        self._connections = {engine: 0 for engine in self.engines}
+        for engine in self.engines:
+            event.listen(engine, 'checkout', self._counter(engine, 1))
+            event.listen(engine, 'checkin', self._counter(engine, -1))
+        self._lags = {}
+        self._lock = Lock()
+
+    def _counter(self, engine, step):
+        def count_connection(*args):
+            with self._lock:
+                self._connections[engine] += step
+        return count_connection
+
+    def lag(self, engine, now=None):
+        """Replication lag of ``engine``, re-measured at most every lag_check_interval"""
+        now = now or time.monotonic()
+        checked_at, lag = self._lags.get(engine, (None, None))
+        if checked_at is None or now - checked_at >= self.lag_check_interval:
+            try:
+                lag = measure_lag(engine)
+            except Exception as e:
+                logger.warning(f"Replica {engine.url!r} unavailable: {str(e)}")
+                lag = float('inf')
+            self._lags[engine] = (now, lag)
+        return lag
+
+    def choose(self):
+        """Pick a replica for a read, or None to read from the primary"""
+        if not self.engines:
+            return None
+        candidates = [engine for engine in self.engines if self.lag(engine) <= self.max_lag]
+        if not candidates:
+            return None
+        if self.policy == 'least_connections':
+            return min(candidates, key=self._connections.get)
+        return candidates[next(self._turn) % len(candidates)]
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def get_replicas(app=None):
+    """Get the app's replica set, configured by SQLALCHEMY_REPLICA_URIS"""
+    app = app or current_app
+    replicas = app.extensions.get('replicas')
+    if replicas is None:
+        replicas = app.extensions['replicas'] = ReplicaSet(
+            app.config.get('SQLALCHEMY_REPLICA_URIS') or [],
+            policy=app.config.get('REPLICA_POLICY', 'round_robin'),
+            sticky_seconds=app.config.get('REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS),
+            max_lag=app.config.get('REPLICA_MAX_LAG', DEFAULT_MAX_LAG),
+            lag_check_interval=app.config.get('REPLICA_LAG_CHECK_INTERVAL', DEFAULT_LAG_CHECK_INTERVAL)
+        )
+    return replicas
+
+
+def reset_replicas(app=None):
+    replicas = (app or current_app).extensions.pop('replicas', None)
+    if replicas is not None:
+        replicas.dispose()
+
+
+def _sticky_serializer(app):
+    return URLSafeSerializer(app.config['SECRET_KEY'], salt='replica-sticky')
+
+
+def is_sticky(now=None):
+    """True if the client committed a change within the last few seconds.
+
+    The stick-until time comes back from the client in the signed cookie
+    (or header) set after its write, so it holds whichever worker or node
+    serves the next request. A missing or tampered value is ignored.
+    """
+    environ = request.environ
+    if 'replica.sticky_until' not in environ:
+        token = request.cookies.get(STICKY_COOKIE) or request.headers.get(STICKY_HEADER)
+        try:
+            environ['replica.sticky_until'] = float(_sticky_serializer(current_app).loads(token)) if token else None
+        except (BadSignature, TypeError, ValueError):
+            environ['replica.sticky_until'] = None
+    until = environ['replica.sticky_until']
+    return until is not None and until > (now or time.time())
+
+
+def send_stickiness(response):
+    """after_request hook: hand a client that just wrote its signed stick-until time"""
+    until = request.environ.get('replica.stuck_until')
+    if until is not None:
+        token = _sticky_serializer(current_app).dumps(until)
+        seconds = get_replicas(current_app).sticky_seconds
+        response.set_cookie(STICKY_COOKIE, token, max_age=ceil(seconds), httponly=True, samesite='Lax')
+        response.headers[STICKY_HEADER] = token
+    return response
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends the reads of read-only requests to a replica.
+
+    A request reads from one replica for its whole lifetime. Everything else
+    goes to the primary: writes, SELECT ... FOR UPDATE, raw statements, work
+    outside a request, reads after the session has written, and reads by a
+    client that committed a change within the last few seconds.
+    """
+
+    def reset_routing(self):
+        """Forget the replica and write state of the previous request"""
+        self.info.pop('replica', None)
+        self.info.pop('wrote', None)
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._is_replica_read(clause):
+            if not is_sticky():
+                if 'replica' not in self.info:
+                    self.info['replica'] = get_replicas(self.app).choose()
+                if self.info['replica'] is not None:
+                    return self.info['replica']
+        elif not isinstance(clause, (Select, CompoundSelect)):
+            self.info['wrote'] = True
+        return super().get_bind(mapper, clause)
+
+    def _is_replica_read(self, clause):
+        if self._flushing or self.info.get('wrote'):
+            return False
+        if not isinstance(clause, (Select, CompoundSelect)):
+            return False
+        if getattr(clause, '_for_update_arg', None) is not None:
+            return False
+        return has_request_context() and request.method in READ_METHODS
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _stick_after_write(session):
+    if not session.info.get('wrote') or not has_request_context():
+        return
+    replicas = get_replicas(session.app)
+    if replicas.engines:
+        request.environ['replica.sticky_until'] = request.environ['replica.stuck_until'] = (
+            time.time() + replicas.sticky_seconds
+        )
@@ -0,0 +1,29 @@
+from functools import wraps
+from flask import jsonify
+from sqlalchemy.orm.exc import StaleDataError
+from db import db
+from utils.logger import logger
+
+
+def retry_on_stale(max_attempts=3):
+    """Re-run a route when a versioned row changed underneath it.
+
+    Routes let StaleDataError propagate; the whole read-modify-write is then
+    retried against fresh rows, up to ``max_attempts`` times, before the
+    client gets a 409.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    return func(*args, **kwargs)
+                except StaleDataError as e:
+                    db.session.rollback()
+                    logger.warning(
+                        f"Concurrent update in {func.__name__} "
+                        f"(attempt {attempt}/{max_attempts}): {str(e)}"
+                    )
+            return jsonify({'error': 'Concurrent update conflict, please retry'}), 409
+        return wrapper
+    return decorator
@@ -0,0 +1,67 @@
+from contextlib import contextmanager
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_PARTY = ('main', 'db', 'migrations', 'orders', 'product', 'user', 'utils', 'wsgi', 'asgi')
+
+
+class StartupTimer:
+    """Records how long each step of bringing the app up takes.
+
+    Timing starts when this module is first imported, which main.py does
+    before anything else, so the first step covers importing the app.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps = []
+
+    def record(self, name, seconds):
+        self.steps.append((name, seconds))
+
+    @contextmanager
+    def step(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def mark(self, name):
+        """Record the time since the previous mark (or since timing started)"""
+        now = time.perf_counter()
+        self.record(name, now - self.started - sum(seconds for _, seconds in self.steps))
+
+    def report(self):
+        lines = [f"{name:<30} {seconds * 1000:8.1f} ms" for name, seconds in self.steps]
+        lines.append(f"{'total':<30} {sum(seconds for _, seconds in self.steps) * 1000:8.1f} ms")
+        return '\n'.join(lines)
+
+
+def import_times(module='main', limit=15, first_party_only=False):
+    """Import ``module`` in a fresh interpreter and return the slowest imports.
+
+    Uses ``python -X importtime``. Returns [(module, self_us, cumulative_us)]
+    sorted by cumulative time.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if first_party_only and name.split('.')[0] not in FIRST_PARTY:
+            continue
+        rows.append((name, int(self_us), int(cumulative_us)))
+    rows.sort(key=lambda row: row[2], reverse=True)
+    return rows[:limit]
+
+
+startup = StartupTimer()
@@ -0,0 +1,11 @@
+"""Production WSGI entry point.
+
+    gunicorn -c gunicorn.conf.py
+
+Building the app does not touch the database, so gunicorn can import it
+once in the master (preload_app) and fork workers without sharing
+connections. See gunicorn.conf.py for the worker lifecycle hooks.
+"""
+from main import create_app
+
+application = create_app()